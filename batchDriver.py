@@ -0,0 +1,283 @@
+import os
+import time
+import sqlite3
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import pandas
+
+import confSumm
+from confSumm import Configuration, BundleScheduler, DATA_BASE_PATH
+from gimgIndex import GimgIndex
+from expCatalog import ExpCatalog
+
+
+MANIFEST_PATH = "batchManifest.sqlite"
+FAILURE_LOG = "batchFailures.log"
+
+# manifest status values, "running" left behind by a killed driver is
+# treated like "pending" on restart
+STATUSES = ["pending", "running", "done", "failed"]
+
+
+def configIDsFromScrape(filename="holtzScrapeLCO.csv", site=None, mjdMin=None, mjdMax=None):
+    """ sorted unique configuration ids in a holtz db scrape (see
+    scrapeHoltzDB.getLCO), optionally limited to a site and mjd range
+    """
+    df = pandas.read_csv(filename)
+    if site is not None and "site" in df.columns:
+        df = df[df.site.str.lower() == site.lower()]
+    if mjdMin is not None:
+        df = df[df.mjd >= mjdMin]
+    if mjdMax is not None:
+        df = df[df.mjd <= mjdMax]
+    return sorted(set(int(x) for x in df.configurationId))
+
+
+def siteMJDsFromScrape(filename="holtzScrapeLCO.csv", configIDs=None, site="lco"):
+    """ sorted unique (site, mjd) pairs of the configurations in a holtz
+    db scrape, site is used if the scrape has no site column
+    """
+    df = pandas.read_csv(filename)
+    if configIDs is not None:
+        df = df[df.configurationId.isin([int(c) for c in configIDs])]
+    if "site" in df.columns:
+        sites = df.site.str.lower()
+    else:
+        sites = [site]*len(df)
+    return sorted(set((s, int(mjd)) for s, mjd in zip(sites, df.mjd)))
+
+
+def refreshIndexes(siteMJDs, nProcs=8):
+    """ build or update the guide frame index and exposure catalog of
+    each (site, mjd), so configurations from the same night processed at
+    once only read them
+    """
+    for site, mjd in siteMJDs:
+        tstart = time.time()
+        nGimg = GimgIndex(site, mjd, gimgBase=DATA_BASE_PATH + "/gcam/").update(nProcs=nProcs)
+        nExp = ExpCatalog(site, mjd, dataBase=DATA_BASE_PATH).update(nProcs=nProcs)
+        print("batch: %s %i indexed %i guide frames %i exposures in %.0f s"%(
+            site, mjd, nGimg, nExp, time.time() - tstart
+        ))
+
+
+class BatchManifest(object):
+    def __init__(self, path=MANIFEST_PATH):
+        """
+        SQLite record of per configuration status for a batch run (status,
+        attempts, timing and the last error), so a restarted batch skips
+        configurations that already finished.
+
+        Parameters
+        ------------------
+        path : string
+            sqlite file, created on first use
+        """
+        self.path = path
+
+    def _connect(self):
+        dirname = os.path.dirname(self.path)
+        if dirname != "":
+            os.makedirs(dirname, exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "create table if not exists configs ("
+            "configID integer primary key, status text, attempts integer, "
+            "started real, finished real, elapsed real, error text)"
+        )
+        return conn
+
+    def add(self, configIDs):
+        """ add configurations (as pending) that aren't in the manifest yet
+        """
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "insert or ignore into configs (configID, status, attempts) values (?, 'pending', 0)",
+                [(int(c),) for c in configIDs]
+            )
+        conn.close()
+
+    def status(self, configIDs=None):
+        """ returns DataFrame of manifest rows, optionally only configIDs
+        """
+        conn = self._connect()
+        df = pandas.read_sql("select * from configs order by configID", conn)
+        conn.close()
+        if configIDs is not None:
+            df = df[df.configID.isin([int(c) for c in configIDs])]
+        return df.reset_index(drop=True)
+
+    def todo(self, configIDs, retryFailed=False):
+        """ configIDs still to run: not done, and not failed unless retryFailed
+        """
+        self.add(configIDs)
+        df = self.status(configIDs)
+        skip = ["done"] if retryFailed else ["done", "failed"]
+        return df.configID[~df.status.isin(skip)].tolist()
+
+    def markStarted(self, configID):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "update configs set status='running', attempts=attempts+1, "
+                "started=?, finished=null, elapsed=null where configID=?",
+                (time.time(), int(configID))
+            )
+        conn.close()
+
+    def markFinished(self, configID, status, elapsed=None, error=None):
+        assert status in ["done", "failed"]
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "update configs set status=?, finished=?, elapsed=?, error=? where configID=?",
+                (status, time.time(), elapsed, error, int(configID))
+            )
+        conn.close()
+
+
+def processConfig(configID, bundleWorkers, bundleCache=True, resultStore=None, configKwargs=None):
+    """ run one Configuration with its own BundleScheduler, runs in a batch
+    worker process.  Never raises, returns dict with configID, status
+    ("done" or "failed"), elapsed and error (traceback or None)
+    """
+    tstart = time.time()
+    if bundleCache and confSumm.BUNDLE_CACHE is None:
+        confSumm.useBundleCache()
+    if resultStore is not None and confSumm.RESULT_STORE is None:
+        confSumm.useResultStore(resultStore)
+    if configKwargs is None:
+        configKwargs = {}
+    scheduler = None
+    try:
+        scheduler = BundleScheduler(bundleWorkers)
+        Configuration(configID, scheduler=scheduler, **configKwargs)
+        status = "done"
+        error = None
+    except Exception:
+        status = "failed"
+        error = traceback.format_exc()
+    finally:
+        if scheduler is not None:
+            scheduler.shutdown()
+    return {
+        "configID": configID, "status": status,
+        "elapsed": time.time() - tstart, "error": error
+    }
+
+
+def _logFailure(logFile, configID, error):
+    with open(logFile, "a") as f:
+        f.write("==== configID %i failed %s\n"%(configID, time.strftime("%Y-%m-%d %H:%M:%S")))
+        f.write(error)
+        if not error.endswith("\n"):
+            f.write("\n")
+
+
+def runBatch(
+    configIDs, cpuBudget=25, nConcurrent=4, manifestPath=MANIFEST_PATH,
+    logFile=FAILURE_LOG, retryFailed=False, bundleCache=True, resultStore=None,
+    configKwargs=None, siteMJDs=None
+):
+    """ process many configurations, nConcurrent at a time, resumably.
+
+    Each configuration runs in its own process with its own BundleScheduler,
+    the cpuBudget is split between them (one cpu per configuration process,
+    the rest as guide bundle workers).  Status is kept in a BatchManifest so
+    configurations done by an earlier run are skipped.  A failure (exception
+    or a crashed worker) is written to logFile with its traceback and the
+    batch carries on, failed configurations are rerun with retryFailed.
+
+    Parameters
+    ------------
+    configIDs : list of int
+        configurations to process, eg from configIDsFromScrape
+    cpuBudget : int
+        total processes in use at once
+    nConcurrent : int
+        configurations processed at once
+    manifestPath : string
+        sqlite manifest, reuse it to resume a batch
+    logFile : string
+        failures are appended here
+    retryFailed : bool
+        rerun configurations that failed in an earlier run
+    bundleCache : bool
+        use the on disk guide bundle cache (see confSumm.useBundleCache)
+    resultStore : string or None
+        if given write results to a ResultStore at this root directory
+        instead of csvs (see confSumm.useResultStore)
+    configKwargs : dict
+        extra Configuration arguments
+    siteMJDs : list of (str, int) or None
+        if given the guide frame indexes and exposure catalogs of these
+        nights are refreshed (see refreshIndexes) before any configuration
+        starts, eg from siteMJDsFromScrape
+
+    Returns
+    ---------
+    pandas.DataFrame
+        manifest rows for configIDs
+    """
+    nConcurrent = max(min(nConcurrent, cpuBudget), 1)
+    bundleWorkers = max((cpuBudget - nConcurrent) // nConcurrent, 1)
+    manifest = BatchManifest(manifestPath)
+    todo = manifest.todo(configIDs, retryFailed=retryFailed)
+    print("batch: %i of %i configurations to run, %i at a time with %i bundle workers each"%(
+        len(todo), len(configIDs), nConcurrent, bundleWorkers
+    ))
+    if siteMJDs is not None and len(todo) > 0:
+        refreshIndexes(siteMJDs, nProcs=cpuBudget)
+
+    def finish(result):
+        manifest.markFinished(result["configID"], result["status"], result["elapsed"], result["error"])
+        if result["status"] == "failed":
+            _logFailure(logFile, result["configID"], result["error"])
+            print("batch: configID %i failed"%result["configID"])
+        else:
+            print("batch: configID %i done in %.0f s"%(result["configID"], result["elapsed"]))
+
+    todo = list(reversed(todo)) # pop from the end, in configID order
+    executor = ProcessPoolExecutor(max_workers=nConcurrent)
+    running = {} # future: (configID, start time)
+    while len(todo) > 0 or len(running) > 0:
+        while len(todo) > 0 and len(running) < nConcurrent:
+            configID = todo.pop()
+            manifest.markStarted(configID)
+            future = executor.submit(
+                processConfig, configID, bundleWorkers, bundleCache, resultStore, configKwargs
+            )
+            running[future] = (configID, time.time())
+
+        done, notDone = wait(running, return_when=FIRST_COMPLETED)
+        broken = False
+        for future in done:
+            configID, tstart = running.pop(future)
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                # a worker died (eg out of memory), we can't tell which
+                # configuration killed it so every running one is failed
+                broken = True
+                result = {
+                    "configID": configID, "status": "failed",
+                    "elapsed": time.time() - tstart, "error": traceback.format_exc()
+                }
+            finish(result)
+        if broken:
+            for future in list(running.keys()):
+                configID, tstart = running.pop(future)
+                finish({
+                    "configID": configID, "status": "failed",
+                    "elapsed": time.time() - tstart,
+                    "error": "worker pool broken while running\n"
+                })
+            executor.shutdown(wait=False, cancel_futures=True)
+            executor = ProcessPoolExecutor(max_workers=nConcurrent)
+    executor.shutdown()
+
+    df = manifest.status(configIDs)
+    print("batch:", df.status.value_counts().to_dict())
+    return df
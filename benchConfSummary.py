@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import tempfile
+import numpy
+import pandas
+
+from confSumm import parseConfSummary
+
+
+CONF_HEADER = """# Configuration summary (synthetic, for benchConfSummary.py)
+
+configuration_id {configid}
+targeting_version 1
+robostrategy_run eta-6
+fps_calibrations_version 2022.09
+jaeger_version 1.1.0
+coordio_version 1.4.0
+kaiju_version 1.3.0
+design_id {designid}
+field_id {fieldid}
+instruments BOSS APOGEE
+epoch 2459823.80000
+obstime Thu Sep  1 07:12:01 2022
+MJD 59823
+observatory APO
+temperature 10.2
+raCen 281.73000000
+decCen 36.77000000
+pa 12.3400
+is_dithered 0
+parent_configuration {configid}
+dither_radius 0.5
+cherno_offset 0.0 0.0 0.0
+design_mode bright_time
+focal_scale 0.99992
+fvc_image_path /data/fcam/59823/proc-fimg-fvc1n-0012.fits
+
+typedef struct {{
+    int positionerId;
+    char holeId[10];
+    char fiberType[10];
+    int assigned;
+    int on_target;
+    int disabled;
+    int valid;
+    int decollided;
+    int too;
+    long too_id;
+    char too_program[20];
+    double xwok;
+    double ywok;
+    double zwok;
+    double xFocal;
+    double yFocal;
+    double alpha;
+    double beta;
+    double racat;
+    double deccat;
+    float pmra;
+    float pmdec;
+    float parallax;
+    double ra;
+    double dec;
+    double ra_observed;
+    double dec_observed;
+    double alt_observed;
+    double az_observed;
+    double lambda_design;
+    double lambda_eff;
+    double coord_epoch;
+    int spectrographId;
+    int fiberId;
+    float mag[5];
+    char optical_prov[30];
+    float bp_mag;
+    float gaia_g_mag;
+    float rp_mag;
+    float h_mag;
+    long catalogid;
+    long carton_to_target_pk;
+    int cadence;
+    char firstcarton[100];
+    char program[20];
+    char category[20];
+    double delta_ra;
+    double delta_dec;
+}} FIBERMAP;
+
+"""
+
+FIBER_TYPES = ["APOGEE", "BOSS", "METROLOGY"]
+CARTONS = ["mwm_galactic_core", "bhm_aqmes_med", "ops_sky_boss", "ops_sky_apogee_best",
+    "mwm_cb_uvex1", "ops_std_eboss", "manual_nsbh_apogee"]
+
+
+def synthConfSummary(path, rng, nPositioners=500, configid=5951):
+    """ write a confSummary-like file with one row per fiber (three per
+    positioner), about the size of the real ones
+    """
+    lines = [CONF_HEADER.format(configid=configid, designid=configid + 10000, fieldid=configid // 2)]
+    for pid in range(nPositioners):
+        for fiberType in FIBER_TYPES:
+            assigned = int(rng.uniform() < 0.6)
+            carton = rng.choice(CARTONS) if assigned else ""
+            category = "science" if "sky" not in carton else "sky_boss"
+            vals = [
+                "%i"%pid, "R%i" % (pid % 30) + "C%i"%(pid // 30), fiberType,
+                "%i"%assigned, "%i"%assigned, "0", "1", "0", "0", "-1", '""',
+            ]
+            vals += ["%.6f"%v for v in rng.normal(scale=200, size=5)]
+            vals += ["%.4f"%v for v in rng.uniform(0, 360, 2)]
+            vals += ["%.8f"%v for v in rng.uniform(-90, 90, 2)]
+            vals += ["%.4f"%v for v in rng.normal(size=3)]
+            vals += ["%.8f"%v for v in rng.uniform(0, 360, 6)]
+            vals += ["%.1f"%(16000 if fiberType == "APOGEE" else 5400)]
+            vals += ["%.1f"%(16000 if fiberType == "APOGEE" else 5400)]
+            vals += ["2015.5" if rng.uniform() < 0.9 else "2000.0"]
+            vals += ["%i"%rng.integers(1, 3), "%i"%rng.integers(1, 301) if assigned else "-999"]
+            vals += ["{ %s }"%" ".join("%.3f"%v for v in rng.uniform(10, 20, 5))]
+            vals += ['"%s"'%("gaia_g" if assigned else ""), "17.1", "16.8", "16.2", "-999.0"]
+            vals += ["%i"%rng.integers(1, 2**40), "%i"%rng.integers(1, 2**30), "%i"%rng.integers(0, 200)]
+            vals += ['"%s"'%carton, '"%s"'%("mwm_rv" if assigned else ""), '"%s"'%category]
+            vals += ["0.0", "0.0"]
+            lines.append("FIBERMAP " + " ".join(vals))
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def benchConfSummary(files=None, nTrials=3, seed=0):
+    """ time parseConfSummary with fastYanny against pydl's yanny and
+    check the DataFrames are identical.  files None benchmarks synthetic
+    real sized files.
+    """
+    if files is None:
+        rng = numpy.random.default_rng(seed)
+        tmpDir = tempfile.mkdtemp(prefix="benchConfSummary")
+        files = []
+        for ii, configid in enumerate([5951, 5952, 5953]):
+            path = os.path.join(tmpDir, "confSummary-%i.par"%configid)
+            synthConfSummary(path, rng, configid=configid)
+            files.append(path)
+
+    rows = []
+    for path in files:
+        for trial in range(nTrials):
+            tstart = time.time()
+            dfYanny = parseConfSummary(path, fast=False)
+            tYanny = time.time() - tstart
+
+            tstart = time.time()
+            dfFast = parseConfSummary(path, fast=True)
+            tFast = time.time() - tstart
+
+            pandas.testing.assert_frame_equal(dfYanny, dfFast)
+            rows.append({
+                "filename": path, "nRows": len(dfFast), "trial": trial,
+                "tYanny": tYanny, "tFast": tFast,
+            })
+
+    df = pandas.DataFrame(rows)
+    summ = df.groupby("filename")[["nRows", "tYanny", "tFast"]].median()
+    summ["speedup"] = summ.tYanny / summ.tFast
+    print(summ)
+    return df
+
+
+if __name__ == "__main__":
+    # python benchConfSummary.py [confSummary files...]
+    files = sys.argv[1:] if len(sys.argv) > 1 else None
+    df = benchConfSummary(files)
+    df.to_csv("benchConfSummary.csv", index=False)
@@ -0,0 +1,351 @@
+import os
+import sys
+import time
+import json
+import platform
+import tempfile
+import numpy
+import pandas
+from astropy.io import fits
+from astropy.time import Time
+from astropy import units as u
+from coordio.utils import radec2wokxy, wokxy2radec
+from coordio.conv import wokToTangent, tangentToGuide
+from coordio.defaults import PLATE_SCALE, POSITIONER_HEIGHT
+
+import procGimg
+from procGimg import (
+    ProcGimg, GuideBundle, getGFACoords, getCentroids, getShift2, getShiftVote,
+    useFieldGaiaCache, fieldQueryRadius, GAIA_EPOCH
+)
+from gaiaCache import GAIA_COLUMNS
+
+
+BENCH_MJD = 59900
+BENCH_CONFIGID = 1
+BENCH_DESIGNID = 1
+PIXEL_SIZE = 0.0135  # mm, GFA pixels
+SITE_LONLAT = {"APO": (-105.8203, 32.7803), "LCO": (-70.6926, -29.0146)}
+
+# stage medians more than this factor slower than the baseline are flagged
+REGRESSION_FACTOR = 1.5
+
+
+def pixelScale(site):
+    # arcsec per GFA pixel
+    return PIXEL_SIZE / PLATE_SCALE[site.upper()] * 3600
+
+
+def synthGaia(site, raCen, decCen, starsPerChip, rng, radius=None, magRange=(10, 18)):
+    """ fake gaia cone around the field center with about starsPerChip
+    sources (brighter than magRange[1]) landing on each GFA.  Magnitudes
+    follow N(<m) ~ 10**(0.35 m), proper motions are a few mas/yr.
+    """
+    if radius is None:
+        radius = fieldQueryRadius(site)
+    chipArea = (2048 * pixelScale(site) / 3600)**2
+    coneArea = 2 * numpy.pi * (1 - numpy.cos(numpy.radians(radius))) * (180 / numpy.pi)**2
+    nStars = int(starsPerChip * coneArea / chipArea)
+
+    # uniform on the sphere within the cone, about the pole then rotated
+    cosR = rng.uniform(numpy.cos(numpy.radians(radius)), 1, nStars)
+    theta = numpy.degrees(numpy.arccos(cosR))
+    phi = rng.uniform(0, 2 * numpy.pi, nStars)
+    dRA = theta * numpy.sin(phi) / numpy.cos(numpy.radians(decCen))
+    dDec = theta * numpy.cos(phi)
+
+    a = 0.35 * numpy.log(10)
+    lo, hi = numpy.exp(a * numpy.array(magRange))
+    mag = numpy.log(rng.uniform(lo, hi, nStars)) / a
+
+    df = pandas.DataFrame({
+        "source_id": numpy.arange(nStars, dtype=numpy.int64),
+        "ra": (raCen + dRA) % 360,
+        "dec": decCen + dDec,
+        "pmra": rng.normal(scale=5, size=nStars),
+        "pmdec": rng.normal(scale=5, size=nStars),
+        "parallax": numpy.abs(rng.normal(scale=0.5, size=nStars)),
+        "phot_g_mean_mag": mag,
+    })
+    return df[list(GAIA_COLUMNS.keys())]
+
+
+def gaiaToCCD(gaia, site, gfaRow, raField, decField, paField, dateObsJD):
+    """ same projection as ProcGimg._getGuideStars, returns gaia rows
+    landing on the chip with xCCD, yCCD columns
+    """
+    b = gfaRow[["xWok", "yWok", "zWok"]].to_numpy().squeeze()
+    iHat = gfaRow[["ix", "iy", "iz"]].to_numpy().squeeze()
+    jHat = gfaRow[["jx", "jy", "jz"]].to_numpy().squeeze()
+    kHat = gfaRow[["kx", "ky", "kz"]].to_numpy().squeeze()
+
+    xWok, yWok, fieldWarn, HA, PA = radec2wokxy(
+        gaia.ra.to_numpy(), gaia.dec.to_numpy(), GAIA_EPOCH, "GFA",
+        raField, decField, paField, site.upper(), dateObsJD,
+        pmra=gaia.pmra.to_numpy(), pmdec=gaia.pmdec.to_numpy()
+    )
+    zWok = numpy.array([POSITIONER_HEIGHT] * len(xWok))
+    xT, yT, zT = wokToTangent(xWok, yWok, zWok, b, iHat, jHat, kHat)
+    xCCD, yCCD = tangentToGuide(xT, yT)
+    stars = gaia.copy()
+    stars["xCCD"] = xCCD
+    stars["yCCD"] = yCCD
+    keep = (stars.xCCD > 1) & (stars.xCCD < 2047) & (stars.yCCD > 1) & (stars.yCCD < 2047)
+    return stars[keep].dropna().reset_index(drop=True)
+
+
+def renderChip(stars, rng, sigma=3.8, sky=1000, noise=15, peak15=600):
+    """ 2048x2048 float32 image of gaussian stars on a noisy sky, peak
+    counts scale with g mag (peak15 at g = 15)
+    """
+    img = rng.normal(sky, noise, size=(2048, 2048))
+    halfWidth = int(numpy.ceil(5 * sigma))
+    peaks = peak15 * 10**(-0.4 * (stars.phot_g_mean_mag.to_numpy() - 15))
+    for x, y, amp in zip(stars.xCCD.to_numpy(), stars.yCCD.to_numpy(), peaks):
+        ix, iy = int(round(x)), int(round(y))
+        x0, x1 = max(ix - halfWidth, 0), min(ix + halfWidth + 1, 2048)
+        y0, y1 = max(iy - halfWidth, 0), min(iy + halfWidth + 1, 2048)
+        yy, xx = numpy.mgrid[y0:y1, x0:x1]
+        img[y0:y1, x0:x1] += amp * numpy.exp(
+            -((xx - x)**2 + (yy - y)**2) / (2 * sigma**2)
+        )
+    return numpy.clip(img, 0, 65535).astype(numpy.float32)
+
+
+def chipHeader(site, gfaRow, raField, decField, paField, dateObs, exptime=15):
+    """ extension 1 header with the keywords ProcGimg, ProcGimgLite and
+    gimgIndex read, plus a TAN wcs centered on the chip
+    """
+    b = gfaRow[["xWok", "yWok"]].to_numpy().squeeze()
+    raChip, decChip, warn = wokxy2radec(
+        numpy.array([b[0]]), numpy.array([b[1]]), "GFA", raField, decField,
+        paField, site.upper(), dateObs.jd
+    )
+    scale = pixelScale(site)
+    header = fits.Header()
+    header["CTYPE1"] = "RA---TAN"
+    header["CTYPE2"] = "DEC--TAN"
+    header["CRPIX1"] = 1024.5
+    header["CRPIX2"] = 1024.5
+    header["CRVAL1"] = float(raChip[0])
+    header["CRVAL2"] = float(decChip[0])
+    header["CD1_1"] = -scale / 3600
+    header["CD1_2"] = 0.0
+    header["CD2_1"] = 0.0
+    header["CD2_2"] = scale / 3600
+    header["PIXELSC"] = scale
+    header["SOLVED"] = True
+    header["SOLVMODE"] = "astrometry.net"
+    header["RAFIELD"] = raField
+    header["DECFIELD"] = decField
+    header["FIELDPA"] = paField
+    header["AOFFRA"] = 0.0
+    header["AOFFDEC"] = 0.0
+    header["AOFFPA"] = 0.0
+    header["DATE-OBS"] = dateObs.iso
+    header["EXPTIME"] = exptime
+    header["CONFIGID"] = BENCH_CONFIGID
+    header["DESIGNID"] = BENCH_DESIGNID
+    header["M2PISTON"] = 0.0
+    header["RMS"] = 0.5
+    return header
+
+
+def synthGuideFrame(
+    gimgBase, site, imgNum, gaia, raField, decField, paField, dateObs, rng,
+    pointingErr=(3., 3., 20.)
+):
+    """ write the six proc-gimg files of one synthetic guide frame under
+    gimgBase/<site>/<mjd>/.  Stars are rendered at a pointing off from
+    the header values by up to pointingErr (ra, dec, pa arcsec) so the
+    matching and pointing fits have something to do.
+
+    Returns
+    ---------
+    chipFiles : dict
+        gfaNum: path
+    """
+    gfaCoords = getGFACoords(site)
+    err = rng.uniform(-1, 1, 3) * numpy.array(pointingErr) / 3600
+    raTrue = raField + err[0] / numpy.cos(numpy.radians(decField))
+    decTrue = decField + err[1]
+    paTrue = paField + err[2]
+
+    outDir = os.path.join(gimgBase, site.lower(), str(BENCH_MJD))
+    os.makedirs(outDir, exist_ok=True)
+    chipFiles = {}
+    for gfaNum in range(1, 7):
+        gfaRow = gfaCoords[gfaCoords.id == gfaNum]
+        stars = gaiaToCCD(gaia, site, gfaRow, raTrue, decTrue, paTrue, dateObs.jd)
+        img = renderChip(stars, rng)
+        cents = getCentroids(img)
+
+        header = chipHeader(site, gfaRow, raField, decField, paField, dateObs)
+        ff = fits.HDUList([
+            fits.PrimaryHDU(),
+            fits.ImageHDU(img, header=header),
+            fits.BinTableHDU.from_columns(cents.to_records(index=False), name="CENTROIDS"),
+        ])
+        ns = "n" if site.lower() == "apo" else "s"
+        path = os.path.join(outDir, "proc-gimg-gfa%i%s-%s.fits"%(gfaNum, ns, str(imgNum).zfill(4)))
+        ff.writeto(path, overwrite=True)
+        chipFiles[gfaNum] = path
+    return chipFiles
+
+
+def fieldCenter(site, dateObs):
+    """ an ra/dec near zenith at dateObs
+    """
+    lon, lat = SITE_LONLAT[site.upper()]
+    lst = dateObs.sidereal_time("mean", longitude=lon * u.deg).degree
+    return lst, lat
+
+
+def _time(f, *args, **kwargs):
+    tstart = time.time()
+    out = f(*args, **kwargs)
+    return time.time() - tstart, out
+
+
+def benchChip(pg):
+    """ time the ProcGimg stages on an already constructed chip, returns
+    dict of stage: seconds
+    """
+    out = {}
+    procGimg.GUIDE_STAR_CAT.clear()
+    out["getGuideStars"], _ = _time(pg._getGuideStars)
+    out["extract"], _ = _time(pg._extract)
+    out["extractROI"], _ = _time(pg._extractROI)
+    xyDetect = pg.centroids[["xCCD", "yCCD"]].to_numpy()
+    xyGaia = pg.guideStars[["xCCD", "yCCD"]].to_numpy()
+    out["getShift2"], _ = _time(getShift2, xyGaia, xyDetect)
+    out["getShiftVote"], _ = _time(getShiftVote, xyGaia, xyDetect)
+    out["matchGuideStars"], _ = _time(pg._matchGuideStars, shiftMethod="xcorr")
+    out["matchGuideStarsVote"], _ = _time(pg._matchGuideStars, shiftMethod="vote")
+    out["fit"], _ = _time(pg._fit)
+    return out
+
+
+def benchPipeline(
+    site="apo", starDensities=(5, 20, 50, 150), nFrames=3, seed=0, workDir=None
+):
+    """ generate nFrames synthetic guide frames per star density (stars per
+    chip) and time each pipeline stage on them.  Gaia is served from a
+    FieldGaiaCache of the synthetic catalog, nothing touches the data
+    tree or the database.
+
+    Returns
+    ---------
+    df : pandas.DataFrame
+        one row per stage/density/frame(/chip) with columns stage,
+        nStars, imgNum, gfaNum, seconds, nDetect, nGuide, nMatch
+    """
+    rng = numpy.random.default_rng(seed)
+    if workDir is None:
+        workDir = tempfile.mkdtemp(prefix="benchPipeline")
+    gimgBase = os.path.join(workDir, "gcam") + "/"
+    savedBase = procGimg.GIMG_BASE
+    savedFieldCache = procGimg.FIELD_GAIA_CACHE
+    procGimg.GIMG_BASE = gimgBase
+    fieldCache = useFieldGaiaCache(os.path.join(workDir, "fields"))
+
+    dateObs0 = Time(BENCH_MJD + 0.2, format="mjd", scale="tai")
+    raField, decField = fieldCenter(site, dateObs0)
+    paField = 30.
+    radius = fieldQueryRadius(site)
+
+    rows = []
+    imgNum = 0
+    try:
+        for nStars in starDensities:
+            gaia = synthGaia(site, raField, decField, nStars, rng, radius)
+            fieldCache.put(BENCH_CONFIGID, gaia, raField, decField, radius, 18)
+
+            for frame in range(nFrames):
+                imgNum += 1
+                dateObs = dateObs0 + frame * 20 * u.s
+                synthGuideFrame(
+                    gimgBase, site, imgNum, gaia, raField, decField, paField,
+                    dateObs, rng
+                )
+
+                procGimg.GUIDE_STAR_CAT.clear()
+                tBundle, gb = _time(GuideBundle, site, BENCH_MJD, imgNum)
+                rows.append(dict(stage="guideBundle", nStars=nStars, imgNum=imgNum,
+                    gfaNum=0, seconds=tBundle, nMatch=len(gb.matches)))
+                for method in ["lsq", "powell"]:
+                    t, _ = _time(gb.fitPointing, method=method)
+                    rows.append(dict(stage="fitPointing_%s"%method, nStars=nStars,
+                        imgNum=imgNum, gfaNum=0, seconds=t, nMatch=len(gb.matches)))
+
+                for gfaNum, pg in gb.gfaDict.items():
+                    procGimg.GUIDE_STAR_CAT.clear()
+                    tChip, pg = _time(ProcGimg, pg.filename, site, gfaNum)
+                    stages = benchChip(pg)
+                    stages["procGimg"] = tChip
+                    for stage, t in stages.items():
+                        rows.append(dict(stage=stage, nStars=nStars, imgNum=imgNum,
+                            gfaNum=gfaNum, seconds=t, nDetect=pg.nDetect,
+                            nGuide=pg.nGuide, nMatch=pg.nMatch))
+                    pg.ff.close()
+    finally:
+        procGimg.GIMG_BASE = savedBase
+        procGimg.FIELD_GAIA_CACHE = savedFieldCache
+        procGimg.GUIDE_STAR_CAT.clear()
+
+    return pandas.DataFrame(rows)
+
+
+def summarize(df):
+    """ median seconds and frames (chips, or bundles for bundle level
+    stages) per second for each stage and density
+    """
+    summ = df.groupby(["stage", "nStars"]).seconds.median().reset_index()
+    summ["fps"] = 1 / summ.seconds
+    return summ
+
+
+def saveBaseline(summ, path):
+    baseline = {
+        "created": Time.now().isot,
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "stages": summ.to_dict("records"),
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=1)
+
+
+def compareBaseline(summ, path, factor=REGRESSION_FACTOR):
+    """ join a fresh summary to a saved baseline, rows with ratio > factor
+    (current seconds / baseline seconds) are flagged as regressions
+    """
+    with open(path) as f:
+        baseline = pandas.DataFrame(json.load(f)["stages"])
+    comp = summ.merge(
+        baseline[["stage", "nStars", "seconds"]], on=["stage", "nStars"],
+        suffixes=("", "_baseline")
+    )
+    comp["ratio"] = comp.seconds / comp.seconds_baseline
+    comp["regression"] = comp.ratio > factor
+    return comp
+
+
+if __name__ == "__main__":
+    # python benchPipeline.py [baseline.json]
+    # writes the baseline if it doesn't exist, else compares against it
+    baselinePath = sys.argv[1] if len(sys.argv) > 1 else "benchPipeline_baseline.json"
+    df = benchPipeline()
+    df.to_csv("benchPipeline.csv", index=False)
+    summ = summarize(df)
+    print(summ)
+    if os.path.exists(baselinePath):
+        comp = compareBaseline(summ, baselinePath)
+        print(comp)
+        if comp.regression.any():
+            print("regressions:")
+            print(comp[comp.regression])
+            sys.exit(1)
+    else:
+        saveBaseline(summ, baselinePath)
@@ -0,0 +1,62 @@
+import time
+import numpy
+import pandas
+
+from procGimg import getShift2, getShiftVote
+
+
+def synthField(nStars, rng, maxShift=60, noise=0.7, fracDetect=0.8, nSpurious=5):
+    """ make a synthetic gaia/detection pair of point lists on a 2048x2048
+    chip.  Detections are a random subset of the gaia sources, moved by a
+    bulk shift plus centroid noise, with some spurious detections mixed in.
+
+    Returns
+    --------
+    xyGaia, xyDetect : numpy.ndarray
+    trueShift : numpy.ndarray
+        shift to add to detections to land on gaia
+    """
+    xyGaia = rng.uniform(1, 2047, size=(nStars, 2))
+    trueShift = rng.uniform(-maxShift, maxShift, size=2)
+    detected = rng.uniform(size=nStars) < fracDetect
+    xyDetect = xyGaia[detected] - trueShift + rng.normal(scale=noise, size=(numpy.sum(detected), 2))
+    xyDetect = numpy.vstack([xyDetect, rng.uniform(1, 2047, size=(nSpurious, 2))])
+    onChip = numpy.all((xyDetect > 1) & (xyDetect < 2047), axis=1)
+    return xyGaia, xyDetect[onChip], trueShift
+
+
+def benchShift(starDensities=(5, 20, 50, 150), nTrials=20, seed=0):
+    rng = numpy.random.default_rng(seed)
+    rows = []
+    for nStars in starDensities:
+        for trial in range(nTrials):
+            xyGaia, xyDetect, trueShift = synthField(nStars, rng)
+
+            tstart = time.time()
+            dx2, dy2 = getShift2(xyGaia, xyDetect)
+            t2 = time.time() - tstart
+
+            tstart = time.time()
+            dxV, dyV = getShiftVote(xyGaia, xyDetect)
+            tV = time.time() - tstart
+
+            rows.append({
+                "nStars": nStars,
+                "trial": trial,
+                "tXcorr": t2,
+                "tVote": tV,
+                "errXcorr": numpy.hypot(dx2 - trueShift[0], dy2 - trueShift[1]),
+                "errVote": numpy.hypot(dxV - trueShift[0], dyV - trueShift[1]),
+                "dAgree": numpy.hypot(dx2 - dxV, dy2 - dyV),
+            })
+
+    df = pandas.DataFrame(rows)
+    summ = df.groupby("nStars").median()
+    summ["speedup"] = summ.tXcorr / summ.tVote
+    print(summ[["tXcorr", "tVote", "speedup", "errXcorr", "errVote", "dAgree"]])
+    return df
+
+
+if __name__ == "__main__":
+    df = benchShift()
+    df.to_csv("benchShift.csv", index=False)
@@ -0,0 +1,62 @@
+import time
+import numpy
+import pandas
+from astropy.time import Time
+
+from confSumm import starWokXY, starWokXYRows
+
+
+def synthConfMeas(nFibers, rng, raCen=180., decCen=32., radius=1.4, epochs=(2015.5, 2000.0)):
+    """ fake confMeas rows (racat, deccat, pmra, pmdec, coord_epoch_jd,
+    fiberType) spread over the field, mostly at the first epoch
+    """
+    r = radius * numpy.sqrt(rng.uniform(size=nFibers))
+    theta = rng.uniform(0, 2 * numpy.pi, nFibers)
+    p = numpy.array([0.9] + [0.1 / (len(epochs) - 1)] * (len(epochs) - 1))
+    epoch = rng.choice(epochs, size=nFibers, p=p)
+    return pandas.DataFrame({
+        "racat": raCen + r * numpy.cos(theta) / numpy.cos(numpy.radians(decCen)),
+        "deccat": decCen + r * numpy.sin(theta),
+        "pmra": rng.normal(scale=10, size=nFibers),
+        "pmdec": rng.normal(scale=10, size=nFibers),
+        "coord_epoch_jd": Time(epoch, format="jyear").jd,
+        "fiberType": rng.choice(["BOSS", "APOGEE"], size=nFibers),
+    })
+
+
+def benchStarWok(nFibers=(100, 500), nTrials=3, seed=0, site="apo"):
+    """ check starWokXY against the row-wise reference and time both
+    """
+    rng = numpy.random.default_rng(seed)
+    dateObsJD = Time(59900.2, format="mjd", scale="tai").jd
+    rows = []
+    for n in nFibers:
+        for trial in range(nTrials):
+            confMeas = synthConfMeas(n, rng)
+            args = ("boss", 180., 32., 30., site, dateObsJD, 1.0001)
+
+            tstart = time.time()
+            xRow, yRow = starWokXYRows(confMeas, *args)
+            tRows = time.time() - tstart
+
+            tstart = time.time()
+            xVec, yVec = starWokXY(confMeas, *args)
+            tVec = time.time() - tstart
+
+            maxDiff = numpy.max(numpy.hypot(xRow - xVec, yRow - yVec))
+            assert maxDiff < 1e-9, "starWokXY differs from row-wise by %e mm"%maxDiff
+            rows.append({
+                "nFibers": n, "trial": trial, "tRows": tRows, "tVec": tVec,
+                "maxDiff": maxDiff,
+            })
+
+    df = pandas.DataFrame(rows)
+    summ = df.groupby("nFibers").median()
+    summ["speedup"] = summ.tRows / summ.tVec
+    print(summ[["tRows", "tVec", "speedup", "maxDiff"]])
+    return df
+
+
+if __name__ == "__main__":
+    df = benchStarWok()
+    df.to_csv("benchStarWok.csv", index=False)
@@ -0,0 +1,125 @@
+import os
+import glob
+import json
+import pickle
+import hashlib
+import numpy
+import pandas
+
+
+BUNDLE_CACHE_DIR = "/uufs/chpc.utah.edu/common/home/u0449727/work/bundleCache"
+BUNDLE_CACHE_MAX_BYTES = 20 * 1024**3
+
+# bump whenever procGimg/GuideBundle/processGuideBundle output changes,
+# entries written by other versions are never read again (and age out)
+PIPELINE_VERSION = "1"
+
+
+def hashGFACoords(gfaCoords):
+    """ short digest of a gfaCoords table (row order and values)
+    """
+    h = pandas.util.hash_pandas_object(gfaCoords, index=False).to_numpy()
+    return hashlib.sha1(h.tobytes()).hexdigest()[:16]
+
+
+def inputStats(chipFiles):
+    """ (basename, size, mtime) of the proc-gimg files of a guide frame,
+    so that reprocessed or added chips change the cache key
+    """
+    stats = []
+    for gfaNum in sorted(chipFiles.keys()):
+        st = os.stat(chipFiles[gfaNum])
+        stats.append((os.path.basename(chipFiles[gfaNum]), st.st_size, st.st_mtime))
+    return stats
+
+
+class BundleCache(object):
+    def __init__(self, cacheDir=BUNDLE_CACHE_DIR, maxBytes=BUNDLE_CACHE_MAX_BYTES):
+        """
+        Content addressed on disk cache of processed guide bundles (the
+        processGuideBundle matches table plus fitted pointing and wok offset
+        parameters).  The key hashes site, mjd, imgNum, fitPointing, the
+        gfaCoords, PIPELINE_VERSION and the size/mtime of the input chip
+        files, so a change to any of them is a miss.  Files are evicted
+        least recently used once the cache exceeds maxBytes.
+
+        Parameters
+        ------------------
+        cacheDir : string
+            directory holding <site>-<mjd>-<imgNum>-<key>.pkl files
+        maxBytes : int
+            max total size of the cache on disk
+        """
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+
+    def key(self, site, mjd, imgNum, fitPointing, gfaHash, chipStats):
+        keyStr = json.dumps([
+            site.lower(), int(mjd), int(imgNum), bool(fitPointing), gfaHash,
+            PIPELINE_VERSION, chipStats
+        ])
+        return hashlib.sha1(keyStr.encode()).hexdigest()
+
+    def path(self, site, mjd, imgNum, key):
+        return os.path.join(
+            self.cacheDir, "%s-%i-%i-%s.pkl"%(site.lower(), mjd, imgNum, key)
+        )
+
+    def get(self, site, mjd, imgNum, key):
+        """ returns dict with matches and params or None on a miss
+        """
+        path = self.path(site, mjd, imgNum, key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            return None
+        return entry
+
+    def put(self, site, mjd, imgNum, key, matches, params):
+        os.makedirs(self.cacheDir, exist_ok=True)
+        path = self.path(site, mjd, imgNum, key)
+        tmpPath = path + ".tmp%i"%os.getpid()
+        with open(tmpPath, "wb") as f:
+            pickle.dump({"matches": matches, "params": params}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpPath, path)
+        self._evict()
+
+    def invalidate(self, site=None, mjd=None, imgNum=None):
+        """ remove cached bundles, optionally only for a site/mjd/imgNum.
+        Returns the number of files removed.
+        """
+        pattern = "%s-%s-%s-*.pkl"%(
+            "*" if site is None else site.lower(),
+            "*" if mjd is None else "%i"%mjd,
+            "*" if imgNum is None else "%i"%imgNum,
+        )
+        files = glob.glob(os.path.join(self.cacheDir, pattern))
+        for f in files:
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+        return len(files)
+
+    def _evict(self):
+        files = glob.glob(os.path.join(self.cacheDir, "*.pkl"))
+        sizes = []
+        mtimes = []
+        for f in files:
+            try:
+                st = os.stat(f)
+            except FileNotFoundError:
+                st = None
+            sizes.append(0 if st is None else st.st_size)
+            mtimes.append(numpy.inf if st is None else st.st_mtime)
+        total = numpy.sum(sizes)
+        for ii in numpy.argsort(mtimes):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(files[ii])
+            except FileNotFoundError:
+                pass
+            total -= sizes[ii]
@@ -1,7 +1,6 @@
 from numpy.lib.recfunctions import drop_fields
 import pandas
 from datetime import datetime
-from pydl.pydlutils.yanny import yanny
 import os
 import glob
 from astropy.io import fits
@@ -13,13 +12,70 @@ import matplotlib.pyplot as plt
 import time
 from multiprocessing import Pool
 from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import traceback
 
-from procGimg import GuideBundle
+from procGimg import GuideBundle, prefetchFieldGaia, fitPointingJoint, getChipFiles, getGFACoords
+from gimgIndex import GimgIndex
+from expCatalog import ExpCatalog
+from fastYanny import readYanny
 
 CONFIG_BASE_PATH = "/uufs/chpc.utah.edu/common/home/sdss50/software/git/sdss/sdsscore/main"
 DATA_BASE_PATH = "/uufs/chpc.utah.edu/common/home/sdss50/sdsswork/data"
 
+# set with useBundleCache to reuse processed guide bundles across runs
+BUNDLE_CACHE = None
+_GFA_HASH = {} # site: gfaCoords digest
+
+
+# set with useResultStore to write results to a partitioned parquet
+# dataset instead of gfa_*.csv and dither_*.csv in the working directory
+RESULT_STORE = None
+
+
+def useResultStore(rootDir=None):
+    """ write SciExp/Configuration results to a resultStore.ResultStore.
+    None uses resultStore.RESULT_STORE_DIR.  Returns the store.
+    """
+    import resultStore
+    global RESULT_STORE
+    if rootDir is None:
+        rootDir = resultStore.RESULT_STORE_DIR
+    RESULT_STORE = resultStore.ResultStore(rootDir)
+    return RESULT_STORE
+
+
+def useBundleCache(cacheDir=None, maxBytes=None):
+    """ cache processGuideBundle output on disk (see bundleCache.py).
+    None uses the bundleCache defaults.  Returns the cache.
+    """
+    import bundleCache
+    global BUNDLE_CACHE
+    if cacheDir is None:
+        cacheDir = bundleCache.BUNDLE_CACHE_DIR
+    if maxBytes is None:
+        maxBytes = bundleCache.BUNDLE_CACHE_MAX_BYTES
+    BUNDLE_CACHE = bundleCache.BundleCache(cacheDir, maxBytes)
+    return BUNDLE_CACHE
+
+
+def _bundleCacheKey(imageNum, site, mjd, fitPointing):
+    import bundleCache
+    site = site.lower()
+    if site not in _GFA_HASH:
+        _GFA_HASH[site] = bundleCache.hashGFACoords(getGFACoords(site))
+    chipStats = bundleCache.inputStats(getChipFiles(site, mjd, imageNum))
+    return BUNDLE_CACHE.key(site, mjd, imageNum, fitPointing, _GFA_HASH[site], chipStats)
+
+
 def processGuideBundle(imageNum, site, mjd, fitPointing):
+    if BUNDLE_CACHE is not None:
+        cacheKey = _bundleCacheKey(imageNum, site, mjd, fitPointing)
+        entry = BUNDLE_CACHE.get(site, mjd, imageNum, cacheKey)
+        if entry is not None:
+            return entry["matches"]
+
     gb = GuideBundle(site, mjd, imageNum, fitPointing)
 
     matches = gb.matches.copy()
@@ -28,11 +84,228 @@ def processGuideBundle(imageNum, site, mjd, fitPointing):
     matches["decFit"] = gb.decCenFit
     matches["paFit"] = gb.paFit
     matches["scaleFit"] = gb.scaleFit
+    # for joint pointing fits across frames
+    matches["dateObsJD"] = gb.refGFA.dateObs.jd
+    matches["raFieldInit"] = gb.refGFA.ff[1].header["RAFIELD"]
+    matches["decFieldInit"] = gb.refGFA.ff[1].header["DECFIELD"]
+    matches["paFieldInit"] = gb.refGFA.ff[1].header["FIELDPA"]
+
+    if BUNDLE_CACHE is not None:
+        params = {
+            "raCenFit": gb.raCenFit, "decCenFit": gb.decCenFit,
+            "paFit": gb.paFit, "scaleFit": gb.scaleFit,
+            "transx": gb.transx, "transy": gb.transy, "rot": gb.rot,
+            "scale": gb.scale, "rms": gb.rms, "fitrms": gb.fitrms,
+            "failedChips": list(gb.failedChips.keys()),
+        }
+        BUNDLE_CACHE.put(site, mjd, imageNum, cacheKey, matches, params)
 
     return matches
 
-def parseConfSummary(ff):
-    print("parsing sum file", ff)
+
+def matchesToBlocks(matches):
+    """ one guide frame's matches as plain numpy arrays, one 2D array per
+    dtype (like pandas' own blocks), for sending back from a worker
+    process.  These pickle as a few contiguous buffers and are stacked in
+    the parent by blocksToMatches without building a DataFrame per frame.
+    """
+    groups = OrderedDict()
+    for ii, dtype in enumerate(matches.dtypes):
+        groups.setdefault(dtype, []).append(ii)
+    blocks = []
+    for idx in groups.values():
+        blocks.append((list(matches.columns[idx]), matches.iloc[:, idx].to_numpy()))
+    return {
+        "columns": list(matches.columns),
+        "index": matches.index.to_numpy(),
+        "blocks": blocks,
+    }
+
+
+def blocksToMatches(frames):
+    """ stack matchesToBlocks output of many guide frames into one DataFrame
+    (same rows, columns and index as pandas.concat of the frames' matches)
+    """
+    frames = [f for f in frames if f is not None]
+    layout = [cols for cols, arr in frames[0]["blocks"]]
+    if any([cols for cols, arr in f["blocks"]] != layout for f in frames[1:]):
+        # columns or dtypes differ between frames, let pandas align them
+        return pandas.concat([blocksToMatches([f]) for f in frames])
+    data = {}
+    for ii, cols in enumerate(layout):
+        arr = numpy.concatenate([f["blocks"][ii][1] for f in frames])
+        for jj, col in enumerate(cols):
+            data[col] = arr[:, jj]
+    return pandas.DataFrame(
+        {col: data[col] for col in frames[0]["columns"]},
+        index=numpy.concatenate([f["index"] for f in frames]), copy=False
+    )
+
+
+def processGuideBundleBlocks(imageNum, site, mjd, fitPointing):
+    """ processGuideBundle for worker pools, returns matchesToBlocks output
+    """
+    return matchesToBlocks(processGuideBundle(imageNum, site, mjd, fitPointing))
+
+
+class BundleScheduler(object):
+    def __init__(self, maxWorkers=25, maxDone=5000):
+        """
+        One process pool for a whole run, shared by every SciExp and
+        Configuration handed this scheduler.  Workers live for the run, so
+        module imports and their in memory GUIDE_STAR_CAT are paid once.
+        Identical (site, mjd, imgNum, fitPointing) tasks are only run once,
+        eg the same guide frames requested by the red and blue runs of a
+        configuration.
+
+        Parameters
+        ------------
+        maxWorkers : int
+            size of the process pool
+        maxDone : int
+            completed results kept for deduplication, oldest are dropped
+        """
+        self.maxWorkers = maxWorkers
+        self.maxDone = maxDone
+        self.executor = ProcessPoolExecutor(max_workers=maxWorkers)
+        self.futures = OrderedDict() # task key: future
+        self.failed = {} # task key: traceback string
+
+    @staticmethod
+    def taskKey(site, mjd, imgNum, fitPointing):
+        return (site.lower(), int(mjd), int(imgNum), bool(fitPointing))
+
+    def submit(self, site, mjd, imgNum, fitPointing):
+        """ queue processGuideBundleBlocks for one guide frame (unless
+        already queued or done), returns the task key
+        """
+        key = self.taskKey(site, mjd, imgNum, fitPointing)
+        if key in self.futures:
+            self.futures.move_to_end(key)
+        else:
+            self.futures[key] = self.executor.submit(
+                processGuideBundleBlocks, key[2], key[0], key[1], key[3]
+            )
+            self._trim()
+        return key
+
+    def submitMany(self, site, mjd, imgNums, fitPointing):
+        return [self.submit(site, mjd, imgNum, fitPointing) for imgNum in imgNums]
+
+    def asCompleted(self, keys):
+        """ yield (key, blocks) for the unique keys as they finish, blocks
+        are matchesToBlocks output (see blocksToMatches).  Failed tasks
+        yield None (and the traceback is kept in self.failed)
+        """
+        keys = list(OrderedDict.fromkeys(keys))
+        futureKeys = {}
+        for key in keys:
+            if key not in self.futures:
+                # never submitted, or trimmed before it was collected
+                self.submit(*key)
+            futureKeys[self.futures[key]] = key
+        for future in as_completed(futureKeys):
+            key = futureKeys[future]
+            try:
+                yield key, future.result()
+            except Exception:
+                self.failed[key] = traceback.format_exc()
+                print("guide bundle failed", key)
+                print(self.failed[key])
+                yield key, None
+
+    def _trim(self):
+        # forget the oldest completed results beyond maxDone
+        done = [key for key, future in self.futures.items() if future.done()]
+        for key in done[:max(len(done) - self.maxDone, 0)]:
+            del self.futures[key]
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def intervalJoin(outerStart, outerEnd, innerStart, innerEnd):
+    """ for each outer interval find the inner intervals that lie entirely
+    within it (innerStart >= outerStart and innerEnd <= outerEnd), eg guide
+    frames inside science exposures.  Times are float arrays (eg JD).
+
+    Returns
+    ---------
+    list of numpy.ndarray
+        indices into the inner arrays (in increasing innerStart order), one
+        array per outer interval
+    """
+    innerStart = numpy.asarray(innerStart, dtype=float)
+    innerEnd = numpy.asarray(innerEnd, dtype=float)
+    order = numpy.argsort(innerStart, kind="stable")
+    sortedStart = innerStart[order]
+    sortedEnd = innerEnd[order]
+    lo = numpy.searchsorted(sortedStart, outerStart, side="left")
+    hi = numpy.searchsorted(sortedStart, outerEnd, side="right")
+    matched = []
+    for ii in range(len(lo)):
+        idx = numpy.arange(lo[ii], hi[ii])
+        matched.append(order[idx[sortedEnd[idx] <= outerEnd[ii]]])
+    return matched
+
+
+def starWokXYRows(confMeas, fiberType, raField, decField, paField, site, dateObsJD, focalScale):
+    """ reference (one radec2wokxy call per fiber) version of starWokXY
+    """
+    xWokStar = []
+    yWokStar = []
+    for ii, row in confMeas.iterrows():
+        xWok, yWok, fieldWarn, HA, PA = radec2wokxy(
+            [float(row.racat)], [float(row.deccat)], float(row.coord_epoch_jd), fiberType.capitalize(),
+            raField, decField, paField,
+            site.upper(), dateObsJD, focalScale=focalScale,
+            pmra=float(row.pmra), pmdec=float(row.pmdec)
+        )
+        xWokStar.append(xWok[0])
+        yWokStar.append(yWok[0])
+    return numpy.array(xWokStar), numpy.array(yWokStar)
+
+
+def starWokXY(confMeas, fiberType, raField, decField, paField, site, dateObsJD, focalScale):
+    """ expected wok xy of the targets in confMeas (racat, deccat, pmra,
+    pmdec, coord_epoch_jd) for a fitted pointing.  One radec2wokxy call
+    per coord_epoch_jd (and fiberType if fiberType is None, then taken
+    from the confMeas fiberType column).
+
+    Returns
+    ---------
+    xWokStar, yWokStar : numpy.ndarray
+        in confMeas row order
+    """
+    xWokStar = numpy.zeros(len(confMeas)) * numpy.nan
+    yWokStar = numpy.zeros(len(confMeas)) * numpy.nan
+    df = confMeas.reset_index(drop=True)
+    if fiberType is None:
+        groups = df.groupby(["coord_epoch_jd", "fiberType"], dropna=False).indices
+    else:
+        groups = df.groupby(["coord_epoch_jd"], dropna=False).indices
+    for key, idx in groups.items():
+        if fiberType is None:
+            _fiberType = key[1]
+        else:
+            _fiberType = fiberType
+        epoch = key[0] if isinstance(key, tuple) else key
+        _df = df.iloc[idx]
+        xWok, yWok, fieldWarn, HA, PA = radec2wokxy(
+            _df.racat.to_numpy(dtype=float), _df.deccat.to_numpy(dtype=float),
+            float(epoch), _fiberType.capitalize(),
+            raField, decField, paField,
+            site.upper(), dateObsJD, focalScale=focalScale,
+            pmra=_df.pmra.to_numpy(dtype=float), pmdec=_df.pmdec.to_numpy(dtype=float)
+        )
+        xWokStar[idx] = xWok
+        yWokStar[idx] = yWok
+    return xWokStar, yWokStar
+
+
+def _readConfSummaryYanny(ff):
+    # reference (pydl) reader, returns header pairs and FIBERMAP DataFrame
+    from pydl.pydlutils.yanny import yanny
     yf = yanny(ff)
     ft = yf["FIBERMAP"]
     magArr = ft["mag"]
@@ -47,43 +320,65 @@ def parseConfSummary(ff):
     df["fiberType"] = df["fiberType"].str.decode("utf-8")
     df["category"] = df["category"].str.decode("utf-8")
     df["firstcarton"] = df["firstcarton"].str.decode("utf-8")
+    pairs = {key: yf[key] for key in yf.pairs()}
+    return pairs, df
+
+
+def _readConfSummaryFast(ff):
+    # fastYanny reader, returns the same as _readConfSummaryYanny
+    pairs, tables = readYanny(ff)
+    cols = tables["FIBERMAP"]
+    magArr = cols.pop("mag")
+    for col in ["holeId", "fiberType", "category", "firstcarton"]:
+        cols[col] = numpy.char.decode(cols[col], "utf-8").tolist()
+    df = pandas.DataFrame(cols)
+    for ii, band in enumerate("ugriz"):
+        df["%smag"%band] = magArr[:, ii]
+    return pairs, df
+
+
+def parseConfSummary(ff, fast=True):
+    """ FIBERMAP of a confSummary(F) file plus header values and flags as
+    a DataFrame.  fast uses fastYanny, else pydl's yanny (same output).
+    """
+    print("parsing sum file", ff)
+    if fast:
+        pairs, df = _readConfSummaryFast(ff)
+    else:
+        pairs, df = _readConfSummaryYanny(ff)
 
     #add headers
-    df["configuration_id"] = int(yf["configuration_id"])
-    df["design_id"] = int(yf["design_id"])
-    df["field_id"] = int(yf["field_id"])
-    df["epoch"] = float(yf["epoch"])
-    obsTime = datetime.strptime(yf["obstime"], "%a %b %d %H:%M:%S %Y")
+    df["configuration_id"] = int(pairs["configuration_id"])
+    df["design_id"] = int(pairs["design_id"])
+    df["field_id"] = int(pairs["field_id"])
+    df["epoch"] = float(pairs["epoch"])
+    obsTime = datetime.strptime(pairs["obstime"], "%a %b %d %H:%M:%S %Y")
     df["obsTime"] = obsTime
-    df["mjd"] = int(yf["MJD"])
-    df["observatory"] = yf["observatory"]
-    df["raCen"] = float(yf["raCen"])
-    df["decCen"] = float(yf["decCen"])
-    df["pa"] = float(yf["pa"])
+    df["mjd"] = int(pairs["MJD"])
+    df["observatory"] = pairs["observatory"]
+    df["raCen"] = float(pairs["raCen"])
+    df["decCen"] = float(pairs["decCen"])
+    df["pa"] = float(pairs["pa"])
     df["filename"] = ff
     coord_epoch = df.coord_epoch.to_numpy()
     _tt = Time(coord_epoch, format="jyear")
     df["coord_epoch_jd"] = _tt.jd
-    try:
-        df["fvc_image_path"] = yf["fvc_image_path"]
-    except:
+    if "fvc_image_path" in pairs:
+        df["fvc_image_path"] = pairs["fvc_image_path"]
+    else:
         df["fvc_image_path"] = None
 
-    if "focal_scale" in yf.pairs():
-        df["focal_scale"] = float(yf["focal_scale"])
+    if "focal_scale" in pairs:
+        df["focal_scale"] = float(pairs["focal_scale"])
     else:
         df["focal_scale"] = 1
 
-    # import pdb; pdb.set_trace()
     # add an easier flag for sky fibers
-    isSky = []
-    for c in df.firstcarton.to_numpy():
-        if "sky" in c or "skies" in c:
-            isSky.append(True)
-        else:
-            isSky.append(False)
-
-    df["isSky"] = isSky
+    firstcarton = df.firstcarton.astype(str)
+    df["isSky"] = (
+        firstcarton.str.contains("sky", regex=False) | \
+        firstcarton.str.contains("skies", regex=False)
+    ).to_numpy(dtype=bool)
 
     # add an easier flag for science fibers
     ot = df.on_target.to_numpy(dtype=bool)
@@ -99,10 +394,10 @@ def parseConfSummary(ff):
         df["fvc"] = False
 
     # figure out if its dithered or not
-    if "parent_configuration" in yf.pairs():
-        df["parent_configuration"] = int(yf["parent_configuration"])
+    if "parent_configuration" in pairs:
+        df["parent_configuration"] = int(pairs["parent_configuration"])
         # df["is_dithered"] = True
-        df["dither_radius"] = float(yf["dither_radius"])
+        df["dither_radius"] = float(pairs["dither_radius"])
     else:
         df["parent_configuration"] = -999
         # df["is_dithered"] = False
@@ -124,15 +419,111 @@ def parseConfSummary(ff):
     return df
 
 
+# adaptive guide frame sampling (SciExp(adaptive=True)), frames are run
+# in batches until the bootstrap standard errors of the medians below are
+# all within tolerance.  ra/dec/pa in deg (ra on sky, ie times cos(dec)),
+# sigmaGFA in mm
+ADAPTIVE_TOL = {
+    "raFit": 0.05/3600, "decFit": 0.05/3600, "paFit": 0.005,
+    "scaleFit": 2e-6, "sigmaGFA": 0.002,
+}
+ADAPTIVE_MIN_FRAMES = 8
+ADAPTIVE_BATCH = 8
+ADAPTIVE_NBOOT = 200
+# ADAPTIVE_TOL parameters that come from the per frame pointing fit
+POINTING_PARAMS = ["raFit", "decFit", "paFit", "scaleFit"]
+
+
+def adaptiveOrder(gimgNums):
+    """ guide frame numbers (sorted, unique) reordered so that every prefix
+    is spread evenly over the exposure (bit reversed index order), so early
+    batches of adaptive sampling see any drift across the exposure
+    """
+    gimgNums = sorted(set(int(x) for x in gimgNums))
+    nBits = max(int(numpy.ceil(numpy.log2(max(len(gimgNums), 1)))), 1)
+    bitRev = [int(format(ii, "0%ib"%nBits)[::-1], 2) for ii in range(len(gimgNums))]
+    return [gimgNums[ii] for ii in numpy.argsort(bitRev, kind="stable")]
+
+
+def frameStats(matches):
+    """ per guide frame (imgNum) pointing fit and sigmaGFA (mm), sigmaGFA
+    computed as in SciExp but from one frame's matches
+    """
+    keep = (matches.cpeak > 500) & (matches.cpeak < 50000)
+    good = matches[keep]
+    sigma = numpy.sqrt((good.x2/2 + good.y2/2).groupby(good.imgNum).median())*13.5/1000
+    stats = matches.groupby("imgNum")[["raFit", "decFit", "paFit", "scaleFit"]].first()
+    stats["sigmaGFA"] = sigma
+    return stats
+
+
+def bootstrapMedianSE(values, nBoot=ADAPTIVE_NBOOT, rng=None):
+    """ bootstrap standard error of the median of values (nans dropped)
+    """
+    values = numpy.asarray(values, dtype=float)
+    values = values[numpy.isfinite(values)]
+    if len(values) < 2:
+        return numpy.inf
+    if rng is None:
+        rng = numpy.random.default_rng()
+    idx = rng.integers(0, len(values), size=(nBoot, len(values)))
+    return float(numpy.std(numpy.median(values[idx], axis=1), ddof=1))
+
+
+def adaptiveConvergence(matches, tol=None, rng=None, fitPointing=True):
+    """ returns (converged, dict of bootstrap standard error per
+    ADAPTIVE_TOL parameter) for the guide frames in matches.  If not
+    fitPointing the frames have no pointing fit (its columns are nan) and
+    only the remaining parameters (sigmaGFA) are tested.
+    """
+    if tol is None:
+        tol = ADAPTIVE_TOL
+    if not fitPointing:
+        tol = {k: v for k, v in tol.items() if k not in POINTING_PARAMS}
+    stats = frameStats(matches)
+    if "raFit" in tol:
+        cosDec = numpy.cos(numpy.radians(numpy.nanmedian(stats.decFit)))
+    stdErr = {}
+    for param in tol.keys():
+        stdErr[param] = bootstrapMedianSE(stats[param], rng=rng)
+        if param == "raFit":
+            stdErr[param] *= cosDec
+    converged = len(stats) >= ADAPTIVE_MIN_FRAMES and \
+        all(stdErr[param] <= tol[param] for param in tol.keys())
+    return converged, stdErr
+
+
 class SciExp(object):
     def __init__(
         self, site, fiberType, mjd, sciImgNum, expStart, expTime,
         gimgNums, ditherFile, confMeas,
-        quick=False, fitPointing=False
+        quick=False, fitPointing=False, jointPointing=False, fitDrift=False,
+        scheduler=None, configID=None, adaptive=False, adaptiveTol=None
     ):
+        """ if jointPointing, instead of fitting pointing per guide frame
+        and taking medians, fit one pointing model (plus a linear drift if
+        fitDrift) to the matches of all guide frames at the exposure
+        midpoint, per frame residuals are kept in self.frameResid
+
+        if scheduler (a BundleScheduler) is given guide bundles are run on
+        its shared pool, else on a Pool created for this exposure
+
+        gfa matches are written to gfa_<sciImgNum>.csv, or to the "gfa"
+        table of RESULT_STORE if set (configID defaults to the guide
+        frames' configid)
+
+        if adaptive, guide frames are processed in batches (spread over
+        the exposure, see adaptiveOrder) until the bootstrap standard
+        errors of the median pointing and sigmaGFA are within adaptiveTol
+        (default ADAPTIVE_TOL).  Without a per frame pointing fit (not
+        fitPointing, or jointPointing) only sigmaGFA is tested.  The frames used are in self.gimgNumsUsed,
+        their number in self.nGimg (and the nGimg column of confMeas), the
+        final standard errors in self.convergence.
+        """
+        assert not (quick and adaptive), "quick and adaptive are exclusive"
         if quick:
             # use only 3 random guide images
-            gimgNums = numpy.random.choice(gimgNums, size=3)
+            gimgNums = numpy.random.choice(gimgNums, size=min(3, len(gimgNums)), replace=False)
         self.site = site.lower()
         self.fiberType = fiberType.lower()
         self.mjd = mjd
@@ -140,23 +531,86 @@ class SciExp(object):
         self.gimgNums = gimgNums
         self.confMeas = confMeas.copy()
 
-        _processGuideBundle = partial(processGuideBundle, mjd=mjd, site=site, fitPointing=fitPointing)
-        p = Pool(25)
-        matches = p.map(_processGuideBundle, gimgNums)
-        matches = pandas.concat(matches)
-        p.close()
+        if jointPointing:
+            fitPointing = False
+        p = None
+        if scheduler is None:
+            _processGuideBundle = partial(processGuideBundleBlocks, mjd=mjd, site=site, fitPointing=fitPointing)
+            p = Pool(25)
+            def runFrames(nums):
+                # each frame once, in first seen order
+                nums = list(OrderedDict.fromkeys(int(n) for n in nums))
+                return p.map(_processGuideBundle, nums)
+        else:
+            def runFrames(nums):
+                # each frame once, repeated keys would return its matches twice
+                nums = list(OrderedDict.fromkeys(int(n) for n in nums))
+                keys = scheduler.submitMany(site, mjd, nums, fitPointing)
+                results = {}
+                for key, _matches in scheduler.asCompleted(keys):
+                    results[key] = _matches
+                # keep gimgNums order, drop failed frames
+                return [results[key] for key in keys if results[key] is not None]
+
+        self.convergence = None
+        if adaptive:
+            rng = numpy.random.default_rng(sciImgNum)
+            order = adaptiveOrder(gimgNums)
+            matches = []
+            nStart = 0
+            nNext = max(ADAPTIVE_MIN_FRAMES, ADAPTIVE_BATCH)
+            while nStart < len(order):
+                matches += [m for m in runFrames(order[nStart:nStart + nNext]) if m is not None]
+                nStart += nNext
+                nNext = ADAPTIVE_BATCH
+                if len(matches) == 0:
+                    continue
+                converged, self.convergence = adaptiveConvergence(
+                    blocksToMatches(matches), adaptiveTol, rng, fitPointing
+                )
+                if converged:
+                    break
+        else:
+            matches = runFrames(gimgNums)
+        if p is not None:
+            p.close()
+        # one DataFrame for the exposure, workers return numpy blocks
+        matches = blocksToMatches(matches)
+        self.gimgNumsUsed = sorted(set(matches.imgNum))
+        self.nGimg = len(self.gimgNumsUsed)
+        if adaptive:
+            print("sciImgNum %i used %i of %i guide frames"%(sciImgNum, self.nGimg, len(set(gimgNums))))
 
         # self.guideBundles = [GuideBundle(site,mjd,imgNum) for imgNum in gimgNums]
 
         # pointing parameters from gimgs
         # write gfa matches to csv
         matches["sciImgNum"] = sciImgNum
-        matches.to_csv("gfa_%i.csv"%sciImgNum)
+        if RESULT_STORE is None:
+            matches.to_csv("gfa_%i.csv"%sciImgNum)
+        else:
+            if configID is None:
+                configID = int(matches.configid.iloc[0])
+            RESULT_STORE.write("gfa", matches, site, mjd, configID, sciImgNum)
+
+        self.dateObs = expStart + TimeDelta(expTime/2*u.s) # midpoint of spectrograph exposure
+        self.dateObsJD = self.dateObs.jd
 
-        self.raFit = numpy.median(matches.raFit)
-        self.decFit = numpy.median(matches.decFit)
-        self.paFit = numpy.median(matches.paFit)
-        self.scaleFit = numpy.median(matches.scaleFit)
+        if jointPointing:
+            self.pointingFit, self.frameResid = fitPointingJoint(
+                matches, self.site, self.dateObsJD, fitDrift=fitDrift
+            )
+            self.raFit = self.pointingFit["raFit"]
+            self.decFit = self.pointingFit["decFit"]
+            self.paFit = self.pointingFit["paFit"]
+            self.scaleFit = self.pointingFit["scaleFit"]
+        else:
+            self.pointingFit = None
+            self.frameResid = None
+            self.raFit = numpy.median(matches.raFit)
+            self.decFit = numpy.median(matches.decFit)
+            self.paFit = numpy.median(matches.paFit)
+            self.scaleFit = numpy.median(matches.scaleFit)
         # optical performance from gimgs
         matches = matches[matches.cpeak > 500]
         matches = matches[matches.cpeak < 50000]
@@ -164,20 +618,10 @@ class SciExp(object):
         matches["fluxRatio"] = matches.fluxNorm_meas / matches.fluxNorm_expect
 
 
-        self.dateObs = expStart + TimeDelta(expTime/2*u.s) # midpoint of spectrograph exposure
-        self.dateObsJD = self.dateObs.jd
-
-        xWokStar = []
-        yWokStar = []
-        for ii, row in confMeas.iterrows():
-            xWok, yWok, fieldWarn, HA, PA = radec2wokxy(
-                [float(row.racat)], [float(row.deccat)], float(row.coord_epoch_jd), self.fiberType.capitalize(),
-                self.raFit, self.decFit, self.paFit,
-                self.site.upper(), self.dateObsJD, focalScale=self.scaleFit,
-                pmra=float(row.pmra), pmdec=float(row.pmdec)
-            )
-            xWokStar.append(xWok[0])
-            yWokStar.append(yWok[0])
+        xWokStar, yWokStar = starWokXY(
+            confMeas, self.fiberType, self.raFit, self.decFit, self.paFit,
+            self.site, self.dateObsJD, self.scaleFit
+        )
 
         self.confMeas["xWokStar"] = xWokStar
         self.confMeas["yWokStar"] = yWokStar
@@ -192,6 +636,7 @@ class SciExp(object):
         self.confMeas["yWokFiber"] = self.confMeas["ywok"] # FVC measured
         self.confMeas["fiberType"] = self.fiberType
         self.confMeas["sciImgNum"] = self.sciImgNum
+        self.confMeas["nGimg"] = self.nGimg
 
         ff = fits.open(ditherFile)
         ditherFlux = fitsTableToPandas(ff[1].data)
@@ -207,7 +652,7 @@ class SciExp(object):
         self.confMeas = self.confMeas.merge(ditherFlux, on="fiberId").reset_index()
         keepColumns = ["positionerId", "fiberId", "fiberType", "spectroflux", "spectroflux_ivar", magCol, "flux_expect", "xWokStar", "yWokStar", "xWokFiber", "yWokFiber"]
         keepColumns += ["raFit", "decFit", "paFit", "scaleFit", "dateObsJD", "sigmaGFA", "fluxRatioGFA"]
-        keepColumns += ["sciImgNum", "alpha", "beta", "dateObsJD"]
+        keepColumns += ["sciImgNum", "nGimg", "alpha", "beta", "dateObsJD"]
         self.confMeas = self.confMeas[keepColumns]
 
         # print("sigmaGFA", self.confMeas.sigmaGFA.to_numpy()[0])
@@ -215,8 +660,35 @@ class SciExp(object):
 
 
 class Configuration(object):
-    def __init__(self, configID, color="red", fitPointing=True):
+    def __init__(
+        self, configID, color="red", fitPointing=True, prefetchGaia=True,
+        useGimgIndex=True, jointPointing=False, useExpCatalog=True,
+        scheduler=None, run=True, adaptive=False
+    ):
         """color ignored for apogee, corresponds to red or blue boss chip
+
+        if prefetchGaia, gaia is fetched once for the whole field (all six
+        GFAs) before the guide bundles are farmed out to worker processes
+
+        if useGimgIndex, guide frame headers are read from (and added to)
+        the per site/mjd gimgIndex rather than opening every fits file
+
+        if jointPointing, pointing is fit once per science exposure to
+        all of its guide frames (see SciExp)
+
+        if useExpCatalog, apogee and boss exposures (and their dither
+        files) are looked up in the per site/mjd expCatalog rather than
+        opening every raw spectrograph file
+
+        if scheduler (a BundleScheduler) is given, the guide bundles of all
+        science exposures are queued on it up front.  With run=False
+        construction stops there and run() processes the exposures later,
+        so bundles for the next configuration can be queued while the
+        current one is processed.
+
+        if adaptive, each science exposure processes only as many guide
+        frames as it needs for a stable pointing (see SciExp), only the
+        first batch is queued up front
         """
         assert color in ["blue", "red"]
 
@@ -225,6 +697,11 @@ class Configuration(object):
         else:
             self.site = "apo"
         self.fitPointing = fitPointing
+        self.useGimgIndex = useGimgIndex
+        self.jointPointing = jointPointing
+        self.useExpCatalog = useExpCatalog
+        self.scheduler = scheduler
+        self.adaptive = adaptive
         self.configID = configID
         self.color = color.lower()
         confPath, confFPath = self._getConfPaths()
@@ -239,6 +716,8 @@ class Configuration(object):
         self.gimgExpStart = []
         self.gimgExpEnd = []
         self.gimgExpTime = []
+        self.gimgExpStartJD = numpy.array([])
+        self.gimgExpEndJD = numpy.array([])
 
         self.apNum = []
         self.apFile = []
@@ -283,46 +762,80 @@ class Configuration(object):
         else:
             raise RuntimeError("No Boss or Ap exposures found")
 
+        self.sciExps = None
         if len(self.confMeasAssigned) > 0:
-            self.sciExps = self.bundleSciExps() # writes a csv for every exposure
+            if prefetchGaia:
+                prefetchFieldGaia(
+                    self.configID, self.site,
+                    float(self.confMeas.raCen.to_numpy()[0]),
+                    float(self.confMeas.decCen.to_numpy()[0])
+                )
+            if self.scheduler is not None:
+                for gimgExpNums in self._sciGimgNums():
+                    if self.adaptive:
+                        gimgExpNums = adaptiveOrder(gimgExpNums)[:max(ADAPTIVE_MIN_FRAMES, ADAPTIVE_BATCH)]
+                    self.scheduler.submitMany(
+                        self.site, self.mjd, gimgExpNums,
+                        self.fitPointing and not self.jointPointing
+                    )
+            if run:
+                self.run()
         else:
             print("found no assigned")
-            self.sciExps = None
 
+    def run(self):
+        if len(self.confMeasAssigned) > 0:
+            self.sciExps = self.bundleSciExps() # writes results for every exposure
+        return self.sciExps
 
-    def bundleSciExps(self):
+    def _sciExpList(self):
+        # sciImgNum, expStart, expEnd, expTime, ditherFile per science exposure
         if self.fiberType == "apogee":
             attrPre = "ap"
         else:
             attrPre = "boss"
         Num = getattr(self,"%sNum"%attrPre)
-        File = getattr(self,"%sFile"%attrPre)
         ExpStart = getattr(self,"%sExpStart"%attrPre)
         ExpEnd = getattr(self,"%sExpEnd"%attrPre)
         ExpTime = getattr(self,"%sExpTime"%attrPre)
         DitherFile = getattr(self,"%sDitherFile"%attrPre)
+        return list(zip(Num,ExpStart,ExpEnd,ExpTime,DitherFile))
+
+    def _sciGimgNums(self):
+        # find what gimgs go with each science image
+        if self.fiberType == "apogee":
+            attrPre = "ap"
+        else:
+            attrPre = "boss"
+        matched = intervalJoin(
+            getattr(self, "%sExpStartJD"%attrPre), getattr(self, "%sExpEndJD"%attrPre),
+            self.gimgExpStartJD, self.gimgExpEndJD
+        )
+        gimgNum = numpy.array(self.gimgNum, dtype=int)
+        return [list(gimgNum[idx]) for idx in matched]
 
+    def bundleSciExps(self):
         sciExps = []
-        for n,f,es,ee,et,df in zip(Num,File,ExpStart,ExpEnd,ExpTime,DitherFile):
-            # find what gimgs go with this science image
+        for (n,es,ee,et,df), gimgExpNums in zip(self._sciExpList(), self._sciGimgNums()):
             print("on image n",n)
-            gimgExpNums = []
-            for gimgNum, gimgStart, gimgEnd in zip(self.gimgNum, self.gimgExpStart, self.gimgExpEnd):
-                if gimgStart < es:
-                    continue
-                if gimgEnd > ee:
-                    continue
-                gimgExpNums.append(gimgNum)
 
             sciExp = SciExp(site=self.site, fiberType=self.fiberType,
                              mjd=self.mjd, sciImgNum=n, expStart=es, expTime=et, gimgNums=gimgExpNums,
                              ditherFile=df,
-                             confMeas=self.confMeasAssigned, fitPointing=self.fitPointing)
+                             confMeas=self.confMeasAssigned, fitPointing=self.fitPointing,
+                             jointPointing=self.jointPointing, scheduler=self.scheduler,
+                             configID=self.configID, adaptive=self.adaptive)
             print("sigmaGFA", sciExp.confMeas.sigmaGFA.to_numpy()[0])
-            dframe = sciExp.confMeas.copy()
-            dframe["mjd"] = self.mjd
-            dframe["configID"] = self.configID
-            dframe.to_csv("dither_%i_%i.csv"%(self.configID, n), index=False)
+            if RESULT_STORE is None:
+                dframe = sciExp.confMeas.copy()
+                dframe["mjd"] = self.mjd
+                dframe["configID"] = self.configID
+                dframe.to_csv("dither_%i_%i.csv"%(self.configID, n), index=False)
+            else:
+                # site/mjd/configID are partition keys
+                RESULT_STORE.write(
+                    "dither", sciExp.confMeas, self.site, self.mjd, self.configID, n
+                )
             sciExps.append(sciExp)
 
         return sciExps
@@ -342,99 +855,153 @@ class Configuration(object):
         else:
             gcamNum = "gfa3s"
 
-        gimgGlob = DATA_BASE_PATH + "/gcam/%s/%i/proc-gimg-%s-*.fits"%(self.site,self.mjd,gcamNum)
-        gimgFiles = sorted(glob.glob(gimgGlob))
-
-        for file in gimgFiles:
-            ff = fits.open(file)
-            if ff[1].header["CONFIGID"] == self.configID:
-                gimgNum = int(file.split("-")[-1].split(".fits")[0])
-                expStart = Time(ff[1].header["DATE-OBS"], format="iso", scale="tai")
-                expTime = ff[1].header["EXPTIME"]
-                expEnd = expStart + TimeDelta(expTime*u.s)
-
-                self.gimgNum.append(gimgNum)
-                self.gimgFile.append(file)
-                self.gimgExpStart.append(expStart)
-                self.gimgExpTime.append(expTime)
-                self.gimgExpEnd.append(expEnd)
+        gimgExps = [] # file, dateObs, expTime
+        if self.useGimgIndex:
+            gimgIndex = GimgIndex(self.site, self.mjd, gimgBase=DATA_BASE_PATH + "/gcam/")
+            gimgIndex.update()
+            df = gimgIndex.query(configid=self.configID, gfaNum=3)
+            if len(df) > 0:
+                gimgExps = list(zip(df.filename, df.DATE_OBS, df.EXPTIME))
+        else:
+            gimgGlob = DATA_BASE_PATH + "/gcam/%s/%i/proc-gimg-%s-*.fits"%(self.site,self.mjd,gcamNum)
+            gimgFiles = sorted(glob.glob(gimgGlob))
+
+            for file in gimgFiles:
+                ff = fits.open(file)
+                if ff[1].header["CONFIGID"] == self.configID:
+                    gimgExps.append((file, ff[1].header["DATE-OBS"], ff[1].header["EXPTIME"]))
+
+        if len(gimgExps) == 0:
+            return
+        files, dateObs, expTime = zip(*gimgExps)
+        # one vectorized Time for all frames, the interval join uses the
+        # float JD arrays
+        expTime = numpy.array(expTime, dtype=float)
+        expStart = Time(list(dateObs), format="iso", scale="tai")
+        expEnd = expStart + TimeDelta(expTime*u.s)
+
+        self.gimgNum = [int(file.split("-")[-1].split(".fits")[0]) for file in files]
+        self.gimgFile = list(files)
+        self.gimgExpStart = expStart
+        self.gimgExpTime = expTime
+        self.gimgExpEnd = expEnd
+        self.gimgExpStartJD = expStart.jd
+        self.gimgExpEndJD = self.gimgExpStartJD + expTime / 86400.
+
+    def _expCatalog(self):
+        if getattr(self, "_expCat", None) is None:
+            self._expCat = ExpCatalog(self.site, self.mjd, dataBase=DATA_BASE_PATH)
+            self._expCat.update()
+        return self._expCat
 
     def _getApExps(self):
         # find all apogee exposures with this configid
-        if self.site == "apo":
-            apStr = "apR"
+        apExps = [] # file, apNum, dateObs, expTime, ditherFile
+        if self.useExpCatalog:
+            df = self._expCatalog().query(
+                configid=self.configID, instrument="apogee", imageType="Object"
+            )
+            if len(df) > 0:
+                df = df[df.ditherFile.notnull()]
+                apExps = list(zip(df.filename, df.expNum, df.DATE_OBS, df.EXPTIME, df.ditherFile))
         else:
-            apStr = "asR"
-        apGlob = DATA_BASE_PATH + "/apogee/%s/%i/%s-a*.apz"%(self.site,self.mjd,apStr)
-        apFiles = sorted(glob.glob(apGlob))
-
-
-        for file in apFiles:
-            ff = fits.open(file)
-            if ff[1].header["IMAGETYP"] != "Object":
-                continue
-            if ff[1].header["CONFIGID"] == self.configID:
-                apNum = int(file.split("-")[-1].split(".apz")[0])
-                dateOBS = ff[1].header["DATE-OBS"].replace("T", " ")
-                expStart = Time(dateOBS, format="iso", scale="tai")
-                expTime = ff[1].header["EXPTIME"]
-                expEnd = expStart + TimeDelta(expTime*u.s)
-
-                dithGlob = DATA_BASE_PATH + "/apogee/quickred/%s/%i/dither/ditherAPOGEE-%i-*.fits"%(self.site, self.mjd, apNum)
-                dithFile = glob.glob(dithGlob)
-                if len(dithFile) == 1:
-                    self.apNum.append(apNum)
-                    self.apFile.append(file)
-                    self.apExpStart.append(expStart)
-                    self.apExpTime.append(expTime)
-                    self.apExpEnd.append(expEnd)
-                    self.apDitherFile.append(dithFile[0])
+            if self.site == "apo":
+                apStr = "apR"
+            else:
+                apStr = "asR"
+            apGlob = DATA_BASE_PATH + "/apogee/%s/%i/%s-a*.apz"%(self.site,self.mjd,apStr)
+            apFiles = sorted(glob.glob(apGlob))
+
+            for file in apFiles:
+                ff = fits.open(file)
+                if ff[1].header["IMAGETYP"] != "Object":
+                    continue
+                if ff[1].header["CONFIGID"] == self.configID:
+                    apNum = int(file.split("-")[-1].split(".apz")[0])
+                    dateOBS = ff[1].header["DATE-OBS"].replace("T", " ")
+                    expTime = ff[1].header["EXPTIME"]
+
+                    dithGlob = DATA_BASE_PATH + "/apogee/quickred/%s/%i/dither/ditherAPOGEE-%i-*.fits"%(self.site, self.mjd, apNum)
+                    dithFile = glob.glob(dithGlob)
+                    if len(dithFile) == 1:
+                        apExps.append((file, apNum, dateOBS, expTime, dithFile[0]))
+
+        for file, apNum, dateOBS, expTime, dithFile in apExps:
+            expStart = Time(dateOBS, format="iso", scale="tai")
+            expEnd = expStart + TimeDelta(expTime*u.s)
+            self.apNum.append(apNum)
+            self.apFile.append(file)
+            self.apExpStart.append(expStart)
+            self.apExpTime.append(expTime)
+            self.apExpEnd.append(expEnd)
+            self.apDitherFile.append(dithFile)
+
+        self.apExpStartJD = numpy.array([t.jd for t in self.apExpStart])
+        self.apExpEndJD = self.apExpStartJD + numpy.array(self.apExpTime, dtype=float) / 86400.
 
 
     def _getBossExps(self):
+        bossExps = [] # file, bossNum, dateObs, expTime, ditherFile
+        if self.useExpCatalog:
+            if self.color == "blue":
+                cameras = ["b1", "b2"]
+            else:
+                cameras = ["r1", "r2"]
+            df = self._expCatalog().query(
+                configid=self.configID, instrument="boss", imageType="science",
+                cameras=cameras
+            )
+            if len(df) > 0:
+                df = df[df.ditherFile.notnull()]
+                bossExps = list(zip(df.filename, df.expNum, df.DATE_OBS, df.EXPTIME, df.ditherFile))
+        else:
+            bossGlob = DATA_BASE_PATH + "/boss/spectro/%s/%i/sdR*.fit.gz"%(self.site,self.mjd)
+            bossFiles = sorted(glob.glob(bossGlob))
 
-        bossGlob = DATA_BASE_PATH + "/boss/spectro/%s/%i/sdR*.fit.gz"%(self.site,self.mjd)
-        bossFiles = sorted(glob.glob(bossGlob))
-
-        for file in bossFiles:
-            ff = fits.open(file)
-            if ff[0].header["FLAVOR"] != "science":
-                continue
-            if self.color == "blue" and "sdR-r1-" in file:
-                continue
-            if self.color == "blue" and "sdR-r2-" in file:
-                continue
-            if self.color == "red" and "sdR-b1-" in file:
-                continue
-            if self.color == "red" and "sdR-b2-" in file:
-                continue
-            if ff[0].header["CONFID"] == self.configID:
-                bossNum = int(file.split("-")[-1].split(".fit.gz")[0])
-                bossNumPad = ("%i"%bossNum).zfill(8)
-                dateOBS = ff[0].header["DATE-OBS"].replace("T", " ")
-                expStart = Time(dateOBS, format="iso", scale="tai")
-                expTime = ff[0].header["EXPTIME"]
-                expEnd = expStart + TimeDelta(expTime*u.s)
-                if "sdR-b1-" in file:
-                    bossColorStr = "b1"
-                elif "sdR-r1-" in file:
-                    bossColorStr = "r1"
-                elif "sdR-b2-" in file:
-                    bossColorStr = "b2"
-                else:
-                    bossColorStr = "r2"
-
-
-                dithGlob = DATA_BASE_PATH + "/boss/sos/%s/%i/dither/ditherBOSS-%s-%s-*.fits"%(self.site, self.mjd, bossNumPad, bossColorStr)
-                dithFile = glob.glob(dithGlob)
-                if len(dithFile) == 1:
-                    self.bossNum.append(bossNum)
-                    self.bossFile.append(file)
-                    self.bossExpStart.append(expStart)
-                    self.bossExpEnd.append(expEnd)
-                    self.bossExpTime.append(expTime)
-                    self.bossDitherFile.append(dithFile[0])
-
+            for file in bossFiles:
+                ff = fits.open(file)
+                if ff[0].header["FLAVOR"] != "science":
+                    continue
+                if self.color == "blue" and "sdR-r1-" in file:
+                    continue
+                if self.color == "blue" and "sdR-r2-" in file:
+                    continue
+                if self.color == "red" and "sdR-b1-" in file:
+                    continue
+                if self.color == "red" and "sdR-b2-" in file:
+                    continue
+                if ff[0].header["CONFID"] == self.configID:
+                    bossNum = int(file.split("-")[-1].split(".fit.gz")[0])
+                    bossNumPad = ("%i"%bossNum).zfill(8)
+                    dateOBS = ff[0].header["DATE-OBS"].replace("T", " ")
+                    expTime = ff[0].header["EXPTIME"]
+                    if "sdR-b1-" in file:
+                        bossColorStr = "b1"
+                    elif "sdR-r1-" in file:
+                        bossColorStr = "r1"
+                    elif "sdR-b2-" in file:
+                        bossColorStr = "b2"
+                    else:
+                        bossColorStr = "r2"
+
+
+                    dithGlob = DATA_BASE_PATH + "/boss/sos/%s/%i/dither/ditherBOSS-%s-%s-*.fits"%(self.site, self.mjd, bossNumPad, bossColorStr)
+                    dithFile = glob.glob(dithGlob)
+                    if len(dithFile) == 1:
+                        bossExps.append((file, bossNum, dateOBS, expTime, dithFile[0]))
+
+        for file, bossNum, dateOBS, expTime, dithFile in bossExps:
+            expStart = Time(dateOBS, format="iso", scale="tai")
+            expEnd = expStart + TimeDelta(expTime*u.s)
+            self.bossNum.append(bossNum)
+            self.bossFile.append(file)
+            self.bossExpStart.append(expStart)
+            self.bossExpEnd.append(expEnd)
+            self.bossExpTime.append(expTime)
+            self.bossDitherFile.append(dithFile)
+
+        self.bossExpStartJD = numpy.array([t.jd for t in self.bossExpStart])
+        self.bossExpEndJD = self.bossExpStartJD + numpy.array(self.bossExpTime, dtype=float) / 86400.
 
 
 
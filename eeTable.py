@@ -0,0 +1,118 @@
+import os
+from multiprocessing import Pool
+import numpy
+from scipy.special import chndtr
+
+
+EE_TABLE_PATH = "/uufs/chpc.utah.edu/common/home/u0449727/work/eeTable.npz"
+
+
+def encircledEnergy(u, v):
+    """ fraction of a circular gaussian's flux inside a circle of radius
+    v (in sigmas) whose center is u sigmas from the gaussian's center.
+    findFiberCenter.apertureFlux is amp*encircledEnergy(d/sigma, FIBER_RAD/sigma)
+    """
+    u = numpy.asarray(u, dtype=numpy.float64)
+    v = numpy.asarray(v, dtype=numpy.float64)
+    return chndtr(v**2, 2, u**2)
+
+
+def _buildRows(args):
+    u, v = args
+    return encircledEnergy(u[:, None], v[None, :])
+
+
+class EETable(object):
+    def __init__(self, uMax=16, vMin=0.2, vMax=6, step=0.005, path=EE_TABLE_PATH, nProcs=8):
+        """
+        encircledEnergy tabulated on a regular (u, v) grid and served by
+        bilinear interpolation.  The table is built once (in parallel) and
+        cached to path, a cached table is reused if its grid matches.
+
+        errBound bounds the interpolation error inside the grid,
+        (du**2 max|E_uu| + dv**2 max|E_vv|)/8 with the second derivatives
+        taken from the tabulated values.  Points with v outside [vMin, vMax]
+        are evaluated exactly, u beyond uMax returns 0 (the true value is
+        below exp(-(uMax - vMax)**2/2)).
+
+        Parameters
+        ------------------
+        uMax : float
+            largest star/fiber offset in sigmas
+        vMin, vMax : float
+            range of fiber radius in sigmas
+        step : float
+            grid spacing in both u and v
+        path : string or None
+            npz cache file, None to always build and never save
+        nProcs : int
+            processes used to build the table
+        """
+        self.u = numpy.arange(0, uMax + step/2, step)
+        self.v = numpy.arange(vMin, vMax + step/2, step)
+        self.step = step
+        self.path = path
+        if path is not None and os.path.exists(path) and self._load():
+            return
+        self._build(nProcs)
+        if path is not None:
+            self._save()
+
+    def _build(self, nProcs):
+        uChunks = numpy.array_split(self.u, max(nProcs, 1)*4)
+        tasks = [(u, self.v) for u in uChunks if len(u) > 0]
+        if nProcs > 1:
+            p = Pool(nProcs)
+            rows = p.map(_buildRows, tasks)
+            p.close()
+        else:
+            rows = [_buildRows(task) for task in tasks]
+        self.ee = numpy.concatenate(rows)
+        self.errBound = self._errBound()
+
+    def _errBound(self):
+        euu = numpy.abs(numpy.diff(self.ee, n=2, axis=0)).max() / self.step**2
+        evv = numpy.abs(numpy.diff(self.ee, n=2, axis=1)).max() / self.step**2
+        return float(self.step**2 * (euu + evv) / 8)
+
+    def _load(self):
+        with numpy.load(self.path) as npz:
+            if len(npz["u"]) != len(self.u) or len(npz["v"]) != len(self.v) or \
+                    not numpy.allclose(npz["u"], self.u) or not numpy.allclose(npz["v"], self.v):
+                return False
+            self.ee = npz["ee"]
+            self.errBound = float(npz["errBound"])
+        return True
+
+    def _save(self):
+        dirname = os.path.dirname(self.path)
+        if dirname != "":
+            os.makedirs(dirname, exist_ok=True)
+        tmpPath = self.path + ".tmp%i.npz"%os.getpid()
+        numpy.savez(tmpPath, u=self.u, v=self.v, ee=self.ee, errBound=self.errBound)
+        os.replace(tmpPath, self.path)
+
+    def __call__(self, u, v):
+        """ encircledEnergy(u, v), interpolated, for broadcastable arrays
+        """
+        u, v = numpy.broadcast_arrays(
+            numpy.abs(numpy.asarray(u, dtype=numpy.float64)),
+            numpy.asarray(v, dtype=numpy.float64)
+        )
+        out = numpy.zeros(u.shape)
+        inV = (v >= self.v[0]) & (v <= self.v[-1])
+        inside = inV & (u <= self.u[-1])
+
+        fu = u[inside] / self.step
+        fv = (v[inside] - self.v[0]) / self.step
+        iu = numpy.minimum(fu.astype(int), len(self.u) - 2)
+        iv = numpy.minimum(fv.astype(int), len(self.v) - 2)
+        a = fu - iu
+        b = fv - iv
+        ee = self.ee
+        out[inside] = (ee[iu, iv]*(1 - a) + ee[iu + 1, iv]*a)*(1 - b) + \
+            (ee[iu, iv + 1]*(1 - a) + ee[iu + 1, iv + 1]*a)*b
+
+        if not numpy.all(inV):
+            out[~inV] = encircledEnergy(u[~inV], v[~inV])
+        return out
@@ -0,0 +1,295 @@
+import os
+import glob
+import gzip
+import sqlite3
+from multiprocessing import Pool
+import numpy
+import pandas
+from astropy.io import fits
+
+
+DATA_BASE = "/uufs/chpc.utah.edu/common/home/sdss50/sdsswork/data"
+EXP_CATALOG_DIR = "/uufs/chpc.utah.edu/common/home/u0449727/work/expCatalog"
+
+FITS_BLOCK = 2880
+
+# columns of the exps table (readExpHeader rows plus the resolved dither
+# file), filename is the key
+EXP_COLUMNS = [
+    "filename", "mtime", "instrument", "camera", "expNum", "imageType",
+    "configid", "DATE_OBS", "EXPTIME", "ditherFile",
+]
+
+# instrument: (header extension, image type keyword, config keyword)
+HEADER_KEYS = {
+    "apogee": (1, "IMAGETYP", "CONFIGID"),
+    "boss": (0, "FLAVOR", "CONFID"),
+}
+
+
+def _hasEnd(block):
+    for ii in range(0, FITS_BLOCK, 80):
+        if block[ii:ii+8] == b"END     ":
+            return True
+    return False
+
+
+def _dataSize(header):
+    # bytes (padded to full blocks) of the data unit following header
+    naxis = header.get("NAXIS", 0)
+    if naxis == 0:
+        return 0
+    nElem = numpy.prod([header["NAXIS%i"%ii] for ii in range(1, naxis + 1)])
+    nBytes = abs(header["BITPIX"]) // 8 * header.get("GCOUNT", 1) * (
+        header.get("PCOUNT", 0) + nElem
+    )
+    return int(numpy.ceil(nBytes / FITS_BLOCK) * FITS_BLOCK)
+
+
+def readFitsHeader(filename, ext=0):
+    """ read the header of extension ext without reading any data after
+    it.  For .gz files only as much is decompressed as needed to reach
+    ext's END card (data units before ext are skipped, not parsed).
+    """
+    if filename.endswith(".gz"):
+        f = gzip.open(filename, "rb")
+    else:
+        f = open(filename, "rb")
+    with f:
+        for hdu in range(ext + 1):
+            blocks = []
+            while True:
+                block = f.read(FITS_BLOCK)
+                if len(block) < FITS_BLOCK:
+                    raise IOError("%s: no END card found in hdu %i"%(filename, hdu))
+                blocks.append(block)
+                if _hasEnd(block):
+                    break
+            header = fits.Header.fromstring(b"".join(blocks).decode("ascii"))
+            if hdu < ext:
+                f.seek(_dataSize(header), 1)
+    return header
+
+
+def parseExpFilename(filename):
+    """ returns instrument, camera, expNum from apR-a-12345678.apz or
+    sdR-b1-00012345.fit.gz style names
+    """
+    base = os.path.basename(filename)
+    if base.endswith(".apz"):
+        prefix, camera, numStr = base.split(".apz")[0].split("-")
+        return "apogee", camera, int(numStr)
+    prefix, camera, numStr = base.split(".fit")[0].split("-")
+    return "boss", camera, int(numStr)
+
+
+def readExpHeader(filename):
+    """ catalog row for one raw apogee or boss exposure
+    """
+    instrument, camera, expNum = parseExpFilename(filename)
+    ext, typeKey, configKey = HEADER_KEYS[instrument]
+    header = readFitsHeader(filename, ext)
+    dateObs = header.get("DATE-OBS", None)
+    if dateObs is not None:
+        dateObs = dateObs.replace("T", " ")
+    configid = header.get(configKey, None)
+    try:
+        configid = int(configid)
+    except (TypeError, ValueError):
+        configid = None
+    return {
+        "filename": filename,
+        "mtime": os.path.getmtime(filename),
+        "instrument": instrument,
+        "camera": camera,
+        "expNum": expNum,
+        "imageType": header.get(typeKey, None),
+        "configid": configid,
+        "DATE_OBS": dateObs,
+        "EXPTIME": header.get("EXPTIME", None),
+    }
+
+
+class ExpCatalog(object):
+    def __init__(self, site, mjd, catalogDir=EXP_CATALOG_DIR, dataBase=DATA_BASE):
+        """
+        SQLite catalog of the raw APOGEE (.apz) and BOSS (sdR*.fit.gz)
+        exposures for one site/mjd: image type, config id, DATE-OBS and
+        EXPTIME from the header, plus the matching ditherAPOGEE /
+        ditherBOSS file if there is exactly one.  Updated incrementally,
+        only new or modified exposures are re-read, dither files are
+        re-resolved for exposures that don't have one yet.
+
+        Parameters
+        ------------------
+        site : string
+            "apo" or "lco" (case ignored)
+        mjd : int
+            mjd to catalog
+        catalogDir : string
+            directory holding expCatalog-<site>-<mjd>.sqlite files
+        dataBase : string
+            root of the sdsswork data tree
+        """
+        self.site = site.lower()
+        self.mjd = mjd
+        self.catalogDir = catalogDir
+        self.dataBase = dataBase
+        self.path = os.path.join(catalogDir, "expCatalog-%s-%i.sqlite"%(self.site, mjd))
+
+    def _connect(self):
+        os.makedirs(self.catalogDir, exist_ok=True)
+        # wait for another process's update rather than fail
+        return sqlite3.connect(self.path, timeout=600)
+
+    def _createTable(self, conn):
+        cols = [row[1] for row in conn.execute("pragma table_info(exps)") if row[5] > 0]
+        if self._hasTable(conn) and cols != ["filename"]:
+            # written before filename was the primary key (and may hold
+            # duplicate rows), rebuild it
+            conn.execute("drop table exps")
+        conn.execute(
+            "create table if not exists exps (%s)"%", ".join(
+                ['"filename" text primary key'] + ['"%s"'%col for col in EXP_COLUMNS[1:]]
+            )
+        )
+        conn.execute("create index if not exists exps_config on exps (configid)")
+
+    def _hasTable(self, conn):
+        cur = conn.execute(
+            "select name from sqlite_master where type='table' and name='exps'"
+        )
+        return cur.fetchone() is not None
+
+    def _indexed(self, conn):
+        if not self._hasTable(conn):
+            return {}
+        df = pandas.read_sql("select filename, mtime from exps", conn)
+        return dict(zip(df.filename, df.mtime))
+
+    def expFiles(self):
+        if self.site == "apo":
+            apStr = "apR"
+        else:
+            apStr = "asR"
+        apFiles = glob.glob(
+            self.dataBase + "/apogee/%s/%i/%s-a*.apz"%(self.site, self.mjd, apStr)
+        )
+        bossFiles = glob.glob(
+            self.dataBase + "/boss/spectro/%s/%i/sdR*.fit.gz"%(self.site, self.mjd)
+        )
+        return sorted(apFiles + bossFiles)
+
+    def ditherFiles(self):
+        """ returns dict of (instrument, camera, expNum): dither file, for
+        exposures with exactly one dither file (camera is "a" for apogee)
+        """
+        found = {}
+        apGlob = self.dataBase + "/apogee/quickred/%s/%i/dither/ditherAPOGEE-*.fits"%(self.site, self.mjd)
+        for f in glob.glob(apGlob):
+            expNum = int(os.path.basename(f).split("-")[1])
+            found.setdefault(("apogee", "a", expNum), []).append(f)
+        bossGlob = self.dataBase + "/boss/sos/%s/%i/dither/ditherBOSS-*.fits"%(self.site, self.mjd)
+        for f in glob.glob(bossGlob):
+            parts = os.path.basename(f).split("-")
+            found.setdefault(("boss", parts[2], int(parts[1])), []).append(f)
+        return {key: files[0] for key, files in found.items() if len(files) == 1}
+
+    def update(self, nProcs=8):
+        """ re-read new or modified exposures, drop exposures that
+        disappeared and resolve missing dither files.  Returns the number
+        of headers read.  The whole diff and write is one write
+        transaction, so concurrent updaters of the same site/mjd run one
+        after the other (the second finds nothing left to read).
+        """
+        files = self.expFiles()
+        conn = self._connect()
+        conn.isolation_level = None # transactions handled here
+        try:
+            conn.execute("begin immediate")
+            self._createTable(conn)
+            indexed = self._indexed(conn)
+            toRead = [f for f in files if indexed.get(f) != os.path.getmtime(f)]
+            removed = set(indexed.keys()) - set(files)
+
+            rows = []
+            if len(toRead) > 0:
+                if nProcs > 1 and len(toRead) > 1:
+                    p = Pool(nProcs)
+                    rows = p.map(readExpHeader, toRead)
+                    p.close()
+                else:
+                    rows = [readExpHeader(f) for f in toRead]
+
+            conn.executemany(
+                "delete from exps where filename=?", [(f,) for f in removed]
+            )
+            # re-read exposures start without a dither file, resolved below
+            conn.executemany(
+                "insert or replace into exps (%s) values (%s)"%(
+                    ", ".join('"%s"'%col for col in EXP_COLUMNS),
+                    ", ".join("?" * len(EXP_COLUMNS))
+                ),
+                [tuple(row.get(col) for col in EXP_COLUMNS) for row in rows]
+            )
+
+            missing = conn.execute(
+                "select filename, instrument, camera, expNum from exps where ditherFile is null"
+            ).fetchall()
+            if len(missing) > 0:
+                dithers = self.ditherFiles()
+                conn.executemany(
+                    "update exps set ditherFile=? where filename=?",
+                    [
+                        (dithers[(inst, cam, num)], f)
+                        for f, inst, cam, num in missing
+                        if (inst, cam, num) in dithers
+                    ]
+                )
+            conn.execute("commit")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("rollback")
+            raise
+        finally:
+            conn.close()
+        return len(toRead)
+
+    def query(self, configid=None, instrument=None, imageType=None, cameras=None):
+        """ return catalog rows as a DataFrame ordered by exposure number,
+        optionally filtered (cameras is a list, eg ["r1", "r2"])
+        """
+        conn = self._connect()
+        if not self._hasTable(conn):
+            conn.close()
+            return pandas.DataFrame()
+        where = []
+        args = []
+        for col, val in [("configid", configid), ("instrument", instrument), ("imageType", imageType)]:
+            if val is not None:
+                where.append("%s=?"%col)
+                args.append(int(val) if col == "configid" else val)
+        if cameras is not None:
+            where.append("camera in (%s)"%", ".join("?" * len(cameras)))
+            args.extend(cameras)
+        sql = "select * from exps"
+        if len(where) > 0:
+            sql += " where " + " and ".join(where)
+        sql += " order by expNum, camera"
+        df = pandas.read_sql(sql, conn, params=args)
+        conn.close()
+        return df
+
+
+def catalogMJDs(site, mjds, nProcs=8):
+    """ build or refresh the catalog for a list of mjds
+    """
+    for mjd in mjds:
+        nRead = ExpCatalog(site, mjd).update(nProcs)
+        print(site, mjd, "read", nRead, "headers")
+
+
+if __name__ == "__main__":
+    import sys
+    # python expCatalog.py apo 59843 59844 ...
+    catalogMJDs(sys.argv[1], [int(x) for x in sys.argv[2:]])
@@ -0,0 +1,129 @@
+import re
+from collections import OrderedDict
+import numpy
+
+
+# same numpy types pydl's yanny uses (char is S<n>)
+YANNY_DTYPES = {"short": "i2", "int": "i4", "long": "i8", "float": "f4", "double": "f8"}
+
+_typedefRE = re.compile(r"typedef\s+struct\s*\{([^}]+)\}\s*(\w*)\s*;")
+_enumRE = re.compile(r"typedef\s+enum\s*\{[^}]+\}\s*\w+\s*;")
+_declRE = re.compile(r"(\S+)\s+(\w+)((?:[\[<]\d*[\]>])*)\s*;")
+_dimRE = re.compile(r"[\[<](\d*)[\]>]")
+_doubleBracesRE = re.compile(r"\{\s*\{\s*\}\s*\}")
+# a quoted string (possibly empty) or a bare word, braces are dropped so
+# array elements come out as consecutive tokens
+_tokenRE = re.compile(r'"([^"]*)"|([^\s{}"]+)')
+_quotedRE = re.compile(r'"[^"]*"')
+_splitUnsafeRE = re.compile(r'[\s{}]')
+
+
+def _trailingComment(line):
+    # same rule as yanny.trailing_comment
+    lastmark = line.rfind("#")
+    if lastmark >= 0 and line[lastmark:].count('"') % 2 == 0:
+        return line[:lastmark].rstrip()
+    return line
+
+
+def _parseTypedef(body):
+    """ returns list of (column, base type, array length or None, char
+    length or None) for a struct definition body
+    """
+    columns = []
+    for typ, name, dims in _declRE.findall(body):
+        dims = [int(d) if d else None for d in _dimRE.findall(dims)]
+        if typ == "char":
+            charLen = dims[-1] if len(dims) > 0 else None
+            arrLen = dims[0] if len(dims) > 1 else None
+        else:
+            charLen = None
+            arrLen = dims[0] if len(dims) > 0 else None
+        columns.append((name, typ, arrLen, charLen))
+    return columns
+
+
+def readYanny(filename):
+    """ read a yanny parameter file (eg confSummary) straight into typed
+    numpy columns.  Matches pydl's yanny for the files we read: pair values
+    are the raw remainder of the line, struct columns use the same dtypes
+    (char as fixed width bytes).  Enums are not supported.
+
+    Returns
+    ---------
+    pairs : OrderedDict
+        keyword: value string
+    tables : OrderedDict
+        struct name (upper case): OrderedDict of column: numpy.ndarray
+    """
+    with open(filename, "r") as f:
+        contents = f.read()
+    contents = re.sub(r"\\\s*\n", " ", contents)
+    if _enumRE.search(contents) is not None:
+        raise NotImplementedError("%s: enum types not supported"%filename)
+
+    structs = OrderedDict()
+    for body, name in _typedefRE.findall(contents):
+        structs[name.upper()] = _parseTypedef(body)
+    contents = _typedefRE.sub("", contents)
+
+    pairs = OrderedDict()
+    rows = OrderedDict((name, []) for name in structs.keys())
+    for line in contents.split("\n"):
+        line = line.strip()
+        if len(line) == 0 or line[0] == "#":
+            continue
+        if "#" in line:
+            line = _trailingComment(line)
+        parts = line.split(None, 1)
+        key = parts[0]
+        if key.upper() in rows:
+            rows[key.upper()].append(parts[1] if len(parts) > 1 else "")
+        else:
+            value = parts[1] if len(parts) > 1 else ""
+            pairs[key] = _doubleBracesRE.sub('""', value)
+
+    tables = OrderedDict()
+    for name, columns in structs.items():
+        tables[name] = _parseRows(filename, name, columns, rows[name])
+    return pairs, tables
+
+
+def _parseRows(filename, name, columns, rows):
+    widths = [1 if arrLen is None else arrLen for col, typ, arrLen, charLen in columns]
+    rowWidth = sum(widths)
+    block = _doubleBracesRE.sub('""', "\n".join(rows))
+    quoted = "".join(_quotedRE.findall(block))
+    if _splitUnsafeRE.search(quoted) is None:
+        # no quoted string holds whitespace or braces, so a plain split
+        # tokenizes (quotes are stripped from char columns below)
+        tokens = block.replace("{", " ").replace("}", " ").split()
+        stripQuotes = len(quoted) > 0
+    else:
+        tokens = [q or w for q, w in _tokenRE.findall(block)]
+        stripQuotes = False
+    nRows = len(rows)
+    if len(tokens) != nRows * rowWidth:
+        raise ValueError(
+            "%s: %i tokens for %i %s rows of %i values"%(filename, len(tokens), nRows, name, rowWidth)
+        )
+
+    table = OrderedDict()
+    start = 0
+    for (col, typ, arrLen, charLen), width in zip(columns, widths):
+        colTokens = [tokens[start + ii::rowWidth] for ii in range(width)]
+        if typ == "char":
+            if stripQuotes:
+                colTokens = [[t.strip('"') for t in ct] for ct in colTokens]
+            if charLen is None:
+                # char[] is as wide as the longest string
+                charLen = max([len(t) for ct in colTokens for t in ct] + [1])
+            dtype = "S%i"%charLen
+        else:
+            dtype = YANNY_DTYPES[typ]
+        if arrLen is None:
+            table[col] = numpy.array(colTokens[0], dtype=dtype)
+        else:
+            table[col] = numpy.array(colTokens, dtype=dtype).T.reshape(nRows, arrLen)
+        start += width
+    return table
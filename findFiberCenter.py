@@ -1,7 +1,9 @@
 import numpy
 from scipy.integrate import dblquad
+from scipy.special import chndtr, i0e, i1e
 from functools import partial
-from scipy.optimize import minimize
+from scipy.optimize import minimize, least_squares
+from scipy.sparse import csr_matrix
 import pandas
 import glob
 import matplotlib.pyplot as plt
@@ -11,6 +13,9 @@ import time
 from multiprocessing import Pool
 import matplotlib as mpl
 import os
+import json
+import hashlib
+import traceback
 
 mpl.rcParams['mathtext.fontset'] = 'stix'
 mpl.rcParams['font.family'] = 'STIXGeneral'
@@ -19,6 +24,17 @@ cpMap = sns.color_palette("flare_r", as_cmap=True)
 
 FIBER_RAD = 60/1000 # mm
 MM_PER_AS = PLATE_SCALE["APO"] / 3600. # mm/arcsec
+STAGE1_STORE = "stage1/results" # resultStore dataset, else stage1/configImgNum csvs
+SCRAPE_PATH = "holtzScrape.csv"
+MERGED_PATH = "holtzScrapeMerged.parquet" # written by mergeDithers
+# fitOneSetLSQ run statistics kept per group by fitAll
+FIT_INFO_COLUMNS = ["ampErr", "sigmaErr", "fibxErr", "fibyErr", "rms", "nfev"]
+# per fiber output of fitConfiguration
+CONFIG_FIBER_COLUMNS = [
+    "positionerId", "configID", "nDither", "fitAmp", "fitSigma",
+    "fitFiberX", "fitFiberY", "fitDx", "fitDy", "ampErr", "fibxErr", "fibyErr",
+    "fitDxGlobal", "fitDyGlobal", "status"
+]
 
 
 def bivariateGaussian(x, y, amp, sigma, starx, stary, fibx, fiby):
@@ -40,21 +56,156 @@ def fractionalFlux(amp, sigma, starx, stary, fibx, fiby):
     return A
 
 
+# set with useEETable to evaluate apertureFlux from a precomputed table
+EE_TABLE = None
+
+
+def useEETable(path=None, **kwargs):
+    """ evaluate apertureFlux (and so every fit and contour) from an
+    eeTable.EETable rather than chndtr.  None uses eeTable.EE_TABLE_PATH,
+    kwargs are passed to EETable.  Returns the table.
+    """
+    import eeTable
+    global EE_TABLE
+    if path is None:
+        path = eeTable.EE_TABLE_PATH
+    EE_TABLE = eeTable.EETable(path=path, **kwargs)
+    print("using encircled energy table, error bound %.1e*amp"%EE_TABLE.errBound)
+    return EE_TABLE
+
+
+def apertureFlux(amp, sigma, starx, stary, fibx, fiby):
+    """Closed form replacement for fractionalFlux, vectorized over any
+    (broadcastable) array inputs.
+
+    The flux of a circular gaussian (sigma) falling in a fiber of radius
+    FIBER_RAD whose center is offset from the star by d is
+
+        amp * P(X <= (FIBER_RAD/sigma)**2),  X ~ ncx2(df=2, nc=(d/sigma)**2)
+
+    (equivalently amp * (1 - Q_1(d/sigma, FIBER_RAD/sigma)), Q_1 being the
+    Marcum Q function).  Agrees with the dblquad integration in
+    fractionalFlux to better than 1e-12*amp over the range of sigmas and
+    offsets encountered in dither fits (|d|, sigma < 0.2 mm).
+
+    If useEETable was called the fraction is interpolated from EE_TABLE
+    instead (within EE_TABLE.errBound*amp).
+    """
+    sigma2 = numpy.asarray(sigma, dtype=numpy.float64)**2
+    dx = numpy.asarray(starx, dtype=numpy.float64) - fibx
+    dy = numpy.asarray(stary, dtype=numpy.float64) - fiby
+    nc = (dx**2 + dy**2) / sigma2
+    if EE_TABLE is not None:
+        return amp * EE_TABLE(numpy.sqrt(nc), FIBER_RAD / numpy.sqrt(sigma2))
+    return amp * chndtr(FIBER_RAD**2 / sigma2, 2, nc)
+
+
+def apertureFluxJac(amp, sigma, starx, stary, fibx, fiby):
+    """Analytic derivatives of apertureFlux with respect to (amp, sigma,
+    fibx, fiby), returned as an (n, 4) array for n star positions.
+
+    With a = d/sigma and b = FIBER_RAD/sigma the enclosed fraction is
+    P = 1 - Q_1(a, b) and
+
+        dP/db = b exp(-(a**2+b**2)/2) I_0(ab)
+        dP/da = -b exp(-(a**2+b**2)/2) I_1(ab)
+
+    evaluated with exponentially scaled Bessel functions
+    (exp(-(a**2+b**2)/2) I_k(ab) = exp(-(a-b)**2/2) ike(ab)).
+    """
+    starx = numpy.atleast_1d(numpy.asarray(starx, dtype=numpy.float64))
+    stary = numpy.atleast_1d(numpy.asarray(stary, dtype=numpy.float64))
+    dx = starx - fibx
+    dy = stary - fiby
+    a = numpy.sqrt(dx**2 + dy**2) / sigma
+    b = FIBER_RAD / sigma
+    ab = a * b
+    expFac = numpy.exp(-0.5*(a - b)**2)
+    eI0 = expFac * i0e(ab)
+    eI1 = expFac * i1e(ab)
+    # eI1/a, finite as d -> 0 (I_1(x) ~ x/2)
+    eI1OverA = numpy.where(a > 1e-8, eI1 / numpy.where(a > 1e-8, a, 1), 0.5 * b * expFac)
+
+    jac = numpy.zeros((len(dx), 4))
+    jac[:, 0] = chndtr(b**2, 2, a**2)
+    jac[:, 1] = amp * (b * a * eI1 - b**2 * eI0) / sigma
+    jac[:, 2] = amp * b * eI1OverA * dx / sigma**2
+    jac[:, 3] = amp * b * eI1OverA * dy / sigma**2
+    return jac
+
+
+def fitOneSetLSQ(starx, stary, flux, sigma, fitSigma=True, fluxErr=None):
+    """ least squares fit of apertureFlux to the dither fluxes using the
+    residuals and the analytic Jacobian (apertureFluxJac).  Same starting
+    point as fitOneSet.  If fluxErr is given residuals are weighted by
+    1/fluxErr.
+
+    Returns
+    ---------
+    fitAmp, fitSigma, fitFiberX, fitFiberY : float
+        best fit (fitSigma is sigma if not fitSigma)
+    info : dict
+        cov (parameter covariance in amp, sigma, fibx, fiby order, sigma
+        row/column zero if not fit), ampErr, sigmaErr, fibxErr, fibyErr,
+        rms (flux residual), chi2, dof, nfev, njev, status, message
+    """
+    starx = numpy.asarray(starx, dtype=numpy.float64)
+    stary = numpy.asarray(stary, dtype=numpy.float64)
+    flux = numpy.asarray(flux, dtype=numpy.float64)
+    if fluxErr is None:
+        weight = numpy.ones(len(flux))
+    else:
+        weight = 1 / numpy.asarray(fluxErr, dtype=numpy.float64)
+
+    amaxFlux = numpy.argmax(flux)
+    fitCols = [0, 1, 2, 3] if fitSigma else [0, 2, 3]
+    xFull = numpy.array([flux[amaxFlux], sigma, starx[amaxFlux], stary[amaxFlux]])
+
+    def expand(x):
+        _x = xFull.copy()
+        _x[fitCols] = x
+        return _x
+
+    def residuals(x):
+        amp, _sigma, fibx, fiby = expand(x)
+        return weight * (apertureFlux(amp, _sigma, starx, stary, fibx, fiby) - flux)
+
+    def jacobian(x):
+        amp, _sigma, fibx, fiby = expand(x)
+        return weight[:, None] * apertureFluxJac(amp, _sigma, starx, stary, fibx, fiby)[:, fitCols]
+
+    lower = numpy.array([0, 1e-4, -numpy.inf, -numpy.inf])[fitCols]
+    x0 = numpy.clip(xFull[fitCols], lower + 1e-12, numpy.inf)
+    out = least_squares(residuals, x0, jac=jacobian, bounds=(lower, numpy.inf), method="trf", x_scale="jac")
+
+    fitAmp, fitSigma, fitFiberX, fitFiberY = expand(out.x)
+    dof = len(flux) - len(fitCols)
+    chi2 = numpy.sum(out.fun**2)
+    # scale by the reduced chi2 unless real flux errors were given
+    resVar = 1 if fluxErr is not None else chi2 / max(dof, 1)
+    _cov = numpy.linalg.pinv(out.jac.T @ out.jac) * resVar
+    cov = numpy.zeros((4, 4))
+    cov[numpy.ix_(fitCols, fitCols)] = _cov
+    errs = numpy.sqrt(numpy.diag(cov))
+    info = {
+        "cov": cov,
+        "ampErr": errs[0], "sigmaErr": errs[1], "fibxErr": errs[2], "fibyErr": errs[3],
+        "rms": numpy.sqrt(numpy.mean((out.fun / weight)**2)),
+        "chi2": chi2, "dof": dof, "nfev": out.nfev, "njev": out.njev,
+        "status": out.status, "message": out.message,
+    }
+    return fitAmp, fitSigma, fitFiberX, fitFiberY, info
+
+
 def minimizeMe1(x, starx, stary, flux):
     amp, sigma, fibx, fiby = x
-    fHats = []
-    for _xs,_ys in zip(starx, stary):
-        fHats.append(fractionalFlux(amp, sigma, _xs, _ys, fibx, fiby))
-    fHats = numpy.array(fHats)
+    fHats = apertureFlux(amp, sigma, starx, stary, fibx, fiby)
     return numpy.mean((fHats-flux)**2)
 
 
 def minimizeMe2(x, sigma, starx, stary, flux):
     amp, fibx, fiby = x
-    fHats = []
-    for _xs,_ys in zip(starx, stary):
-        fHats.append(fractionalFlux(amp, sigma, _xs, _ys, fibx, fiby))
-    fHats = numpy.array(fHats)
+    fHats = apertureFlux(amp, sigma, starx, stary, fibx, fiby)
     return numpy.mean((fHats-flux)**2)
 
 
@@ -73,6 +224,9 @@ def weightedCenter(starx, stary, flux):
 
 
 def fitOneSet(starx, stary, flux, sigma, fitSigma=False, method="Powell"):
+    # method "lsq" uses fitOneSetLSQ, anything else is a scipy minimize method
+    if method == "lsq":
+        return fitOneSetLSQ(starx, stary, flux, sigma, fitSigma=fitSigma)[:4]
     # initial guess for fitter pick spot with most flux
     amaxFlux = numpy.argmax(flux)
     ampInit = flux[amaxFlux]
@@ -106,12 +260,9 @@ def plotContour(ax, xStar, yStar, sigma, amp, xMin=-.17, xMax=.17, yMin=-.17, yM
     x = numpy.linspace(xMin, xMax, npts)
     y = numpy.linspace(yMin, yMax, npts)
     xx, yy = numpy.meshgrid(x,y)
-    g = []
 
     tstart = time.time()
-    for _xx, _yy in zip(xx.flatten(),yy.flatten()):
-        g.append(fractionalFlux(amp, sigma, _xx, _yy, xStar, yStar))
-    g = numpy.array(g).reshape(npts,npts)
+    g = apertureFlux(amp, sigma, xx, yy, xStar, yStar)
     vmax=numpy.max(g)
     vmin=numpy.min(g)
     ax.contourf(x, y, g, levels=75, vmin=vmin, vmax=vmax, cmap=cpMap)
@@ -126,8 +277,7 @@ def fitOne(posIdConfigID, returnVals=False):
     try:
         os.nice(5)
 
-        df = pandas.read_csv("holtzScrapeMerged.csv")
-        df = df[(df.positionerId==positionerId)&(df.configID==configID)]
+        df = loadMerged([configID], [positionerId])
         # make sure we actually have dithers to fit!
         if len(df) < 5:
             return
@@ -149,24 +299,370 @@ def fitOne(posIdConfigID, returnVals=False):
         print(positionerId, configID, "fit failed")
 
 
-def fitAll():
-    df = pandas.read_csv("holtzScrapeMerged.csv")
-
-    _posIdConfigID = []
-    confList = list(set(df.configID))
-    for conf in confList:
-        _df = df[df.configID==conf]
-        posList = list(set(_df.positionerId))
-        for posId in posList:
-            _posIdConfigID.append([posId,conf])
-
-    p = Pool(30)
-    p.map(fitOne, _posIdConfigID)
-    p.close()
-
+def groupDithers(df, minPoints=5):
+    """ split a merged dither table into one task per (positionerId,
+    configID) with only the arrays the fit needs.  The table is sorted
+    once on the keys and cut at the group boundaries rather than masked
+    per group.
+
+    Returns
+    ---------
+    tasks : list
+        (positionerId, configID, xstar, ystar, flux, sigma) for groups with
+        at least minPoints dithers
+    skipped : list
+        (positionerId, configID, nDither) for groups with fewer
+    """
+    df = df.sort_values(["positionerId", "configID"], kind="stable")
+    posIds = df.positionerId.to_numpy()
+    configIDs = df.configID.to_numpy()
+    xstar = df.xOff.to_numpy(dtype=float)
+    ystar = df.yOff.to_numpy(dtype=float)
+    flux = df.spectroflux.to_numpy(dtype=float)
+    sigmaGFA = df.sigmaGFA.to_numpy(dtype=float)
+
+    newGroup = (posIds[1:] != posIds[:-1]) | (configIDs[1:] != configIDs[:-1])
+    starts = numpy.concatenate([[0], numpy.flatnonzero(newGroup) + 1])
+    ends = numpy.concatenate([starts[1:], [len(df)]])
+
+    tasks = []
+    skipped = []
+    for start, end in zip(starts, ends):
+        key = (int(posIds[start]), int(configIDs[start]))
+        if end - start < minPoints:
+            skipped.append(key + (int(end - start),))
+            continue
+        tasks.append(key + (
+            xstar[start:end], ystar[start:end], flux[start:end],
+            numpy.median(sigmaGFA[start:end])
+        ))
+    return tasks, skipped
+
+
+def fitGroups(tasks):
+    """ fit a chunk of groupDithers tasks (runs in a worker), a failed fit
+    is returned as a row with status "failed" and its traceback
+    """
+    os.nice(5)
+    rows = []
+    for positionerId, configID, xstar, ystar, flux, sigma in tasks:
+        row = {
+            "positionerId": positionerId, "configID": configID,
+            "nDither": len(flux), "sigmaGFA": sigma,
+            "fitAmp": numpy.nan, "fitSigma": numpy.nan,
+            "fitFiberX": numpy.nan, "fitFiberY": numpy.nan,
+            "status": "ok", "error": "",
+        }
+        try:
+            fitAmp, fitSigma, fitFiberX, fitFiberY, info = fitOneSetLSQ(xstar, ystar, flux, sigma)
+            row.update({
+                "fitAmp": fitAmp, "fitSigma": fitSigma,
+                "fitFiberX": fitFiberX, "fitFiberY": fitFiberY,
+            })
+            for key in FIT_INFO_COLUMNS:
+                row[key] = info[key]
+        except Exception:
+            row["status"] = "failed"
+            row["error"] = traceback.format_exc()
+        rows.append(row)
+    return rows
+
+
+def fitAll(mergedPath=MERGED_PATH, outFile="fitPositioners.csv", nProcs=30, chunkSize=50, minPoints=5):
+    """ fit every (positionerId, configID) in the merged dither table
+    (see loadMerged).  The table is read once and workers get chunks of
+    per group arrays.
+
+    All fits go to one table (outFile) with a row per group: the fit
+    parameters (fitOneSetLSQ) and their errors, rms, nfev, nDither,
+    sigmaGFA and status ("ok", "failed" with the
+    traceback in error, or "tooFew" for groups under minPoints dithers).
+    Merge it back onto the dither table on positionerId and configID for
+    per dither rows.
+    """
+    df = loadMerged(
+        columns=["positionerId", "configID", "xOff", "yOff", "spectroflux", "sigmaGFA"],
+        path=mergedPath
+    )
+    tasks, skipped = groupDithers(df, minPoints)
+    chunks = [tasks[ii:ii + chunkSize] for ii in range(0, len(tasks), chunkSize)]
+
+    rows = []
+    if nProcs > 1 and len(chunks) > 1:
+        p = Pool(nProcs)
+        for _rows in p.imap_unordered(fitGroups, chunks):
+            rows.extend(_rows)
+        p.close()
+    else:
+        for chunk in chunks:
+            rows.extend(fitGroups(chunk))
+    for positionerId, configID, nDither in skipped:
+        rows.append({
+            "positionerId": positionerId, "configID": configID,
+            "nDither": nDither, "status": "tooFew", "error": "",
+        })
+
+    fits = pandas.DataFrame(rows).sort_values(["positionerId", "configID"]).reset_index(drop=True)
+    fits.to_csv(outFile, index=False)
+    nFailed = numpy.sum(fits.status == "failed")
+    print("fit %i groups, %i failed, %i with too few dithers"%(len(tasks), nFailed, len(skipped)))
+    return fits
+
+
+def fitConfiguration(df, minPoints=5, perExposureSigma=True):
+    """ fit every fiber of one configuration at once: per fiber amp and
+    position plus a seeing sigma shared by all fibers (one per science
+    exposure if perExposureSigma, else one for the configuration).  The
+    global offset (fitDxGlobal, fitDyGlobal) is the mean fiber position
+    and fitDx/fitDy are each fiber's offset from it.
+
+    Each dither only touches its fiber's 3 parameters and its sigma, so the
+    Jacobian is sparse and solved iteratively (lsmr), and the covariance is
+    found from the per fiber 3x3 blocks and a Schur complement on the
+    sigmas.  Cost is linear in the number of fibers.
+
+    Parameters
+    ------------
+    df : pandas.DataFrame
+        merged dithers of one configID (see loadMerged) with positionerId,
+        sciImgNum, xOff, yOff, spectroflux and sigmaGFA
+    minPoints : int
+        fibers with fewer dithers are left out (status "tooFew")
+
+    Returns
+    ---------
+    fibers : pandas.DataFrame
+        one row per fiber, columns as fitAll plus fitDx, fitDy, errors and
+        the global offset
+    summary : dict
+        configID, nFibers, nDither, sigma (per exposure) and sigmaErr,
+        fitDxGlobal/fitDyGlobal and errors, rms, chi2, dof, nfev, status
+        ("ok", or "tooFew" with no fit if no fiber has minPoints dithers),
+        lsqStatus, fitTime
+    """
+    tstart = time.time()
+    configID = int(df.configID.iloc[0])
+    nDither = df.groupby("positionerId").size()
+    keepPos = nDither.index[nDither >= minPoints]
+    tooFew = nDither.index[nDither < minPoints]
+    df = df[df.positionerId.isin(keepPos)].sort_values(["positionerId", "sciImgNum"], kind="stable")
+    tooFewFibers = pandas.DataFrame({
+        "positionerId": numpy.asarray(tooFew), "configID": configID,
+        "nDither": nDither[tooFew].to_numpy(), "status": "tooFew",
+    })
+    if len(keepPos) == 0:
+        # nothing to fit
+        fibers = tooFewFibers.reindex(columns=CONFIG_FIBER_COLUMNS)
+        summary = {
+            "configID": configID, "nFibers": 0, "nDither": 0,
+            "status": "tooFew", "fitTime": time.time() - tstart,
+        }
+        return fibers, summary
+
+    fi, posIds = pandas.factorize(df.positionerId, sort=True)
+    if perExposureSigma:
+        ei, expNums = pandas.factorize(df.sciImgNum, sort=True)
+    else:
+        ei = numpy.zeros(len(df), dtype=int)
+        expNums = numpy.array([-1])
+    nF = len(posIds)
+    nE = len(expNums)
+    nObs = len(df)
+    xstar = df.xOff.to_numpy(dtype=float)
+    ystar = df.yOff.to_numpy(dtype=float)
+    flux = df.spectroflux.to_numpy(dtype=float)
+
+    # same starting point as fitOneSet, per fiber
+    imax = df.reset_index(drop=True).groupby(fi).spectroflux.idxmax().to_numpy()
+    sigmaInit = df.groupby(ei).sigmaGFA.median().to_numpy()
+    x0 = numpy.concatenate([flux[imax], xstar[imax], ystar[imax], sigmaInit])
+    # fibers stay within a fiber radius of their dither pattern, far
+    # outside it the flux (and gradient) vanishes and a shared trust
+    # region step can strand them
+    lower = numpy.concatenate([
+        numpy.zeros(nF),
+        pandas.Series(xstar).groupby(fi).min().to_numpy() - FIBER_RAD,
+        pandas.Series(ystar).groupby(fi).min().to_numpy() - FIBER_RAD,
+        numpy.full(nE, 1e-4)
+    ])
+    upper = numpy.concatenate([
+        numpy.full(nF, numpy.inf),
+        pandas.Series(xstar).groupby(fi).max().to_numpy() + FIBER_RAD,
+        pandas.Series(ystar).groupby(fi).max().to_numpy() + FIBER_RAD,
+        numpy.full(nE, numpy.inf)
+    ])
+    x0 = numpy.clip(x0, lower + 1e-12, upper - 1e-12)
+
+    rows = numpy.repeat(numpy.arange(nObs), 4)
+    cols = numpy.column_stack([fi, nF + fi, 2*nF + fi, 3*nF + ei]).flatten()
+
+    def unpack(x):
+        return x[:nF], x[nF:2*nF], x[2*nF:3*nF], x[3*nF:]
+
+    def residuals(x):
+        amp, px, py, sigma = unpack(x)
+        return apertureFlux(amp[fi], sigma[ei], xstar, ystar, px[fi], py[fi]) - flux
+
+    def jacobian(x):
+        amp, px, py, sigma = unpack(x)
+        jac = apertureFluxJac(amp[fi], sigma[ei], xstar, ystar, px[fi], py[fi])
+        # reorder apertureFluxJac's (amp, sigma, fibx, fiby) to our columns
+        jac = jac[:, [0, 2, 3, 1]]
+        return csr_matrix((jac.flatten(), (rows, cols)), shape=(nObs, 3*nF + nE))
+
+    out = least_squares(
+        residuals, x0, jac=jacobian, bounds=(lower, upper), method="trf",
+        x_scale="jac", tr_solver="lsmr"
+    )
+    amp, px, py, sigma = unpack(out.x)
+
+    # covariance, J^T J = [[A, B], [B^T, C]] with A block diagonal (3x3 per
+    # fiber in amp, px, py) and C diagonal (sigmas)
+    jac = apertureFluxJac(amp[fi], sigma[ei], xstar, ystar, px[fi], py[fi])
+    jFib = jac[:, [0, 2, 3]]
+    jSig = jac[:, 1]
+    A = numpy.zeros((nF, 3, 3))
+    numpy.add.at(A, fi, jFib[:, :, None] * jFib[:, None, :])
+    B = numpy.zeros((nF, 3, nE))
+    numpy.add.at(B, (fi, slice(None), ei), jFib * jSig[:, None])
+    C = numpy.bincount(ei, weights=jSig**2, minlength=nE)
+    Ainv = numpy.linalg.pinv(A)
+    AinvB = Ainv @ B
+    Sinv = numpy.linalg.pinv(numpy.diag(C) - numpy.einsum("fik,fil->kl", B, AinvB))
+    dof = nObs - len(out.x)
+    chi2 = numpy.sum(out.fun**2)
+    resVar = chi2 / max(dof, 1)
+    covFib = (Ainv + AinvB @ Sinv @ AinvB.transpose(0, 2, 1)) * resVar
+    fibErr = numpy.sqrt(numpy.maximum(numpy.diagonal(covFib, axis1=1, axis2=2), 0))
+    sigmaErr = numpy.sqrt(numpy.maximum(numpy.diag(Sinv) * resVar, 0))
+
+    # global offset is the mean fiber position, its variance sums the
+    # (correlated through the sigmas) fiber position covariances
+    globalErr = []
+    for ii in [1, 2]:
+        v = AinvB[:, ii, :].sum(axis=0)
+        var = (Ainv[:, ii, ii].sum() + v @ Sinv @ v) * resVar / nF**2
+        globalErr.append(numpy.sqrt(max(var, 0)))
+    dxGlobal = numpy.mean(px)
+    dyGlobal = numpy.mean(py)
+
+    fibers = pandas.DataFrame({
+        "positionerId": numpy.asarray(posIds), "configID": configID,
+        "nDither": numpy.bincount(fi, minlength=nF),
+        "fitAmp": amp, "fitSigma": numpy.median(sigma),
+        "fitFiberX": px, "fitFiberY": py,
+        "fitDx": px - dxGlobal, "fitDy": py - dyGlobal,
+        "ampErr": fibErr[:, 0], "fibxErr": fibErr[:, 1], "fibyErr": fibErr[:, 2],
+        "fitDxGlobal": dxGlobal, "fitDyGlobal": dyGlobal,
+        "status": "ok",
+    })
+    if len(tooFew) > 0:
+        fibers = pandas.concat([fibers, tooFewFibers], ignore_index=True)
+
+    summary = {
+        "configID": configID, "nFibers": nF, "nDither": nObs,
+        "sciImgNum": list(expNums), "sigma": list(sigma), "sigmaErr": list(sigmaErr),
+        "fitDxGlobal": dxGlobal, "fitDyGlobal": dyGlobal,
+        "fitDxGlobalErr": globalErr[0], "fitDyGlobalErr": globalErr[1],
+        "rms": numpy.sqrt(numpy.mean(out.fun**2)), "chi2": chi2, "dof": dof,
+        "nfev": out.nfev, "status": "ok", "lsqStatus": out.status,
+        "fitTime": time.time() - tstart,
+    }
+    return fibers, summary
+
+
+def _fitConfigurationTask(args):
+    # fitConfiguration in a worker, failures are returned not raised
+    configID, df, minPoints, perExposureSigma = args
+    os.nice(5)
+    try:
+        fibers, summary = fitConfiguration(df, minPoints, perExposureSigma)
+        summary["error"] = ""
+    except Exception:
+        fibers = None
+        summary = {"configID": configID, "status": "failed", "error": traceback.format_exc()}
+    return fibers, summary
+
+
+def fitAllConfigurations(
+    mergedPath=MERGED_PATH, outFile="fitConfigurations.csv",
+    summaryFile="fitConfigurationSummary.csv", nProcs=30, minPoints=5,
+    perExposureSigma=True
+):
+    """ fitConfiguration for every configID in the merged dither table,
+    one task per configuration.  Fiber results go to outFile, one row per
+    configuration (sigmas, global offset, fit statistics, or the traceback
+    of a failure) to summaryFile.
+    """
+    df = loadMerged(
+        columns=["positionerId", "configID", "sciImgNum", "xOff", "yOff", "spectroflux", "sigmaGFA"],
+        path=mergedPath
+    )
+    tasks = [
+        (configID, _df, minPoints, perExposureSigma)
+        for configID, _df in df.groupby("configID", sort=True)
+    ]
+    if nProcs > 1 and len(tasks) > 1:
+        p = Pool(nProcs)
+        results = p.map(_fitConfigurationTask, tasks)
+        p.close()
+    else:
+        results = [_fitConfigurationTask(task) for task in tasks]
 
-def testOne(TEST_ROBOT, TEST_CONFIG, ax1, ax2,xaxis=True,yaxis=True):
-    hc = pandas.read_csv("holtzScrape.csv")
+    fibers = [f for f, s in results if f is not None]
+    if len(fibers) > 0:
+        fibers = pandas.concat(fibers, ignore_index=True)
+    else:
+        # nothing fit (every configuration failed, or no input)
+        fibers = pandas.DataFrame(columns=CONFIG_FIBER_COLUMNS)
+    summary = pandas.DataFrame([s for f, s in results])
+    fibers.to_csv(outFile, index=False)
+    summary.to_csv(summaryFile, index=False)
+    nFailed = numpy.sum(summary.status == "failed") if len(summary) > 0 else 0
+    nTooFew = numpy.sum(summary.status == "tooFew") if len(summary) > 0 else 0
+    print("fit %i configurations, %i failed, %i too few dithers"%(len(summary), nFailed, nTooFew))
+    return fibers, summary
+
+
+def _mergeInputs(scrapePath):
+    if os.path.exists(STAGE1_STORE):
+        stage1 = glob.glob(os.path.join(STAGE1_STORE, "dither", "**", "*.parquet"), recursive=True)
+    else:
+        stage1 = glob.glob("stage1/configImgNum/dither*.csv")
+    return [scrapePath] + sorted(stage1)
+
+
+def _inputsHash(files):
+    # digest of (name, size, mtime) of every input
+    stats = []
+    for f in files:
+        st = os.stat(f)
+        stats.append((f, st.st_size, st.st_mtime))
+    return hashlib.sha1(json.dumps(stats).encode()).hexdigest()
+
+
+def mergeDithers(scrapePath=SCRAPE_PATH, mergedPath=MERGED_PATH, force=False):
+    """ merge the holtz db scrape with the stage1 dither tables (from
+    STAGE1_STORE if it exists, else the stage1/configImgNum csvs) into a
+    parquet file sorted on (configID, positionerId).  Nothing is done if
+    the inputs (names, sizes and mtimes, hashed into the file's metadata)
+    are unchanged since the last merge, unless force.
+
+    Returns
+    ---------
+    bool
+        True if the merge was (re)built
+    """
+    import pyarrow
+    import pyarrow.parquet as pq
+
+    inputsHash = _inputsHash(_mergeInputs(scrapePath))
+    if not force and os.path.exists(mergedPath):
+        metadata = pq.read_schema(mergedPath).metadata or {}
+        if metadata.get(b"inputsHash") == inputsHash.encode():
+            return False
+
+    hc = pandas.read_csv(scrapePath)
     hc["configID"] = hc.configurationId
     # convert cherno offsets to mm offsets
     xOff = hc.dChernoDec * MM_PER_AS
@@ -174,31 +670,48 @@ def testOne(TEST_ROBOT, TEST_CONFIG, ax1, ax2,xaxis=True,yaxis=True):
     hc["xOff"] = xOff
     hc["yOff"] = yOff
 
-    files = glob.glob("stage1/configImgNum/dither*.csv")
-
-    mc = pandas.concat([pandas.read_csv(x) for x in files])
+    if os.path.exists(STAGE1_STORE):
+        from resultStore import ResultStore
+        mc = ResultStore(STAGE1_STORE).read("dither")
+    else:
+        files = glob.glob("stage1/configImgNum/dither*.csv")
+        mc = pandas.concat([pandas.read_csv(x) for x in files])
     mc = mc.drop_duplicates()
     mc["fiberID"] = mc.fiberId
+    mc = mc[mc.configID.isin(set(hc.configID))]
 
-    validConfigs = list(set(hc.configID))
-    mc = mc[mc.configID.isin(validConfigs)]
-
-    # print("len before", len(hc))
-    _dfList = []
-    for config in validConfigs:
-        _a = hc[hc.configID==config].copy()
-        _b = mc[mc.configID==config]
-
-        # keep only fibers on target
-        sb = set(_b.fiberID)
-        _a = _a[_a.fiberID.isin(list(sb))]
-        _dfList.append(_a)
-
-    hc = pandas.concat(_dfList)
+    # inner merge keeps only fibers on target in each config
+    hc = hc.merge(mc, on=["configID", "sciImgNum", "fiberID"], suffixes=(None, "_mc"))
+    hc = hc.sort_values(["configID", "positionerId"], kind="stable")
+
+    table = pyarrow.Table.from_pandas(hc, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"inputsHash"] = inputsHash.encode()
+    table = table.replace_schema_metadata(metadata)
+    tmpPath = mergedPath + ".tmp%i"%os.getpid()
+    # row groups small enough that a config slice reads few of them
+    pq.write_table(table, tmpPath, row_group_size=20000, compression="zstd")
+    os.replace(tmpPath, mergedPath)
+    print("merged %i dithers to %s"%(len(hc), mergedPath))
+    return True
+
+
+def loadMerged(configIDs=None, positionerIds=None, columns=None, path=MERGED_PATH):
+    """ rows of the merged dither table (see mergeDithers, rerun here if
+    its inputs changed) for the given configIDs and positionerIds (None
+    for all), only the row groups holding them are read
+    """
+    mergeDithers(mergedPath=path)
+    filters = []
+    if configIDs is not None:
+        filters.append(("configID", "in", [int(x) for x in configIDs]))
+    if positionerIds is not None:
+        filters.append(("positionerId", "in", [int(x) for x in positionerIds]))
+    return pandas.read_parquet(path, columns=columns, filters=filters or None)
 
 
-    hc = hc.merge(mc, on=["configID", "sciImgNum", "fiberID"], suffixes=(None, "_mc"))
-    hc.to_csv("holtzScrapeMerged.csv", index=False)
+def testOne(TEST_ROBOT, TEST_CONFIG, ax1, ax2,xaxis=True,yaxis=True):
+    _hc = loadMerged([TEST_CONFIG], [TEST_ROBOT])
 
     # print("robot options", set(hc.positionerId))
 
@@ -207,8 +720,6 @@ def testOne(TEST_ROBOT, TEST_CONFIG, ax1, ax2,xaxis=True,yaxis=True):
 
     # plotFlux(TEST_ROBOT, TEST_CONFIG, hc)
 
-    _hc = hc[(hc.positionerId == TEST_ROBOT) & (hc.configID == TEST_CONFIG)]
-
     vmin = numpy.min(_hc.spectroflux.to_numpy())
     vmax = numpy.max(_hc.spectroflux.to_numpy())
     hueNorm = [vmin, vmax]
@@ -0,0 +1,347 @@
+import os
+import glob
+from collections import OrderedDict
+import numpy
+import pandas
+from astropy import units as u
+from astropy_healpix import HEALPix
+
+
+GAIA_CACHE_DIR = "/uufs/chpc.utah.edu/common/home/u0449727/work/gaiaCache"
+GAIA_CACHE_NSIDE = 64
+GAIA_CACHE_MAG_LIMIT = 18  # faintest g mag stored in the tiles
+FIELD_CACHE_DIR = GAIA_CACHE_DIR + "/fields"
+
+# columns kept in the tiles (and their on disk dtypes)
+GAIA_COLUMNS = OrderedDict([
+    ("source_id", numpy.int64),
+    ("ra", numpy.float64),
+    ("dec", numpy.float64),
+    ("pmra", numpy.float64),
+    ("pmdec", numpy.float64),
+    ("parallax", numpy.float64),
+    ("phot_g_mean_mag", numpy.float32),
+])
+
+
+def angSep(ra1, dec1, ra2, dec2):
+    """ angular separation in degrees (haversine), all inputs in degrees
+    """
+    ra1, dec1, ra2, dec2 = [numpy.radians(x) for x in (ra1, dec1, ra2, dec2)]
+    sdec = numpy.sin((dec2 - dec1) / 2)
+    sra = numpy.sin((ra2 - ra1) / 2)
+    a = sdec**2 + numpy.cos(dec1) * numpy.cos(dec2) * sra**2
+    return numpy.degrees(2 * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0, 1))))
+
+
+def radec2xyz(ra, dec):
+    """ unit vectors (n x 3) from ra, dec in degrees
+    """
+    ra = numpy.radians(numpy.atleast_1d(ra))
+    dec = numpy.radians(numpy.atleast_1d(dec))
+    cosDec = numpy.cos(dec)
+    return numpy.array([cosDec*numpy.cos(ra), cosDec*numpy.sin(ra), numpy.sin(dec)]).T
+
+
+def queryGaiaDB(raCen, decCen, radius, maxMag=GAIA_CACHE_MAG_LIMIT):
+    """ cone search against catalogdb.Gaia_DR2, returns a DataFrame with
+    GAIA_COLUMNS.  Imported lazily so the cache can be used offline.
+    """
+    import peewee
+    from sdssdb.peewee.sdss5db import database, catalogdb
+    database.set_profile("operations")
+    database.connect()
+    cols = [getattr(catalogdb.Gaia_DR2, col) for col in GAIA_COLUMNS.keys()]
+    results = catalogdb.Gaia_DR2.select(*cols).where(
+        (peewee.fn.q3c_radial_query(
+            catalogdb.Gaia_DR2.ra,
+            catalogdb.Gaia_DR2.dec,
+            raCen,
+            decCen,
+            radius)
+        ) & \
+        (catalogdb.Gaia_DR2.phot_g_mean_mag < maxMag)
+    )
+    df = pandas.DataFrame(list(results.dicts()), columns=list(GAIA_COLUMNS.keys()))
+    database.close()
+    return df
+
+
+class GaiaCache(object):
+    def __init__(
+        self, cacheDir=GAIA_CACHE_DIR, nside=GAIA_CACHE_NSIDE,
+        maxTilesInMemory=2000
+    ):
+        """
+        Local gaia catalog partitioned into nested HEALPix tiles, one
+        compressed numpy (.npz) file per tile holding only GAIA_COLUMNS.
+
+        Parameters
+        ------------------
+        cacheDir : string
+            directory holding the tiles
+        nside : int
+            HEALPix nside of the partitioning
+        maxTilesInMemory : int
+            number of loaded tiles to keep in memory (LRU)
+        """
+        self.cacheDir = cacheDir
+        self.nside = nside
+        self.hp = HEALPix(nside=nside, order="nested")
+        self.maxTilesInMemory = maxTilesInMemory
+        self._tiles = OrderedDict()
+        # max distance from a tile center to its boundary (padded a bit
+        # for edge curvature between the sampled boundary points)
+        allPix = numpy.arange(self.hp.npix)
+        ra, dec = self.hp.boundaries_lonlat(allPix, step=4)
+        raCen, decCen = self.hp.healpix_to_lonlat(allPix)
+        raCen = raCen.to(u.deg).value
+        decCen = decCen.to(u.deg).value
+        self.tileRadius = 1.02 * numpy.max(angSep(
+            raCen[:, None], decCen[:, None], ra.to(u.deg).value, dec.to(u.deg).value
+        ))
+        self._tileCenXYZ = radec2xyz(raCen, decCen)
+
+    def tilePath(self, pix):
+        return os.path.join(
+            self.cacheDir, "nside%i"%self.nside, "gaia-%i-%i.npz"%(self.nside, pix)
+        )
+
+    def builtTiles(self):
+        files = glob.glob(os.path.join(self.cacheDir, "nside%i"%self.nside, "gaia-*.npz"))
+        return sorted([int(f.split("-")[-1].split(".npz")[0]) for f in files])
+
+    def tilesForCone(self, raCen, decCen, radius):
+        """ tiles that may hold sources within radius of raCen, decCen:
+        any tile whose center is within radius + tileRadius
+        """
+        cenXYZ = radec2xyz(raCen, decCen)[0]
+        cosR = numpy.cos(numpy.radians(min(radius + self.tileRadius, 180)))
+        return numpy.flatnonzero(self._tileCenXYZ @ cenXYZ >= cosR)
+
+    def tileCenter(self, pix):
+        ra, dec = self.hp.healpix_to_lonlat([pix])
+        return ra.to(u.deg).value[0], dec.to(u.deg).value[0]
+
+    def _loadTile(self, pix):
+        if pix in self._tiles:
+            self._tiles.move_to_end(pix)
+            return self._tiles[pix]
+        path = self.tilePath(pix)
+        if not os.path.exists(path):
+            raise RuntimeError(
+                "gaia tile %i (nside %i) not built, see GaiaCache.buildFromDB"%(pix, self.nside)
+            )
+        with numpy.load(path) as npz:
+            tile = {col: npz[col] for col in GAIA_COLUMNS.keys()}
+            tile["magLimit"] = float(npz["magLimit"])
+        tile["xyz"] = radec2xyz(tile["ra"], tile["dec"]).reshape(-1, 3)
+        self._tiles[pix] = tile
+        if len(self._tiles) > self.maxTilesInMemory:
+            self._tiles.popitem(last=False)
+        return tile
+
+    def coneSearch(self, raCen, decCen, radius, maxMag=GAIA_CACHE_MAG_LIMIT):
+        """ same selection as the q3c_radial_query in procGimg.queryGaia:
+        sources within radius (degrees) of raCen, decCen with
+        phot_g_mean_mag < maxMag.
+
+        Returns
+        --------
+        pandas.DataFrame with GAIA_COLUMNS
+        """
+        tiles = [self._loadTile(pix) for pix in self.tilesForCone(raCen, decCen, radius)]
+        for tile in tiles:
+            if maxMag > tile["magLimit"]:
+                raise RuntimeError(
+                    "maxMag %.2f fainter than cache limit %.2f"%(maxMag, tile["magLimit"])
+                )
+
+        cenXYZ = radec2xyz(raCen, decCen)[0]
+        cosR = numpy.cos(numpy.radians(radius))
+        keeps = [
+            (tile["xyz"] @ cenXYZ >= cosR) & (tile["phot_g_mean_mag"] < maxMag)
+            for tile in tiles
+        ]
+        cols = {}
+        for col, dtype in GAIA_COLUMNS.items():
+            cols[col] = numpy.concatenate(
+                [tile[col][keep] for tile, keep in zip(tiles, keeps)] + \
+                [numpy.zeros(0, dtype=dtype)]
+            )
+        return pandas.DataFrame(cols)
+
+    def writeTile(self, pix, df, magLimit=GAIA_CACHE_MAG_LIMIT):
+        """ write the sources in df that fall in tile pix, an empty tile is
+        still written so it is known to have been built.
+        """
+        path = self.tilePath(pix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if len(df) > 0:
+            inTile = self.hp.lonlat_to_healpix(
+                df.ra.to_numpy() * u.deg, df.dec.to_numpy() * u.deg
+            ) == pix
+            df = df[inTile & (df.phot_g_mean_mag.to_numpy() < magLimit)]
+        arrs = {
+            col: df[col].to_numpy(dtype=dtype) for col, dtype in GAIA_COLUMNS.items()
+        }
+        # write then move so readers never see a partial tile
+        tmpPath = path + ".tmp%i"%os.getpid()
+        with open(tmpPath, "wb") as f:
+            numpy.savez_compressed(f, magLimit=magLimit, **arrs)
+        os.replace(tmpPath, path)
+        self._tiles.pop(pix, None)
+
+    def buildFromTable(self, df, magLimit=GAIA_CACHE_MAG_LIMIT, pixels=None):
+        """ build (or refresh) tiles from a local table of gaia sources,
+        eg a csv export standing in for the database.  Every tile in
+        pixels is written, empty if df has no sources in it, so cone
+        searches over empty sky return nothing instead of raising.
+
+        Parameters
+        ------------
+        df : pandas.DataFrame
+            must contain GAIA_COLUMNS
+        pixels : list of int or None
+            tiles to write, if None the footprint of df: every tile
+            touched by df and their neighbours
+        """
+        tilePix = self.hp.lonlat_to_healpix(
+            df.ra.to_numpy() * u.deg, df.dec.to_numpy() * u.deg
+        )
+        # partition df by tile once
+        order = numpy.argsort(tilePix, kind="stable")
+        sortedPix = tilePix[order]
+        if pixels is None:
+            touched = numpy.unique(sortedPix)
+            neighbours = self.hp.neighbours(touched).ravel()
+            pixels = numpy.union1d(touched, neighbours[neighbours >= 0])
+        for pix in pixels:
+            lo, hi = numpy.searchsorted(sortedPix, [pix, pix + 1])
+            self.writeTile(pix, df.iloc[order[lo:hi]], magLimit)
+        return list(pixels)
+
+    def buildFromDB(self, pixels, magLimit=GAIA_CACHE_MAG_LIMIT, overwrite=False):
+        """ build (or refresh if overwrite) tiles by querying the operations
+        database with one cone per tile.
+        """
+        built = []
+        for pix in pixels:
+            if not overwrite and os.path.exists(self.tilePath(pix)):
+                continue
+            ra, dec = self.tileCenter(pix)
+            df = queryGaiaDB(ra, dec, self.tileRadius, magLimit)
+            self.writeTile(pix, df, magLimit)
+            built.append(pix)
+        return built
+
+    def buildForCones(self, raDecRad, magLimit=GAIA_CACHE_MAG_LIMIT, overwrite=False):
+        """ build all tiles needed to serve a list of [ra, dec, radius] cones
+        (eg every field center in a season) from the database.
+        """
+        pixels = set()
+        for ra, dec, radius in raDecRad:
+            pixels.update(self.tilesForCone(ra, dec, radius).tolist())
+        return self.buildFromDB(sorted(pixels), magLimit, overwrite)
+
+
+class FieldGaiaCache(object):
+    def __init__(self, cacheDir=FIELD_CACHE_DIR, maxConfigs=200):
+        """
+        Read-only (to workers) on disk cache of one gaia cone per
+        configuration, big enough to cover all six GFAs.  The parent
+        process writes a field with put, worker processes read it with
+        coneSearch.  Files are evicted least recently used once there
+        are more than maxConfigs of them.
+
+        Parameters
+        ------------------
+        cacheDir : string
+            directory holding one .npz file per configid
+        maxConfigs : int
+            max number of configurations kept on disk
+        """
+        self.cacheDir = cacheDir
+        self.maxConfigs = maxConfigs
+        self._mem = OrderedDict()  # small per process memo of loaded fields
+
+    def path(self, configid):
+        return os.path.join(self.cacheDir, "gaiaField-%i.npz"%configid)
+
+    def put(self, configid, df, raCen, decCen, radius, maxMag):
+        os.makedirs(self.cacheDir, exist_ok=True)
+        arrs = {
+            col: df[col].to_numpy(dtype=dtype) for col, dtype in GAIA_COLUMNS.items()
+        }
+        path = self.path(configid)
+        tmpPath = path + ".tmp%i"%os.getpid()
+        with open(tmpPath, "wb") as f:
+            numpy.savez(
+                f, raCen=raCen, decCen=decCen, radius=radius, maxMag=maxMag, **arrs
+            )
+        os.replace(tmpPath, path)
+        self._mem.pop(configid, None)
+        self._evict()
+
+    def get(self, configid):
+        """ returns dict of field meta data and columns or None if the
+        field isn't cached
+        """
+        if configid in self._mem:
+            return self._mem[configid]
+        path = self.path(configid)
+        try:
+            with numpy.load(path) as npz:
+                field = {key: npz[key] for key in npz.files}
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            # never fetched, or evicted under us
+            return None
+        for key in ["raCen", "decCen", "radius", "maxMag"]:
+            field[key] = float(field[key])
+        field["xyz"] = radec2xyz(field["ra"], field["dec"]).reshape(-1, 3)
+        self._mem[configid] = field
+        if len(self._mem) > 2:
+            self._mem.popitem(last=False)
+        return field
+
+    def coneSearch(self, configid, raCen, decCen, radius, maxMag):
+        """ same semantics as GaiaCache.coneSearch but served from the
+        cached field, returns None if the field isn't cached or doesn't
+        fully cover the requested cone/magnitude range.
+        """
+        field = self.get(configid)
+        if field is None:
+            return None
+        dist = angSep(field["raCen"], field["decCen"], raCen, decCen)
+        if dist + radius > field["radius"] or maxMag > field["maxMag"]:
+            return None
+        cenXYZ = radec2xyz(raCen, decCen)[0]
+        keep = (field["xyz"] @ cenXYZ >= numpy.cos(numpy.radians(radius))) & \
+            (field["phot_g_mean_mag"] < maxMag)
+        return pandas.DataFrame({col: field[col][keep] for col in GAIA_COLUMNS.keys()})
+
+    def _evict(self):
+        files = glob.glob(os.path.join(self.cacheDir, "gaiaField-*.npz"))
+        if len(files) <= self.maxConfigs:
+            return
+        mtimes = []
+        for f in files:
+            try:
+                mtimes.append(os.path.getmtime(f))
+            except FileNotFoundError:
+                mtimes.append(numpy.inf)
+        for ii in numpy.argsort(mtimes)[:len(files) - self.maxConfigs]:
+            try:
+                os.remove(files[ii])
+            except FileNotFoundError:
+                pass
+
+
+if __name__ == "__main__":
+    import sys
+    # build tiles from a local csv stand in for the database
+    # python gaiaCache.py gaiaExport.csv
+    gc = GaiaCache()
+    pixels = gc.buildFromTable(pandas.read_csv(sys.argv[1]))
+    print("built", len(pixels), "tiles in", gc.cacheDir)
@@ -0,0 +1,204 @@
+import os
+import glob
+import sqlite3
+from multiprocessing import Pool
+import numpy
+import pandas
+from astropy.io import fits
+
+
+GIMG_BASE = "/uufs/chpc.utah.edu/common/home/sdss50/sdsswork/data/gcam/"
+GIMG_INDEX_DIR = "/uufs/chpc.utah.edu/common/home/u0449727/work/gimgIndex"
+
+# header keywords (from extension 1) indexed as their own columns,
+# "-" is replaced with "_" in the column name
+INDEX_KEYWORDS = [
+    "CONFIGID", "DESIGNID", "DATE-OBS", "EXPTIME", "SOLVED", "SOLVMODE",
+    "RAFIELD", "DECFIELD", "FIELDPA", "AOFFRA", "AOFFDEC", "AOFFPA",
+    "M2PISTON", "RMS", "PIXELSC",
+]
+
+# centroids with peak above this count as detections (see ProcGimgLite.nDetect)
+DETECT_PEAK = 700
+
+# columns of the gimg table (readGimgHeader rows), filename is the key
+GIMG_COLUMNS = ["filename", "mtime", "gfaNum", "imgNum"] + \
+    [key.replace("-", "_") for key in INDEX_KEYWORDS] + ["header", "nCentroids", "nDetect"]
+
+
+def parseGimgFilename(filename):
+    """ returns gfaNum, imgNum from a proc-gimg-gfa3n-0022.fits style name
+    """
+    base = os.path.basename(filename).split(".fits")[0]
+    gfaStr, imgStr = base.split("-")[-2:]
+    return int(gfaStr[3]), int(imgStr)
+
+
+def readGimgHeader(filename):
+    """ read only what the index needs from one proc-gimg file, the
+    CENTROIDS table is small so it's fine to read it for nDetect
+    """
+    gfaNum, imgNum = parseGimgFilename(filename)
+    row = {
+        "filename": filename,
+        "mtime": os.path.getmtime(filename),
+        "gfaNum": gfaNum,
+        "imgNum": imgNum,
+    }
+    with fits.open(filename) as ff:
+        header = ff[1].header
+        for key in INDEX_KEYWORDS:
+            row[key.replace("-", "_")] = header.get(key, None)
+        row["header"] = header.tostring()
+        if "CENTROIDS" in ff:
+            cents = ff["CENTROIDS"].data
+            row["nCentroids"] = ff["CENTROIDS"].header.get("NAXIS2", 0)
+            if cents is None or len(cents) == 0:
+                row["nDetect"] = 0
+            else:
+                row["nDetect"] = int(numpy.sum(cents["peak"] > DETECT_PEAK))
+        else:
+            row["nCentroids"] = 0
+            row["nDetect"] = 0
+    return row
+
+
+class GimgIndex(object):
+    def __init__(self, site, mjd, indexDir=GIMG_INDEX_DIR, gimgBase=GIMG_BASE):
+        """
+        SQLite index of selected proc-gimg header keywords (plus the full
+        extension 1 header and CENTROIDS row counts) for one site/mjd.
+        Updated incrementally: only files that are new or whose mtime
+        changed are re-read.
+
+        Parameters
+        ------------------
+        site : string
+            "apo" or "lco" (case ignored)
+        mjd : int
+            mjd to index
+        indexDir : string
+            directory holding gimgIndex-<site>-<mjd>.sqlite files
+        gimgBase : string
+            root of the gcam data tree
+        """
+        self.site = site.lower()
+        self.mjd = mjd
+        self.indexDir = indexDir
+        self.gimgBase = gimgBase
+        self.path = os.path.join(indexDir, "gimgIndex-%s-%i.sqlite"%(self.site, mjd))
+
+    def _connect(self):
+        os.makedirs(self.indexDir, exist_ok=True)
+        # wait for another process's update rather than fail
+        return sqlite3.connect(self.path, timeout=600)
+
+    def _createTable(self, conn):
+        cols = [row[1] for row in conn.execute("pragma table_info(gimg)") if row[5] > 0]
+        if self._hasTable(conn) and cols != ["filename"]:
+            # written before filename was the primary key (and may hold
+            # duplicate rows), rebuild it
+            conn.execute("drop table gimg")
+        conn.execute(
+            "create table if not exists gimg (%s)"%", ".join(
+                ['"filename" text primary key'] + ['"%s"'%col for col in GIMG_COLUMNS[1:]]
+            )
+        )
+        conn.execute("create index if not exists gimg_img on gimg (imgNum, gfaNum)")
+
+    def _hasTable(self, conn):
+        cur = conn.execute(
+            "select name from sqlite_master where type='table' and name='gimg'"
+        )
+        return cur.fetchone() is not None
+
+    def _indexed(self, conn):
+        if not self._hasTable(conn):
+            return {}
+        df = pandas.read_sql("select filename, mtime from gimg", conn)
+        return dict(zip(df.filename, df.mtime))
+
+    def update(self, nProcs=8):
+        """ re-read new or modified files and drop files that disappeared,
+        returns the number of files read.  The whole diff and write is one
+        write transaction, so concurrent updaters of the same site/mjd run
+        one after the other (the second finds nothing left to read).
+        """
+        files = sorted(glob.glob(
+            self.gimgBase + "%s/%i/proc-gimg-*.fits"%(self.site, self.mjd)
+        ))
+        conn = self._connect()
+        conn.isolation_level = None # transactions handled here
+        try:
+            conn.execute("begin immediate")
+            self._createTable(conn)
+            indexed = self._indexed(conn)
+            toRead = [f for f in files if indexed.get(f) != os.path.getmtime(f)]
+            removed = set(indexed.keys()) - set(files)
+
+            rows = []
+            if len(toRead) > 0:
+                if nProcs > 1 and len(toRead) > 1:
+                    p = Pool(nProcs)
+                    rows = p.map(readGimgHeader, toRead)
+                    p.close()
+                else:
+                    rows = [readGimgHeader(f) for f in toRead]
+
+            conn.executemany(
+                "delete from gimg where filename=?", [(f,) for f in removed]
+            )
+            conn.executemany(
+                "insert or replace into gimg (%s) values (%s)"%(
+                    ", ".join('"%s"'%col for col in GIMG_COLUMNS),
+                    ", ".join("?" * len(GIMG_COLUMNS))
+                ),
+                [tuple(row.get(col) for col in GIMG_COLUMNS) for row in rows]
+            )
+            conn.execute("commit")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("rollback")
+            raise
+        finally:
+            conn.close()
+        return len(toRead)
+
+    def query(self, configid=None, gfaNum=None, imgNum=None, header=False):
+        """ return indexed rows as a DataFrame, optionally filtered, the
+        (large) header column is only returned if header is True
+        """
+        conn = self._connect()
+        where = []
+        args = []
+        for col, val in [("CONFIGID", configid), ("gfaNum", gfaNum), ("imgNum", imgNum)]:
+            if val is not None:
+                where.append("%s=?"%col)
+                args.append(int(val))
+        if not self._hasTable(conn):
+            conn.close()
+            return pandas.DataFrame()
+        cols = [row[1] for row in conn.execute("pragma table_info(gimg)")]
+        if not header:
+            cols.remove("header")
+        sql = "select %s from gimg"%", ".join('"%s"'%col for col in cols)
+        if len(where) > 0:
+            sql += " where " + " and ".join(where)
+        sql += " order by imgNum, gfaNum"
+        df = pandas.read_sql(sql, conn, params=args)
+        conn.close()
+        return df
+
+
+def indexMJDs(site, mjds, nProcs=8):
+    """ build or refresh the index for a list of mjds
+    """
+    for mjd in mjds:
+        nRead = GimgIndex(site, mjd).update(nProcs)
+        print(site, mjd, "read", nRead, "headers")
+
+
+if __name__ == "__main__":
+    import sys
+    # python gimgIndex.py apo 59843 59844 ...
+    indexMJDs(sys.argv[1], [int(x) for x in sys.argv[2:]])
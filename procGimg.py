@@ -8,6 +8,8 @@ import pandas
 from datetime import datetime
 from multiprocessing import Pool
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import traceback
 import time
 import numpy
 from coordio.utils import fitsTableToPandas, wokxy2radec, radec2wokxy
@@ -25,7 +27,7 @@ from skimage import filters
 from skimage.registration import phase_cross_correlation
 from skimage.transform import EuclideanTransform, SimilarityTransform
 import os
-from scipy.optimize import minimize
+from scipy.optimize import minimize, least_squares
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -64,12 +66,153 @@ def getCentroids(data):
     objects = objects[objects.npix>50]
     return objects
 
+# set with useGaiaCache to query gaia from local HEALPix tiles
+# (see gaiaCache.py) instead of the operations database
+GAIA_CACHE = None
+
+
+def useGaiaCache(cacheDir=None):
+    """ route all gaia queries in this module through a local
+    gaiaCache.GaiaCache (built beforehand with gaiaCache.py).
+    cacheDir None uses gaiaCache.GAIA_CACHE_DIR.  Returns the cache.
+    """
+    import gaiaCache
+    global GAIA_CACHE
+    if cacheDir is None:
+        cacheDir = gaiaCache.GAIA_CACHE_DIR
+    GAIA_CACHE = gaiaCache.GaiaCache(cacheDir)
+    return GAIA_CACHE
+
+
+# set with useFieldGaiaCache, per configuration gaia catalogs fetched
+# once by the parent process (prefetchFieldGaia) and read by workers
+FIELD_GAIA_CACHE = None
+
+
+def useFieldGaiaCache(cacheDir=None, maxConfigs=200):
+    """ serve ProcGimg guide star queries from per configuration gaia
+    fields written by prefetchFieldGaia. cacheDir None uses
+    gaiaCache.FIELD_CACHE_DIR.  Returns the cache.
+    """
+    import gaiaCache
+    global FIELD_GAIA_CACHE
+    if cacheDir is None:
+        cacheDir = gaiaCache.FIELD_CACHE_DIR
+    FIELD_GAIA_CACHE = gaiaCache.FieldGaiaCache(cacheDir, maxConfigs)
+    return FIELD_GAIA_CACHE
+
+
+def fieldQueryRadius(site, gfaCoords=None, chipRadius=0.08, pad=0.05):
+    """ radius (deg) of a single cone around the field center that covers
+    the chipRadius query cones of all six GFAs.  pad allows for focal
+    scale changes, guider offsets and dithers moving the chips around.
+    """
+    if gfaCoords is None:
+        gfaCoords = getGFACoords(site)
+    rWok = numpy.max(numpy.hypot(gfaCoords.xWok, gfaCoords.yWok)) # mm
+    return rWok / PLATE_SCALE[site.upper()] + chipRadius + pad
+
+
+def prefetchFieldGaia(configid, site, raCen, decCen, maxMag=18, gfaCoords=None):
+    """ fetch gaia once for a whole configuration so that guide bundles
+    processed in worker processes don't each re-query it per chip.
+    Uses the local tile cache if enabled, else the database.
+    """
+    import gaiaCache
+    if FIELD_GAIA_CACHE is None:
+        useFieldGaiaCache()
+    radius = fieldQueryRadius(site, gfaCoords)
+    field = FIELD_GAIA_CACHE.get(configid)
+    if field is not None and field["radius"] >= radius and field["maxMag"] >= maxMag:
+        if gaiaCache.angSep(field["raCen"], field["decCen"], raCen, decCen) < 1e-6:
+            return
+
+    if GAIA_CACHE is not None:
+        df = GAIA_CACHE.coneSearch(raCen, decCen, radius, maxMag)
+    else:
+        df = gaiaCache.queryGaiaDB(raCen, decCen, radius, maxMag)
+    FIELD_GAIA_CACHE.put(configid, df, raCen, decCen, radius, maxMag)
+
+
+def getCentroidsROI(data, xyPredict, margin=60, halfWidth=20, thresh=1.5, minNPix=50):
+    """ sep extraction restricted to stamps around predicted star positions
+
+    Parameters
+    ------------
+    data : numpy.ndarray
+        full CCD image
+    xyPredict : numpy.ndarray
+        nx2 predicted (x=column, y=row) positions in CCD pixels
+    margin : int
+        pixels, allowance for the (unknown) bulk shift between predicted
+        and actual positions
+    halfWidth : int
+        pixels, allowance for the extent of a star image
+    thresh : float
+        detection threshold in units of the local background rms
+    minNPix : int
+        minimum number of pixels for bone fide detection
+
+    Returns
+    ---------
+    pandas.DataFrame with the same columns as a full frame sep extraction,
+    in full frame pixel coordinates
+    """
+    nRows, nCols = data.shape
+    half = margin + halfWidth
+    objList = []
+    for x, y in numpy.round(xyPredict).astype(int):
+        x0 = max(x - half, 0)
+        x1 = min(x + half + 1, nCols)
+        y0 = max(y - half, 0)
+        y1 = min(y + half + 1, nRows)
+        if x1 - x0 < 3 or y1 - y0 < 3:
+            continue
+        stamp = numpy.array(data[y0:y1, x0:x1], dtype=numpy.float64)
+        # local background, sigma clipped median and MAD based rms
+        # (from a subsample of pixels, plenty for a background level)
+        pix = stamp[::2, ::2].flatten()
+        for ii in range(3):
+            med = numpy.median(pix)
+            rms = 1.4826 * numpy.median(numpy.abs(pix - med))
+            if rms == 0:
+                break
+            pix = pix[numpy.abs(pix - med) < 3 * rms]
+        if rms == 0:
+            continue
+        objects = sep.extract(stamp - med, thresh, err=rms)
+        if len(objects) == 0:
+            continue
+        # throw out detections truncated by a stamp edge that isn't a chip edge
+        truncated = ((objects["xmin"] == 0) & (x0 > 0)) | \
+            ((objects["xmax"] == x1 - x0 - 1) & (x1 < nCols)) | \
+            ((objects["ymin"] == 0) & (y0 > 0)) | \
+            ((objects["ymax"] == y1 - y0 - 1) & (y1 < nRows))
+        objects = objects[~truncated]
+        for col in ["x", "xmin", "xmax", "xcpeak", "xpeak"]:
+            objects[col] += x0
+        for col in ["y", "ymin", "ymax", "ycpeak", "ypeak"]:
+            objects[col] += y0
+        objList.append(objects)
+
+    if len(objList) == 0:
+        return None
+    objects = fitsTableToPandas(numpy.concatenate(objList))
+    # overlapping stamps find the same star more than once
+    objects = objects.drop_duplicates(subset=["xpeak", "ypeak"])
+    objects = objects[objects.npix>minNPix]
+    return objects.reset_index(drop=True)
+
+
 def queryGaia(raCen, decCen, radius=0.08):
     # all inputs in degrees
     # from sdssdb.peewee.sdss5db import database, catalogdb
     # database.set_profile('operations')
-    database.connect()
     MAX_MAG = 18
+    if GAIA_CACHE is not None:
+        return GAIA_CACHE.coneSearch(raCen, decCen, radius, MAX_MAG).to_dict("records")
+
+    database.connect()
 
     results = catalogdb.Gaia_DR2.select(
         catalogdb.Gaia_DR2.solution_id,
@@ -146,12 +289,403 @@ def getShift2(xyGaia, xyDetect):
 
     return xOff, yOff
 
+
+def getShiftVote(xyGaia, xyDetect, binSize=20, maxShift=2048, refineRadii=(10, 3)):
+    """ get the bulk shift between the two lists by voting on
+    all pairwise (gaia - detection) offsets, works only on the point
+    lists so it avoids building and blurring full CCD images like getShift2.
+
+    Parameters
+    -----------
+    xyGaia : numpy.ndarray
+        nx2 expected (gaia) positions in CCD pixels
+    xyDetect : numpy.ndarray
+        mx2 detected positions in CCD pixels
+    binSize : float
+        pixels, size of the coarse voting grid
+    maxShift : float
+        pixels, ignore pair offsets larger than this in either axis
+    refineRadii : tuple of float
+        pixels, successively smaller radii around the current estimate
+        within which pair offsets are median combined
+
+    Returns
+    --------
+    xOff, yOff : float
+        shift to add to xyDetect to land on xyGaia (same sense as getShift2)
+    """
+    xyGaia = numpy.asarray(xyGaia, dtype=numpy.float64).reshape(-1, 2)
+    xyDetect = numpy.asarray(xyDetect, dtype=numpy.float64).reshape(-1, 2)
+    if len(xyGaia) == 0 or len(xyDetect) == 0:
+        return 0., 0.
+
+    dx = (xyGaia[:, 0, None] - xyDetect[None, :, 0]).flatten()
+    dy = (xyGaia[:, 1, None] - xyDetect[None, :, 1]).flatten()
+    keep = (numpy.abs(dx) < maxShift) & (numpy.abs(dy) < maxShift)
+    dx = dx[keep]
+    dy = dy[keep]
+
+    # coarse vote, sum over a 3x3 neighborhood so a cluster
+    # split across a bin edge still wins
+    nBins = int(numpy.ceil(2 * maxShift / binSize))
+    edges = numpy.linspace(-maxShift, maxShift, nBins + 1)
+    votes, xEdges, yEdges = numpy.histogram2d(dx, dy, bins=[edges, edges])
+    padded = numpy.pad(votes, 1)
+    smoothed = sum(
+        padded[ii:ii + nBins, jj:jj + nBins] for ii in range(3) for jj in range(3)
+    )
+    ii, jj = numpy.unravel_index(numpy.argmax(smoothed), smoothed.shape)
+
+    # the box sum ties across the neighborhood of a compact cluster,
+    # so start from the median of all pairs in the winning 3x3 block
+    inBlock = (dx >= xEdges[max(ii - 1, 0)]) & (dx < xEdges[min(ii + 2, nBins)]) & \
+        (dy >= yEdges[max(jj - 1, 0)]) & (dy < yEdges[min(jj + 2, nBins)])
+    xOff = numpy.median(dx[inBlock])
+    yOff = numpy.median(dy[inBlock])
+
+    # refine with the median of pair offsets near the peak
+    for radius in refineRadii:
+        near = (dx - xOff)**2 + (dy - yOff)**2 < radius**2
+        if not numpy.any(near):
+            break
+        xOff = numpy.median(dx[near])
+        yOff = numpy.median(dy[near])
+
+    return float(xOff), float(yOff)
+
+
 GUIDE_STAR_CAT = {}
 
+# finite difference steps for field ra, dec, pa (deg) and focal scale
+POINTING_FD_STEPS = numpy.array([1e-4, 1e-4, 1e-3, 1e-5])
+
+
+def wokResiduals(
+    x, ra, dec, pmra, pmdec, xWokMeas, yWokMeas, site, dateObsJD, epoch=GAIA_EPOCH
+):
+    """ expected - measured wok positions of gaia stars on the GFAs for
+    pointing parameters x = [raField, decField, paField, focalScale]
+
+    Returns
+    --------
+    numpy.ndarray
+        [dx, dy] concatenated (length 2*len(ra)), mm
+    """
+    raField, decField, paField, focalScale = x
+    xWokExpect, yWokExpect, fieldWarn, HA, PA = radec2wokxy(
+        ra, dec, epoch, "GFA",
+        raField, decField, paField,
+        site.upper(), dateObsJD, focalScale=focalScale,
+        pmra=pmra, pmdec=pmdec
+    )
+    return numpy.concatenate([xWokExpect - xWokMeas, yWokExpect - yWokMeas])
+
+
+def solveLSQ(resid, xInit, steps, maxEval=100):
+    """ nonlinear least squares (scipy least_squares, trust region)
+    on a residual vector function, with a forward difference jacobian
+    using fixed absolute steps.
+
+    radec2wokxy only takes a scalar field center, pa and scale, so the
+    perturbed models can't be stacked into a single call, but the
+    jacobian costs len(xInit) evaluations and convergence typically takes
+    a handful of iterations rather than the hundreds of evaluations Powell
+    needs on the rms.
+
+    Parameters
+    ------------
+    resid : callable
+        resid(x) returns a 1D residual array
+    xInit : numpy.ndarray
+        starting parameters
+    steps : numpy.ndarray
+        finite difference step for each parameter
+    maxEval : int
+        max number of residual evaluations by the solver
+
+    Returns
+    --------
+    scipy.optimize.OptimizeResult
+        with extra attributes nEval (total resid calls including the
+        jacobian) and cov (parameter covariance scaled by the
+        residual variance, None if singular)
+    """
+    nEval = [0]
+    last = {}
+
+    def _resid(x):
+        key = tuple(x)
+        if key not in last:
+            nEval[0] += 1
+            last.clear()
+            last[key] = resid(numpy.array(x))
+        return last[key]
+
+    def _jac(x):
+        r0 = _resid(x)
+        jac = numpy.zeros((len(r0), len(x)))
+        for ii, step in enumerate(steps):
+            xp = numpy.array(x, dtype=numpy.float64)
+            xp[ii] += step
+            nEval[0] += 1
+            jac[:, ii] = (resid(xp) - r0) / step
+        return jac
+
+    out = least_squares(
+        _resid, xInit, jac=_jac, method="trf", x_scale=steps, max_nfev=maxEval
+    )
+    out.nEval = nEval[0]
+    dof = len(out.fun) - len(xInit)
+    try:
+        cov = numpy.linalg.inv(out.jac.T @ out.jac)
+        if dof > 0:
+            cov *= numpy.sum(out.fun**2) / dof
+        out.cov = cov
+    except numpy.linalg.LinAlgError:
+        out.cov = None
+    return out
+
+
+def fitPointingJoint(matches, site, tMidJD, fitDrift=False, maxEval=100):
+    """ fit a single pointing model to the stacked gfa matches of many
+    guide frames (eg all frames in a science exposure) in one solve.
+
+    Parameters
+    ------------
+    matches : pandas.DataFrame
+        concatenated GuideBundle.matches with imgNum, dateObsJD and
+        raFieldInit, decFieldInit, paFieldInit columns (see
+        confSumm.processGuideBundle)
+    site : str
+        "apo" or "lco"
+    tMidJD : float
+        reference time (eg science exposure midpoint), fitted values are
+        the pointing at this time
+    fitDrift : bool
+        if True also fit a linear drift (per hour) in ra/dec/pa/scale
+    maxEval : int
+        max solver iterations
+
+    Returns
+    ---------
+    fit : dict
+        raFit, decFit, paFit, scaleFit at tMidJD, drift rates (per hour,
+        zero if not fitted), rms, nEval, fitTime and cov
+    frameResid : pandas.DataFrame
+        per frame imgNum, dateObsJD, nStars, rms (mm) of the joint model
+    """
+    cols = ["ra", "dec", "pmra", "pmdec", "xWok_meas", "yWok_meas", "dateObsJD"]
+    matches = matches.dropna(subset=cols)
+    frames = []
+    for imgNum, _m in matches.groupby("imgNum"):
+        dateObsJD = _m.dateObsJD.to_numpy()[0]
+        frames.append(dict(
+            imgNum=imgNum,
+            dt=(dateObsJD - tMidJD) * 24, # hours
+            arrays=dict(
+                ra=_m.ra.to_numpy(),
+                dec=_m.dec.to_numpy(),
+                pmra=_m.pmra.to_numpy(),
+                pmdec=_m.pmdec.to_numpy(),
+                xWokMeas=_m.xWok_meas.to_numpy(),
+                yWokMeas=_m.yWok_meas.to_numpy(),
+                site=site.upper(),
+                dateObsJD=dateObsJD
+            )
+        ))
+
+    def framePointing(x, dt):
+        if fitDrift:
+            return x[:4] + x[4:] * dt
+        return x
+
+    def resid(x):
+        return numpy.concatenate([
+            wokResiduals(framePointing(x, f["dt"]), **f["arrays"]) for f in frames
+        ])
+
+    xInit = numpy.array([
+        numpy.median(matches.raFieldInit), numpy.median(matches.decFieldInit),
+        numpy.median(matches.paFieldInit), 1
+    ])
+    steps = POINTING_FD_STEPS
+    if fitDrift:
+        xInit = numpy.concatenate([xInit, numpy.zeros(4)])
+        steps = numpy.concatenate([steps, steps])
+
+    tstart = time.time()
+    optOut = solveLSQ(resid, xInit, steps, maxEval)
+    fitTime = time.time() - tstart
+    print("joint pointing fit of %i frames took"%len(frames), fitTime, "nEval", optOut.nEval)
+
+    x = optOut.x
+    drift = x[4:] if fitDrift else numpy.zeros(4)
+    frameResid = []
+    for f in frames:
+        r = wokResiduals(framePointing(x, f["dt"]), **f["arrays"])
+        frameResid.append({
+            "imgNum": f["imgNum"],
+            "dateObsJD": f["arrays"]["dateObsJD"],
+            "nStars": len(r) // 2,
+            "rms": numpy.sqrt(2 * numpy.mean(r**2)),
+        })
+
+    fit = {
+        "raFit": x[0], "decFit": x[1], "paFit": x[2], "scaleFit": x[3],
+        "raDrift": drift[0], "decDrift": drift[1], "paDrift": drift[2],
+        "scaleDrift": drift[3],
+        "rms": numpy.sqrt(2 * numpy.mean(optOut.fun**2)),
+        "nEval": optOut.nEval, "fitTime": fitTime, "cov": optOut.cov,
+    }
+    return fit, pandas.DataFrame(frameResid)
+
+
+class _HDUStandIn(object):
+    def __init__(self, header, data=None):
+        self.header = header
+        self.data = data
+
+
+class _FitsStandIn(object):
+    """ picklable stand in for an open proc-gimg HDUList, keeps the headers
+    and the CENTROIDS table but not the pixels.  Used when ProcGimg or
+    ProcGimgLite objects are sent back from worker processes.
+    """
+    def __init__(self, ff):
+        self._names = [hdu.name for hdu in ff]
+        self._hdus = [_HDUStandIn(hdu.header.copy()) for hdu in ff]
+        if "CENTROIDS" in self._names:
+            idx = self._names.index("CENTROIDS")
+            self._hdus[idx].data = numpy.array(ff["CENTROIDS"].data)
+
+    @classmethod
+    def fromHeader(cls, header):
+        """ stand in for a proc-gimg file from its extension 1 header alone
+        (eg from gimgIndex), no CENTROIDS data
+        """
+        if isinstance(header, str):
+            header = fits.Header.fromstring(header)
+        ff = cls.__new__(cls)
+        ff._names = ["PRIMARY", header.get("EXTNAME", "")]
+        ff._hdus = [_HDUStandIn(fits.Header()), _HDUStandIn(header)]
+        return ff
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self._names.index(key.upper())
+        return self._hdus[key]
+
+
+def _loadChip(ProcClass, imgFile, site, gfaNum, kwargs):
+    try:
+        return ProcClass(imgFile, site, gfaNum, **kwargs), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def loadChips(
+    ProcClass, chipFiles, site, executor=None, maxWorkers=6, chipKwargs=None, **kwargs
+):
+    """ build ProcGimg or ProcGimgLite objects for the chips of one guide
+    frame, optionally concurrently.  A chip that raises is recorded
+    in failedChips rather than killing the whole bundle.
+
+    Parameters
+    ------------
+    ProcClass : class
+        ProcGimg or ProcGimgLite
+    chipFiles : dict
+        gfaNum: path to proc-gimg file
+    site : str
+        "apo" or "lco"
+    executor : None, str, or concurrent.futures.Executor
+        None processes chips serially, "thread" or "process" creates
+        a pool of maxWorkers for this call, an Executor instance is used
+        as is (and not shut down).  Objects coming back from processes
+        carry headers and centroids but not pixel data.
+    chipKwargs : dict or None
+        gfaNum: dict of extra ProcClass kwargs for that chip only
+    kwargs :
+        passed to ProcClass
+
+    Returns
+    ---------
+    gfaDict : dict
+        gfaNum: ProcClass object for chips that succeeded
+    failedChips : dict
+        gfaNum: traceback string for chips that failed
+    """
+    if chipKwargs is None:
+        chipKwargs = {}
+    allKwargs = {}
+    for gfaNum in chipFiles.keys():
+        allKwargs[gfaNum] = dict(kwargs)
+        allKwargs[gfaNum].update(chipKwargs.get(gfaNum, {}))
+
+    ownExecutor = False
+    if executor == "thread":
+        executor = ThreadPoolExecutor(max_workers=maxWorkers)
+        ownExecutor = True
+    elif executor == "process":
+        executor = ProcessPoolExecutor(max_workers=maxWorkers)
+        ownExecutor = True
+
+    if executor is None:
+        results = [
+            _loadChip(ProcClass, imgFile, site, gfaNum, allKwargs[gfaNum])
+            for gfaNum, imgFile in chipFiles.items()
+        ]
+    else:
+        futures = [
+            executor.submit(_loadChip, ProcClass, imgFile, site, gfaNum, allKwargs[gfaNum])
+            for gfaNum, imgFile in chipFiles.items()
+        ]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception:
+                # eg the worker process died
+                results.append((None, traceback.format_exc()))
+        if ownExecutor:
+            executor.shutdown()
+
+    gfaDict = {}
+    failedChips = {}
+    for gfaNum, (proc, err) in zip(chipFiles.keys(), results):
+        if err is None:
+            gfaDict[gfaNum] = proc
+        else:
+            print("gfa %i failed: %s"%(gfaNum, chipFiles[gfaNum]))
+            print(err)
+            failedChips[gfaNum] = err
+    return gfaDict, failedChips
+
+
+def getChipFiles(site, mjd, imgNum):
+    """ paths to the existing proc-gimg files (keyed by gfa number) for
+    one guide frame
+    """
+    imgNumStr = str(imgNum).zfill(4)
+    chipFiles = {}
+    for gfaNum in range(1,7):
+        if site.lower() == "apo":
+            gfaNumStr = "gfa%in"%gfaNum
+        else:
+            gfaNumStr = "gfa%is"%gfaNum
+        imgFile = getGimgBasePath(site)+ "/%i/proc-gimg-%s-%s.fits"%(mjd,gfaNumStr,imgNumStr)
+        if not os.path.exists(imgFile):
+            continue
+        chipFiles[gfaNum] = imgFile
+    return chipFiles
+
 
 
 class ProcGimg(object):
-    def __init__(self, filename, site, gfaID, extract=True, focalScale=1, gfaCoords=None):
+    def __init__(
+        self, filename, site, gfaID, extract=True, focalScale=1, gfaCoords=None,
+        shiftMethod="xcorr", extractMode="full"
+    ):
         """
         Parameters
         ------------------
@@ -166,6 +700,13 @@ class ProcGimg(object):
             present from fits file
         focalScale : float
             scale to use for coordio conversions
+        shiftMethod : str
+            "xcorr" to use getShift2 or "vote" to use getShiftVote for
+            the bulk shift between gaia and detections
+        extractMode : str
+            if extract, "full" runs sep over the whole frame, "roi" only
+            over stamps around the predicted gaia positions (falling
+            back to full frame if that finds nothing)
 
         """
         self.filename = filename
@@ -181,11 +722,6 @@ class ProcGimg(object):
         self.ff = fits.open(filename)
         self.astroNetSolved = self.ff[1].header["SOLVED"]
 
-        if extract:
-            self.centroids = self._extract()
-        else:
-            self.centroids = fitsTableToPandas(self.ff["CENTROIDS"].data)
-
         gfaRow = self.gfaCoords[self.gfaCoords.id == gfaID]
         self.b = gfaRow[["xWok", "yWok", "zWok"]].to_numpy().squeeze()
         self.iHat = gfaRow[["ix", "iy", "iz"]].to_numpy().squeeze()
@@ -219,6 +755,17 @@ class ProcGimg(object):
 
         self.coordioCenter = numpy.array([raChipCen, decChipCen]).squeeze()
 
+        t1 = time.time()
+        self._getGuideStars() # sets attr self.guideStars
+        print("get guideStars took", time.time()-t1)
+
+        if extract and extractMode == "roi":
+            self.centroids = self._extractROI()
+        elif extract:
+            self.centroids = self._extract()
+        else:
+            self.centroids = fitsTableToPandas(self.ff["CENTROIDS"].data)
+
         # offset centroids by 0.5 pixels to match coordio's
         # definition of guide coordinates
         # self.centroids["x"] = self.centroids.x + 0.5
@@ -240,10 +787,7 @@ class ProcGimg(object):
         self.centroids["zWok"] = zWok
         self.centroids["fluxNorm"] = self.centroids.cflux / self.exptime
 
-        t1 = time.time()
-        self._getGuideStars() # sets attr self.guideStars
-        print("get guideStars took", time.time()-t1)
-        self._matchGuideStars() # sets attr self.matches
+        self._matchGuideStars(shiftMethod=shiftMethod) # sets attr self.matches
 
         self.dxMean = None # pixels
         self.dyMean = None # pixels
@@ -264,6 +808,13 @@ class ProcGimg(object):
 
         self._fit()
 
+    def __getstate__(self):
+        # don't ship pixels across process boundaries
+        state = self.__dict__.copy()
+        if isinstance(self.ff, fits.HDUList):
+            state["ff"] = _FitsStandIn(self.ff)
+        return state
+
     @property
     def offRA(self):
         # ra offset in degrees
@@ -346,6 +897,30 @@ class ProcGimg(object):
         objects = objects[objects.npix>minNPix]
         return objects.reset_index(drop=True)
 
+    def _extractROI(self, minNPix=50, margin=60, halfWidth=20):
+        """ centroid only stamps around the predicted guideStars positions,
+        see getCentroidsROI.  Falls back to full frame extraction if there
+        are no guide stars or nothing is found.
+
+        Parameters
+        -----------
+        minNPix : int
+            minimum number of pixels for bone fide detection
+        margin : int
+            pixels, allowance for the bulk shift
+        halfWidth : int
+            pixels, allowance for star size
+        """
+        objects = None
+        if len(self.guideStars) > 0:
+            xyPredict = self.guideStars[["xCCD", "yCCD"]].to_numpy()
+            objects = getCentroidsROI(
+                self.ff[1].data, xyPredict, margin, halfWidth, minNPix=minNPix
+            )
+        if objects is None or len(objects) == 0:
+            return self._extract(minNPix)
+        return objects
+
     def _getGuideStars(self, maxMag=18, queryRadius=0.08):
         """
         Parameters
@@ -371,30 +946,44 @@ class ProcGimg(object):
                 print("copied previously found guideStars")
                 return
 
-        database.connect()
+        results = None
+        if FIELD_GAIA_CACHE is not None:
+            # None if this configuration wasn't prefetched
+            results = FIELD_GAIA_CACHE.coneSearch(
+                self.configid, self.coordioCenter[0], self.coordioCenter[1],
+                queryRadius, maxMag
+            )
 
-        results = catalogdb.Gaia_DR2.select(
-            catalogdb.Gaia_DR2.solution_id,
-            catalogdb.Gaia_DR2.source_id,
-            catalogdb.Gaia_DR2.ra,
-            catalogdb.Gaia_DR2.dec,
-            catalogdb.Gaia_DR2.phot_g_mean_mag,
-            catalogdb.Gaia_DR2.parallax,
-            catalogdb.Gaia_DR2.pmra,
-            catalogdb.Gaia_DR2.pmdec
-        ).where(
-            (peewee.fn.q3c_radial_query(
+        if results is None and GAIA_CACHE is not None:
+            results = GAIA_CACHE.coneSearch(
+                self.coordioCenter[0], self.coordioCenter[1], queryRadius, maxMag
+            )
+
+        if results is None:
+            database.connect()
+
+            results = catalogdb.Gaia_DR2.select(
+                catalogdb.Gaia_DR2.solution_id,
+                catalogdb.Gaia_DR2.source_id,
                 catalogdb.Gaia_DR2.ra,
                 catalogdb.Gaia_DR2.dec,
-                self.coordioCenter[0],
-                self.coordioCenter[1],
-                queryRadius)
-            ) & \
-            (catalogdb.Gaia_DR2.phot_g_mean_mag < maxMag)
-        )
-        database.close()
+                catalogdb.Gaia_DR2.phot_g_mean_mag,
+                catalogdb.Gaia_DR2.parallax,
+                catalogdb.Gaia_DR2.pmra,
+                catalogdb.Gaia_DR2.pmdec
+            ).where(
+                (peewee.fn.q3c_radial_query(
+                    catalogdb.Gaia_DR2.ra,
+                    catalogdb.Gaia_DR2.dec,
+                    self.coordioCenter[0],
+                    self.coordioCenter[1],
+                    queryRadius)
+                ) & \
+                (catalogdb.Gaia_DR2.phot_g_mean_mag < maxMag)
+            )
+            database.close()
 
-        results = pandas.DataFrame(list(results.dicts()))
+            results = pandas.DataFrame(list(results.dicts()))
         # add a pseudoflux column
         flux = 10**(-results.phot_g_mean_mag/2.5) # plus a constant zeropoint
         results["fluxNorm"] = flux
@@ -443,17 +1032,25 @@ class ProcGimg(object):
             GUIDE_STAR_CAT[self.configid][self.gfaID] = self.guideStars.copy()
 
 
-    def _matchGuideStars(self, thresh=10):
+    def _matchGuideStars(self, thresh=10, shiftMethod="xcorr"):
         """
         Paramters
         -----------------
         thresh : float
             threshold in pixels of a positive match after a bulk xyoffset
             has been determined and applied
+        shiftMethod : str
+            "xcorr" for image cross correlation (getShift2), or "vote"
+            for pair offset voting on the point lists (getShiftVote)
         """
         xyDetect = self.centroids[["xCCD", "yCCD"]].to_numpy()
         xyGaia = self.guideStars[["xCCD", "yCCD"]].to_numpy()
-        dx, dy = getShift2(xyGaia, xyDetect)
+        if shiftMethod == "xcorr":
+            dx, dy = getShift2(xyGaia, xyDetect)
+        elif shiftMethod == "vote":
+            dx, dy = getShiftVote(xyGaia, xyDetect)
+        else:
+            raise RuntimeError("unknown shiftMethod %s"%shiftMethod)
         # print("gfa %i shift %.2f %.2f"%(self.gfaID, dx, dy))
         xyDetectShift = xyDetect + numpy.array([[dx,dy]]*len(xyDetect))
         idxDetect, idxGaia, dist = arg_nearest_neighbor(xyDetectShift, xyGaia)#, atol=thresh)
@@ -517,22 +1114,38 @@ class ProcGimg(object):
 
 
 class GuideBundle(object):
-    def __init__(self, site, mjd, imgNum, fitPointing=False):
+    def __init__(
+        self, site, mjd, imgNum, fitPointing=False, executor=None, maxWorkers=6,
+        pointingMethod="powell"
+    ):
+        """
+        Parameters
+        ------------
+        site : str
+            "apo" or "lco"
+        mjd : int
+            mjd of guide frame
+        imgNum : int
+            guide frame number
+        fitPointing : bool
+            if True solve for field ra/dec/pa/scale
+        executor : None, str, or concurrent.futures.Executor
+            how to process the six chips, see loadChips
+        maxWorkers : int
+            pool size if executor is "thread" or "process"
+        pointingMethod : str
+            fitPointing method, "powell" or "lsq"
+        """
         self.mjd = mjd
         self.imgNum = imgNum
         self.site = site.lower()
 
-        imgNumStr = str(imgNum).zfill(4)
-        self.gfaDict = {}
-        for gfaNum in range(1,7):
-            if site.lower() == "apo":
-                gfaNumStr = "gfa%in"%gfaNum
-            else:
-                gfaNumStr = "gfa%is"%gfaNum
-            imgFile = getGimgBasePath(site)+ "/%i/proc-gimg-%s-%s.fits"%(mjd,gfaNumStr,imgNumStr)
-            if not os.path.exists(imgFile):
-                continue
-            self.gfaDict[gfaNum] = ProcGimg(imgFile, site, gfaNum)
+        chipFiles = getChipFiles(site, mjd, imgNum)
+        self.gfaDict, self.failedChips = loadChips(
+            ProcGimg, chipFiles, site, executor, maxWorkers
+        )
+        if len(self.gfaDict) == 0:
+            raise RuntimeError("no chips processed for %s %i %i"%(site, mjd, imgNum))
 
         dfList = []
         for gfaID, gfaDict in self.gfaDict.items():
@@ -547,16 +1160,23 @@ class GuideBundle(object):
 
         self.fitWokOffset()
         if fitPointing:
-            self.fitPointing()
+            self.fitPointing(method=pointingMethod)
         else:
             self.raCenFit = numpy.nan
             self.decCenFit = numpy.nan
             self.paFit = numpy.nan
             self.scaleFit = numpy.nan
 
+    @property
+    def refGFA(self):
+        # chip used for header values, gfa 3 unless it failed
+        if 3 in self.gfaDict:
+            return self.gfaDict[3]
+        return list(self.gfaDict.values())[0]
+
     @property
     def configid(self):
-        return self.gfaDict[3].configid
+        return self.refGFA.configid
 
     def fitWokOffset(self):
 
@@ -587,47 +1207,64 @@ class GuideBundle(object):
         self.matches["rms"] = self.rms
         self.matches["fitrms"] = self.fitrms
 
-    def _xyWokRMS(self, x):
-
-        raField, decField, paField, focalScale = x
-
-        dateObsJD = self.gfaDict[3].dateObs.jd
-        site = self.site.upper()
-        ra = self.matches.ra.to_numpy()
-        dec = self.matches.dec.to_numpy()
-        pmra = self.matches.pmra.to_numpy()
-        pmdec = self.matches.pmdec.to_numpy()
-
-        xWokExpect, yWokExpect, fieldWarn, HA, PA = radec2wokxy(
-            ra, dec, GAIA_EPOCH, "GFA",
-            raField, decField, paField,
-            site.upper(), dateObsJD, focalScale=focalScale,
-            pmra=pmra, pmdec=pmdec
+    def _pointingArrays(self):
+        # cache numpy arrays so the objective doesn't touch pandas
+        self._ptArrays = dict(
+            ra=self.matches.ra.to_numpy(),
+            dec=self.matches.dec.to_numpy(),
+            pmra=self.matches.pmra.to_numpy(),
+            pmdec=self.matches.pmdec.to_numpy(),
+            xWokMeas=self.matches.xWok_meas.to_numpy(),
+            yWokMeas=self.matches.yWok_meas.to_numpy(),
+            site=self.site.upper(),
+            dateObsJD=self.refGFA.dateObs.jd
         )
 
-        xWokMeas = self.matches.xWok_meas.to_numpy()
-        yWokMeas = self.matches.yWok_meas.to_numpy()
+    def _xyWokResid(self, x):
+        if getattr(self, "_ptArrays", None) is None:
+            self._pointingArrays()
+        self.nEvalPointing += 1
+        return wokResiduals(x, **self._ptArrays)
+
+    def _xyWokRMS(self, x):
+        resid = self._xyWokResid(x)
+        # mean of dx**2 + dy**2 over stars
+        return numpy.sqrt(2 * numpy.mean(resid**2))
 
-        dx = xWokExpect - xWokMeas
-        dy = yWokExpect - yWokMeas
-        dr = numpy.sqrt(dx**2+dy**2)
-        return numpy.sqrt(numpy.mean(dr**2))
 
+    def fitPointing(self, method="powell"):
+        """ solve for ra/dec/pa/scale
 
-    def fitPointing(self):
-        # solve for ra/dec/pa/scale
-        raInit = self.gfaDict[3].ff[1].header["RAFIELD"]
-        decInit = self.gfaDict[3].ff[1].header["DECFIELD"]
-        paInit = self.gfaDict[3].ff[1].header["FIELDPA"]
+        Parameters
+        -----------
+        method : str
+            "powell" for Powell minimization of the rms, "lsq" (opt in)
+            for least squares on the per star wok residuals (solveLSQ)
+        """
+        raInit = self.refGFA.ff[1].header["RAFIELD"]
+        decInit = self.refGFA.ff[1].header["DECFIELD"]
+        paInit = self.refGFA.ff[1].header["FIELDPA"]
         self.xInit = numpy.array([raInit,decInit,paInit,1])
 
+        self._pointingArrays()
+        self.nEvalPointing = 0
         tstart = time.time()
-        self.optOut = minimize(self._xyWokRMS, self.xInit, method="Powell")
-        print("minimize took", time.time()-tstart)
+        if method == "lsq":
+            self.optOut = solveLSQ(self._xyWokResid, self.xInit, POINTING_FD_STEPS)
+            self.pointingCov = self.optOut.cov
+        elif method == "powell":
+            self.optOut = minimize(self._xyWokRMS, self.xInit, method="Powell")
+            self.pointingCov = None
+        else:
+            raise RuntimeError("unknown fitPointing method %s"%method)
+        self.fitPointingTime = time.time()-tstart
+        nEval = self.nEvalPointing
+        print("minimize took", self.fitPointingTime, "nEval", nEval)
 
         self.raCenFit, self.decCenFit, self.paFit, self.scaleFit = self.optOut.x
         self.rmsGuess = self._xyWokRMS(self.xInit)
         self.rmsFit = self._xyWokRMS(self.optOut.x)
+        self.nEvalPointing = nEval
 
     def plots(self):
 
@@ -654,7 +1291,10 @@ class GuideBundle(object):
         plt.close("all")
 
 class ProcGimgLite(object):
-    def __init__(self, filename, site, gfaID, extract=True, focalScale=1, gfaCoords=None):
+    def __init__(
+        self, filename, site, gfaID, extract=True, focalScale=1, gfaCoords=None,
+        header=None, nDetect=None
+    ):
         """
         Parameters
         ------------------
@@ -669,6 +1309,12 @@ class ProcGimgLite(object):
             present from fits file
         focalScale : float
             scale to use for coordio conversions
+        header : str, astropy.io.fits.Header, or None
+            extension 1 header (eg from gimgIndex), if supplied the
+            fits file isn't opened
+        nDetect : int or None
+            number of detections (eg from gimgIndex), required if header
+            is supplied
 
         """
         self.filename = filename
@@ -681,7 +1327,11 @@ class ProcGimgLite(object):
         else:
             self.gfaCoords = gfaCoords.copy()
 
-        self.ff = fits.open(filename)
+        if header is not None:
+            self.ff = _FitsStandIn.fromHeader(header)
+        else:
+            self.ff = fits.open(filename)
+        self._nDetect = nDetect
         self.astroNetSolved = self.ff[1].header["SOLVED"]
 
         # if extract:
@@ -778,6 +1428,13 @@ class ProcGimgLite(object):
 
         # return pandas.Series(d)
 
+    def __getstate__(self):
+        # don't ship pixels across process boundaries
+        state = self.__dict__.copy()
+        if isinstance(self.ff, fits.HDUList):
+            state["ff"] = _FitsStandIn(self.ff)
+        return state
+
     @property
     def offRA(self):
         # ra offset in degrees
@@ -898,6 +1555,8 @@ class ProcGimgLite(object):
     @property
     def nDetect(self):
         # get number of centroids with > 900 peak counts
+        if self._nDetect is not None:
+            return self._nDetect
         cents = self.ff["CENTROIDS"].data
         if len(cents)==0:
             return 0
@@ -932,22 +1591,29 @@ class ProcGimgLite(object):
 
 
 class GuideBundleLite(object):
-    def __init__(self, site, mjd, imgNum):
+    def __init__(self, site, mjd, imgNum, executor=None, maxWorkers=6, gimgIndex=None):
+        """ executor and maxWorkers as in GuideBundle. If gimgIndex (a
+        gimgIndex.GimgIndex for this site/mjd) is supplied headers are read
+        from the index rather than from the fits files.
+        """
         self.mjd = mjd
         self.imgNum = imgNum
         self.site = site.lower()
 
-        imgNumStr = str(imgNum).zfill(4)
-        self.gfaDict = {}
-        for gfaNum in range(1,7):
-            if site.lower() == "apo":
-                gfaNumStr = "gfa%in"%gfaNum
-            else:
-                gfaNumStr = "gfa%is"%gfaNum
-            imgFile = getGimgBasePath(site)+ "/%i/proc-gimg-%s-%s.fits"%(mjd,gfaNumStr,imgNumStr)
-            if not os.path.exists(imgFile):
-                continue
-            self.gfaDict[gfaNum] = ProcGimgLite(imgFile, site, gfaNum)
+        chipKwargs = None
+        rows = None
+        if gimgIndex is not None:
+            rows = gimgIndex.query(imgNum=imgNum, header=True)
+        if rows is not None and len(rows) > 0:
+            chipFiles = dict(zip(rows.gfaNum, rows.filename))
+            chipKwargs = {}
+            for gfaNum, header, nDetect in zip(rows.gfaNum, rows.header, rows.nDetect):
+                chipKwargs[gfaNum] = {"header": header, "nDetect": int(nDetect)}
+        else:
+            chipFiles = getChipFiles(site, mjd, imgNum)
+        self.gfaDict, self.failedChips = loadChips(
+            ProcGimgLite, chipFiles, site, executor, maxWorkers, chipKwargs
+        )
 
     def toPandas(self):
         dfList = []
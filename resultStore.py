@@ -0,0 +1,132 @@
+import os
+import pandas
+import pyarrow
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+RESULT_STORE_DIR = "/uufs/chpc.utah.edu/common/home/u0449727/work/ditherResults"
+
+PARTITION_SCHEMA = pyarrow.schema([
+    ("site", pyarrow.string()),
+    ("mjd", pyarrow.int32()),
+    ("configID", pyarrow.int64()),
+])
+
+# per fiber dither measurements written by Configuration.bundleSciExps,
+# magnitude column is hmag for apogee and flux_g for boss (null otherwise)
+DITHER_SCHEMA = pyarrow.schema([
+    ("positionerId", pyarrow.int32()),
+    ("fiberId", pyarrow.int32()),
+    ("fiberType", pyarrow.string()),
+    ("spectroflux", pyarrow.float64()),
+    ("spectroflux_ivar", pyarrow.float64()),
+    ("hmag", pyarrow.float64()),
+    ("flux_g", pyarrow.float64()),
+    ("flux_expect", pyarrow.float64()),
+    ("xWokStar", pyarrow.float64()),
+    ("yWokStar", pyarrow.float64()),
+    ("xWokFiber", pyarrow.float64()),
+    ("yWokFiber", pyarrow.float64()),
+    ("raFit", pyarrow.float64()),
+    ("decFit", pyarrow.float64()),
+    ("paFit", pyarrow.float64()),
+    ("scaleFit", pyarrow.float64()),
+    ("dateObsJD", pyarrow.float64()),
+    ("sigmaGFA", pyarrow.float64()),
+    ("fluxRatioGFA", pyarrow.float64()),
+    ("sciImgNum", pyarrow.int64()),
+    ("nGimg", pyarrow.int32()),
+    ("alpha", pyarrow.float64()),
+    ("beta", pyarrow.float64()),
+])
+
+TABLE_SCHEMAS = {"dither": DITHER_SCHEMA}
+
+# within a file rows are sorted on these so row group statistics prune
+SORT_COLUMNS = {"dither": ["positionerId"], "gfa": ["imgNum", "gfaID"]}
+
+
+class ResultStore(object):
+    def __init__(self, rootDir=RESULT_STORE_DIR, compression="zstd"):
+        """
+        Parquet datasets of pipeline results (one per table, eg "dither"
+        and "gfa") hive partitioned by site/mjd/configID.  Each science
+        exposure is one file, rewriting an exposure replaces its file.
+
+        Parameters
+        ------------------
+        rootDir : string
+            directory holding one sub directory per table
+        compression : string
+            parquet compression codec
+        """
+        self.rootDir = rootDir
+        self.compression = compression
+        self.partitioning = ds.partitioning(PARTITION_SCHEMA, flavor="hive")
+
+    def tableDir(self, table):
+        return os.path.join(self.rootDir, table)
+
+    def _toArrow(self, table, df):
+        df = df.loc[:, ~df.columns.duplicated()]
+        schema = TABLE_SCHEMAS.get(table, None)
+        if schema is None:
+            # no fixed schema (eg gfa matches), use pandas' but drop the index
+            return pyarrow.Table.from_pandas(df, preserve_index=False)
+        df = df.copy()
+        for field in schema:
+            if field.name not in df.columns:
+                df[field.name] = None
+        return pyarrow.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+
+    def write(self, table, df, site, mjd, configID, sciImgNum):
+        """ write (or replace) the rows of one science exposure
+        """
+        sortCols = [c for c in SORT_COLUMNS.get(table, []) if c in df.columns]
+        if len(sortCols) > 0:
+            df = df.sort_values(sortCols, kind="stable")
+        arrow = self._toArrow(table, df)
+        outDir = os.path.join(
+            self.tableDir(table), "site=%s"%site.lower(), "mjd=%i"%mjd,
+            "configID=%i"%configID
+        )
+        os.makedirs(outDir, exist_ok=True)
+        path = os.path.join(outDir, "%s-%i.parquet"%(table, sciImgNum))
+        # hidden (dot) name so readers never pick up a partial file
+        tmpPath = os.path.join(outDir, ".%s-%i.parquet.tmp%i"%(table, sciImgNum, os.getpid()))
+        pq.write_table(arrow, tmpPath, compression=self.compression)
+        os.replace(tmpPath, path)
+        return path
+
+    def dataset(self, table):
+        return ds.dataset(
+            self.tableDir(table), format="parquet", partitioning=self.partitioning,
+            schema=self._datasetSchema(table)
+        )
+
+    def _datasetSchema(self, table):
+        schema = TABLE_SCHEMAS.get(table, None)
+        if schema is None:
+            return None
+        for field in PARTITION_SCHEMA:
+            schema = schema.append(field)
+        return schema
+
+    def read(self, table, filters=None, columns=None):
+        """ read a table as a DataFrame.  filters are pushed down to the
+        partitions (site, mjd, configID) and parquet row group statistics,
+        either a pyarrow.dataset expression or pyarrow/pandas style tuples,
+        eg [("configID", "in", [5951, 5952]), ("positionerId", "=", 1234)]
+
+        Returns
+        ---------
+        pandas.DataFrame
+            empty if nothing has been written to the table
+        """
+        if not os.path.exists(self.tableDir(table)):
+            return pandas.DataFrame()
+        if filters is not None and not isinstance(filters, ds.Expression):
+            filters = pq.filters_to_expression(filters)
+        arrow = self.dataset(table).to_table(filter=filters, columns=columns)
+        return arrow.to_pandas()
@@ -1,7 +1,7 @@
 from commiss import db
 import pandas
 import os
-from confSumm import Configuration
+from batchDriver import runBatch, configIDsFromScrape, siteMJDsFromScrape
 
 # confMJD = [ [ 5144, 59704],
 #             [ 5146, 59704],
@@ -124,23 +124,22 @@ def getLCO():
     df.to_csv("holtzScrapeLCO.csv", index=False)
 
 
-def procAllLCO():
+def procAllLCO(cpuBudget=25, nConcurrent=4, retryFailed=False, bundleCache=True):
+    # resumable, configurations already done (see batchManifest.sqlite)
+    # are skipped and failures are logged to batchFailures.log
     os.nice(10)
-    df = pandas.read_csv("holtzScrapeLCO.csv")
-    configIDs = list(set(df.configurationId))
-    for configID in configIDs:
-        Configuration(configID)
+    configIDs = configIDsFromScrape("holtzScrapeLCO.csv")
+    siteMJDs = siteMJDsFromScrape("holtzScrapeLCO.csv")
+    return runBatch(
+        configIDs, cpuBudget=cpuBudget, nConcurrent=nConcurrent,
+        retryFailed=retryFailed, bundleCache=bundleCache, siteMJDs=siteMJDs
+    )
 
 
 if __name__ == "__main__":
     # procAllLCO()
     # Configuration(10000385)
-    Configuration(10001077)
-    Configuration(10001075)
-    Configuration(10001073)
-    Configuration(10000385)
-    Configuration(10001082)
-    Configuration(10001084)
+    runBatch([10001077, 10001075, 10001073, 10000385, 10001082, 10001084])
 
 
 
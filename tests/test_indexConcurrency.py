@@ -0,0 +1,98 @@
+""" two configurations from the same night (as run side by side by
+batchDriver.runBatch) update the same site/mjd gimgIndex and expCatalog
+at once, neither index may end up with duplicate rows
+"""
+import os
+import sys
+import gzip
+import sqlite3
+import multiprocessing
+import numpy
+from astropy.io import fits
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from gimgIndex import GimgIndex
+from expCatalog import ExpCatalog
+
+SITE = "lco"
+MJD = 59900
+N_FILES = 40
+
+
+def writeGimgs(gimgBase):
+    mjdDir = os.path.join(gimgBase, SITE, "%i"%MJD)
+    os.makedirs(mjdDir)
+    for imgNum in range(1, N_FILES // 4 + 1):
+        for gfaNum in range(1, 5):
+            header = fits.Header({"CONFIGID": 10000385, "DATE-OBS": "2022-11-20 01:02:03", "EXPTIME": 15.0})
+            cents = fits.BinTableHDU.from_columns(
+                [fits.Column(name="peak", format="E", array=numpy.array([100., 800., 1200.]))],
+                name="CENTROIDS"
+            )
+            hdul = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(numpy.zeros((4, 4)), header=header), cents])
+            hdul.writeto(os.path.join(mjdDir, "proc-gimg-gfa%in-%s.fits"%(gfaNum, str(imgNum).zfill(4))))
+
+
+def writeExps(dataBase):
+    apDir = os.path.join(dataBase, "apogee", SITE, "%i"%MJD)
+    bossDir = os.path.join(dataBase, "boss", "spectro", SITE, "%i"%MJD)
+    os.makedirs(apDir)
+    os.makedirs(bossDir)
+    for expNum in range(N_FILES // 2):
+        header = fits.Header({"IMAGETYP": "Object", "CONFIGID": 10000385, "DATE-OBS": "2022-11-20T01:02:03", "EXPTIME": 500.})
+        hdul = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(numpy.zeros((4, 4)), header=header)])
+        hdul.writeto(os.path.join(apDir, "asR-a-%i.apz"%(40000000 + expNum)))
+        header = fits.Header({"FLAVOR": "science", "CONFID": 10000385, "DATE-OBS": "2022-11-20T01:02:03", "EXPTIME": 900.})
+        path = os.path.join(bossDir, "sdR-b1-%s.fit.gz"%str(expNum).zfill(8))
+        fits.PrimaryHDU(numpy.zeros((4, 4)), header=header).writeto(path[:-3])
+        with open(path[:-3], "rb") as f, gzip.open(path, "wb") as g:
+            g.write(f.read())
+        os.remove(path[:-3])
+
+
+def _update(index, barrier):
+    barrier.wait()
+    index.update(nProcs=1)
+
+
+def runConcurrently(index, nProcs=2):
+    ctx = multiprocessing.get_context("fork")
+    barrier = ctx.Barrier(nProcs)
+    procs = [ctx.Process(target=_update, args=(index, barrier)) for ii in range(nProcs)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+
+
+def countRows(path, table):
+    conn = sqlite3.connect(path)
+    nRows, nFiles = conn.execute(
+        "select count(*), count(distinct filename) from %s"%table
+    ).fetchone()
+    conn.close()
+    return nRows, nFiles
+
+
+def test_gimgIndexConcurrentUpdate(tmp_path):
+    gimgBase = str(tmp_path / "gcam") + "/"
+    writeGimgs(gimgBase)
+    index = GimgIndex(SITE, MJD, indexDir=str(tmp_path / "index"), gimgBase=gimgBase)
+    runConcurrently(index)
+    assert countRows(index.path, "gimg") == (N_FILES, N_FILES)
+    imgs = index.query()
+    assert not imgs.duplicated(["imgNum", "gfaNum"]).any()
+    # a later update with nothing changed reads nothing
+    assert index.update(nProcs=1) == 0
+
+
+def test_expCatalogConcurrentUpdate(tmp_path):
+    dataBase = str(tmp_path / "data")
+    writeExps(dataBase)
+    catalog = ExpCatalog(SITE, MJD, catalogDir=str(tmp_path / "catalog"), dataBase=dataBase)
+    runConcurrently(catalog)
+    assert countRows(catalog.path, "exps") == (N_FILES, N_FILES)
+    exps = catalog.query()
+    assert not exps.duplicated(["instrument", "camera", "expNum"]).any()
+    assert catalog.update(nProcs=1) == 0